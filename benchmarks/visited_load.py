@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Load generator for /visited: several client processes send requests to a running server, reports requests per second.
+
+E.g. to check how throughput scales with workers, run against `promnesia serve --workers N` for different N:
+
+    promnesia serve --db /path/to/promnesia.sqlite --workers 4 &
+    python3 benchmarks/visited_load.py --base http://localhost:13131 --clients 8 --duration 10
+
+By default urls are https://google.com/<random number below 2 * --count> (same as make_testvisit in promnesia tests), so about half of them are visited.
+Alternatively, pass --urls with a file (one url per line) to sample from, e.g. urls from your own database.
+"""
+
+from __future__ import annotations
+
+import argparse
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from pathlib import Path
+
+import requests
+
+# urls per /visited request, roughly what the extension sends for a page with lots of links
+BATCH = 50
+
+
+def load(base: str, seed: int, *, urls: list[str] | None, count: int, duration: float) -> int:
+    """
+    Sends requests for duration seconds, returns number of requests done
+    """
+    rng = random.Random(seed)
+    requests_done = 0
+    with requests.Session() as session:
+        deadline = time.perf_counter() + duration
+        while time.perf_counter() < deadline:
+            # random urls, so the server's response cache doesn't kick in
+            if urls is None:
+                batch = [f'https://google.com/{rng.randrange(count * 2)}' for _ in range(BATCH)]
+            else:
+                batch = rng.choices(urls, k=BATCH)
+            r = session.post(base + '/visited', json={'urls': batch})
+            assert r.status_code == 200, r
+            requests_done += 1
+    return requests_done
+
+
+def run(base: str, *, clients: int, duration: float, warmup: float, count: int, urls: list[str] | None) -> float:
+    """
+    Returns requests per second across all clients
+    """
+    with ProcessPoolExecutor(clients) as pool:
+        seeds = range(clients)
+        # warm up, so all server workers have their connections/statements ready
+        list(pool.map(partial(load, urls=urls, count=count, duration=warmup), [base] * clients, seeds))
+        done = list(pool.map(partial(load, urls=urls, count=count, duration=duration), [base] * clients, seeds))
+    return sum(done) / duration
+
+
+def main() -> None:
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument('--base', default='http://localhost:13131', help='server address (default: %(default)s)')
+    p.add_argument('--clients', type=int, default=8, help='number of client processes (default: %(default)s)')
+    p.add_argument('--duration', type=float, default=10.0, help='seconds to measure for (default: %(default)s)')
+    p.add_argument('--warmup', type=float, default=1.0, help='seconds to warm up for (default: %(default)s)')
+    p.add_argument(
+        '--count', type=int, default=100_000, help='number of visits in the test database (default: %(default)s)'
+    )
+    p.add_argument('--urls', type=Path, help='file with urls to sample from, instead of the test ones')
+    args = p.parse_args()
+
+    urls = None if args.urls is None else args.urls.read_text().splitlines()
+    qps = run(
+        args.base,
+        clients=args.clients,
+        duration=args.duration,
+        warmup=args.warmup,
+        count=args.count,
+        urls=urls,
+    )
+    print(f'/visited: {args.clients} clients, {qps:.0f} requests/sec')
+
+
+if __name__ == '__main__':
+    main()
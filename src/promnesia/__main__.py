@@ -2,6 +2,7 @@ from __future__ import annotations
 
 import argparse
 import ast
+import hashlib
 import importlib
 import inspect
 import os
@@ -9,6 +10,7 @@ import shlex
 import shutil
 import sys
 from collections.abc import Callable, Iterable, Iterator, Sequence
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from subprocess import Popen, check_call, run
 from tempfile import TemporaryDirectory, gettempdir
@@ -20,18 +22,41 @@ from .common import (
     PathIsh,
     Res,
     Source,
+    _promnesia_version,
     default_config_path,
     get_system_tz,
     get_tmpdir,
     logger,
     user_config_file,
 )
+from .database.common import (
+    SourceFingerprints,
+    get_shard_path,
+    get_shards_dir,
+    has_both_layouts,
+    remove_db,
+)
 from .database.dump import visits_to_sqlite
-from .extract import extract_visits
+from .database.load import get_source_fingerprints
+from .extract import _picklable, extract_visits_parallel, extract_visits_with_hook
 from .misc import install_server
 
 
-def iter_all_visits(sources_subset: Iterable[str | int] = ()) -> Iterator[Res[DbVisit]]:
+def iter_all_visits(
+    sources_subset: Iterable[str | int] = (),
+    *,
+    fingerprints: SourceFingerprints | None = None,
+    parallel: int | None = None,
+    config_errors: bool = True,
+) -> Iterator[Res[DbVisit]]:
+    """
+    :param config_errors: whether to yield errors for the config sources that failed to load
+    :param fingerprints:
+        if passed, sources with fingerprints matching the previous run are skipped,
+        and fingerprints of the (successfully) extracted sources are collected in fingerprints.current
+    :param parallel:
+        if passed, sources are extracted in parallel by that many worker processes (0 means number of cpus)
+    """
     cfg = config.get()
     output_dir = cfg.output_dir
     # not sure if belongs here??
@@ -47,6 +72,7 @@ def iter_all_visits(sources_subset: Iterable[str | int] = ()) -> Iterator[Res[Db
     if is_subset_sources:
         sources_subset = set(sources_subset)
 
+    selected: list[tuple[int, Res[Source]]] = []
     for i, source in enumerate(sources):
         # TODO why would it not be present??
         name: str | None = getattr(source, "name", None)
@@ -57,9 +83,17 @@ def iter_all_visits(sources_subset: Iterable[str | int] = ()) -> Iterator[Res[Db
             else:
                 logger.debug("skipping '%s' not in --sources.", name)
                 continue
+        selected.append((i, source))
+
+    group_fingerprints: dict[str, str | None] = {}
+    if fingerprints is not None:
+        group_fingerprints = _group_fingerprints([s for _, s in selected if isinstance(s, Source)])
 
+    jobs: list[tuple[int, Source]] = []
+    for i, source in selected:
         if isinstance(source, Exception):
-            yield source
+            if config_errors:
+                yield source
             continue
 
         if not isinstance(source, Source):
@@ -68,28 +102,108 @@ def iter_all_visits(sources_subset: Iterable[str | int] = ()) -> Iterator[Res[Db
             yield RuntimeError(f"Shouldn't have gotten this as a source: {source}")
             continue
 
-        _einfo = source.description  # FIXME hmm it's not even used?? add as exception notes?
-        for v in extract_visits(source, src=source.name):
-            if hook is None:
-                yield v
-            else:
-                try:
-                    yield from hook(v)
-                except Exception as e:
-                    yield e
+        if fingerprints is not None:
+            fingerprint = group_fingerprints[source.name]
+            if fingerprint is not None and fingerprints.previous.get(source.name) == fingerprint:
+                if source.name not in fingerprints.skipped:
+                    logger.info("skipping '%s', inputs haven't changed since the last indexing", source.name)
+                    fingerprints.skipped.append(source.name)
+                continue
+
+        jobs.append((i, source))
+
+    if parallel is not None and config.instance_path is None:
+        logger.warning("parallel indexing is only supported when config is loaded from a file, falling back to serial")
+        parallel = None
+
+    results: Iterable[tuple[Source, Res[DbVisit]]]
+    if parallel is None:
+        results = ((source, v) for _, source in jobs for v in extract_visits_with_hook(source, hook=hook))
+    else:
+        assert config.instance_path is not None  # make type checker happy
+        logger.info('extracting %d sources in parallel', len(jobs))
+        results = extract_visits_parallel(jobs, config_path=config.instance_path, workers=parallel)
+
+    failed: set[str] = set()
+    for source, v in results:
+        if isinstance(v, Exception):
+            failed.add(source.name)
+        yield v
+
+    if fingerprints is not None:
+        for name, fingerprint in group_fingerprints.items():
+            # if there were errors, better to retry next time
+            if fingerprint is not None and name not in failed and name not in fingerprints.skipped:
+                fingerprints.current[name] = fingerprint
 
     if sources_subset:  # type: ignore[truthy-iterable]
         logger.warning("unknown --sources: %s", ", ".join(repr(i) for i in sources_subset))
 
 
+def _group_fingerprints(sources: Sequence[Source]) -> dict[str, str | None]:
+    # sources with the same name end up under the same src in the database, so can only be skipped together
+    # also need to take config FILTERS/HOOK into account since they affect the resulting visits
+    cfg = config.get()
+    shared = repr((cfg.FILTERS, getattr(cfg.hook, '__qualname__', cfg.hook), _promnesia_version()))
+    groups: dict[str, list[Source]] = {}
+    for source in sources:
+        groups.setdefault(source.name, []).append(source)
+
+    res: dict[str, str | None] = {}
+    for name, group in groups.items():
+        fps: list[str | None] = []
+        for source in group:
+            try:
+                fps.append(source.fingerprint())
+            except Exception as e:
+                logger.exception(e)
+                logger.warning("couldn't compute fingerprint for '%s', will reindex it", name)
+                fps.append(None)
+        if any(fp is None for fp in fps):
+            res[name] = None
+        else:
+            res[name] = hashlib.sha256(repr((shared, fps)).encode('utf8')).hexdigest()
+    return res
+
+
 def _do_index(
-    *, dry: bool = False, sources_subset: Iterable[str | int] = (), overwrite_db: bool = False
+    *,
+    dry: bool = False,
+    sources_subset: Iterable[str | int] = (),
+    overwrite_db: bool = False,
+    skip_unchanged: bool = False,
+    parallel: int | None = None,
 ) -> Iterable[Exception]:
     # also keep & return errors for further display
     errors: list[Exception] = []
 
+    if skip_unchanged and overwrite_db:
+        logger.warning("--skip-unchanged doesn't make sense with --overwrite, ignoring")
+        skip_unchanged = False
+
+    if config.get().SHARDED_DB and not dry:
+        errors = _do_index_sharded(
+            sources_subset=sources_subset,
+            overwrite_db=overwrite_db,
+            skip_unchanged=skip_unchanged,
+            parallel=parallel,
+        )
+        _warn_if_both_layouts()
+        return errors
+
+    if overwrite_db and not dry:
+        # otherwise server would still query the shards (e.g. if SHARDED_DB was set previously)
+        shards_dir = get_shards_dir(config.get().db)
+        for shard in shards_dir.glob('*.sqlite'):
+            logger.info('removing shard %s, since SHARDED_DB is off', shard)
+            remove_db(shard)
+
+    fingerprints: SourceFingerprints | None = None
+    if skip_unchanged:
+        fingerprints = SourceFingerprints(previous=get_source_fingerprints(config.get().db))
+
     def it() -> Iterable[Res[DbVisit]]:
-        for v in iter_all_visits(sources_subset):
+        for v in iter_all_visits(sources_subset, fingerprints=fingerprints, parallel=parallel):
             if isinstance(v, Exception):
                 errors.append(v)
             yield v
@@ -100,10 +214,143 @@ def _do_index(
         for v in res:
             print(v)
     else:
-        dump_errors = visits_to_sqlite(it(), overwrite_db=overwrite_db)
+        dump_errors = visits_to_sqlite(it(), overwrite_db=overwrite_db, fingerprints=fingerprints)
         for e in dump_errors:
             logger.exception(e)
             errors.append(e)
+        _warn_if_both_layouts()
+    return errors
+
+
+def _warn_if_both_layouts() -> None:
+    db = config.get().db
+    if has_both_layouts(db):
+        logger.warning(
+            "both %s and shards in %s exist (was SHARDED_DB changed?), server would return duplicate visits. "
+            "Run with --overwrite to remove the stale ones.",
+            db,
+            get_shards_dir(db),
+        )
+
+
+def _index_shard(
+    name: str,
+    sources_idxs: Sequence[int],
+    *,
+    overwrite_db: bool,
+    skip_unchanged: bool,
+) -> tuple[list[Exception], bool]:
+    """
+    Indexes sources with this name into their shard.
+    Returns errors, and whether anything was indexed (or skipped since it's unchanged).
+    """
+    shard = get_shard_path(config.get().db, name)
+    fingerprints: SourceFingerprints | None = None
+    if skip_unchanged:
+        fingerprints = SourceFingerprints(previous=get_source_fingerprints(shard))
+
+    errors: list[Exception] = []
+    indexed = 0
+
+    def it() -> Iterable[Res[DbVisit]]:
+        nonlocal indexed
+        for v in iter_all_visits(sources_idxs, fingerprints=fingerprints, config_errors=False):
+            if isinstance(v, Exception):
+                errors.append(v)
+            else:
+                indexed += 1
+            yield v
+
+    dump_errors = visits_to_sqlite(
+        it(),
+        overwrite_db=overwrite_db,
+        fingerprints=fingerprints,
+        allow_empty=True,  # checked across all shards by the caller
+        _db_path=shard,
+    )
+    for e in dump_errors:
+        logger.exception(e)
+        errors.append(e)
+    skipped = fingerprints is not None and len(fingerprints.skipped) > 0
+    return errors, indexed > 0 or skipped
+
+
+def _index_shard_in_worker(name: str, sources_idxs: Sequence[int], **kwargs) -> tuple[list[Exception], bool]:
+    errors, ok = _index_shard(name, sources_idxs, **kwargs)
+    return [_picklable(e) for e in errors], ok
+
+
+def _do_index_sharded(
+    *,
+    sources_subset: Iterable[str | int],
+    overwrite_db: bool,
+    skip_unchanged: bool,
+    parallel: int | None,
+) -> list[Exception]:
+    """
+    Indexes each source (i.e. all sources with the same name) into its own database, see SHARDED_DB in config.
+    With parallel, each shard is extracted and written by its own worker process, since shards don't share any locks.
+    """
+    cfg = config.get()
+    db = cfg.db
+    errors: list[Exception] = []
+
+    subset = set(sources_subset)
+    is_subset_sources = len(subset) > 0
+    groups: dict[str, list[int]] = {}
+    selected: set[str] = set()
+    for i, source in enumerate(cfg.sources):
+        if isinstance(source, Exception):
+            errors.append(source)
+            continue
+        groups.setdefault(source.name, []).append(i)
+        if not is_subset_sources or source.name in subset or i in subset:
+            selected.add(source.name)
+            subset -= {i, source.name}
+    if len(subset) > 0:
+        logger.warning("unknown --sources: %s", ", ".join(repr(i) for i in subset))
+
+    shards_dir = get_shards_dir(db)
+    shards_dir.mkdir(parents=True, exist_ok=True)
+    if overwrite_db and not is_subset_sources:
+        # same as with a single database: whatever isn't in the config anymore is removed
+        keep = {get_shard_path(db, name) for name in selected}
+        for shard in shards_dir.glob('*.sqlite'):
+            if shard not in keep:
+                logger.info('removing stale shard %s', shard)
+                remove_db(shard)
+        if db.exists():
+            # otherwise server would still query it (e.g. if it was indexed before SHARDED_DB was set)
+            logger.info('removing %s, since SHARDED_DB is on', db)
+            remove_db(db)
+
+    if parallel is not None and config.instance_path is None:
+        logger.warning("parallel indexing is only supported when config is loaded from a file, falling back to serial")
+        parallel = None
+
+    names = sorted(selected)
+    kwargs = {'overwrite_db': overwrite_db, 'skip_unchanged': skip_unchanged}
+    results: list[tuple[list[Exception], bool]]
+    if parallel is None:
+        results = [_index_shard(name, groups[name], **kwargs) for name in names]
+    else:
+        assert config.instance_path is not None  # make type checker happy
+        logger.info('indexing %d shards in parallel', len(names))
+        # NOTE: sources might be defined in the config itself, so they can't be pickled -- need to load config again
+        with ProcessPoolExecutor(
+            max_workers=parallel or None,
+            initializer=config.load_from,
+            initargs=(config.instance_path,),
+        ) as pool:
+            futures = [pool.submit(_index_shard_in_worker, name, groups[name], **kwargs) for name in names]
+            results = [f.result() for f in futures]
+
+    for shard_errors, _ in results:
+        errors.extend(shard_errors)
+    if not any(ok for _, ok in results):
+        e = RuntimeError('No visits were indexed, something is probably wrong!')
+        logger.exception(e)
+        errors.append(e)
     return errors
 
 
@@ -113,18 +360,37 @@ def do_index(
     dry: bool = False,
     sources_subset: Iterable[str | int] = (),
     overwrite_db: bool = False,
+    skip_unchanged: bool = False,
+    parallel: int | None = None,
+    watch: bool = False,
+    watch_poll: float | None = None,
 ) -> Sequence[Exception]:
+    if watch and dry:
+        logger.warning("--watch doesn't make sense with --dry, ignoring")
+        watch = False
     config.load_from(config_file)  # meh.. should be cleaner
     try:
-        errors = list(_do_index(dry=dry, sources_subset=sources_subset, overwrite_db=overwrite_db))
+        errors = list(
+            _do_index(
+                dry=dry,
+                sources_subset=sources_subset,
+                overwrite_db=overwrite_db,
+                skip_unchanged=skip_unchanged,
+                parallel=parallel,
+            )
+        )
+        if len(errors) > 0:
+            logger.error('%d errors, printing them out:', len(errors))
+            for e in errors:
+                logger.exception(e)
+            logger.error('%d errors, exit code 1', len(errors))
+        if watch:
+            from .watch import watch as do_watch
+
+            do_watch(set(sources_subset), poll=watch_poll)
     finally:
         # this reset is mainly for tests, so we don't end up reusing the same config by accident
         config.reset()
-    if len(errors) > 0:
-        logger.error('%d errors, printing them out:', len(errors))
-        for e in errors:
-            logger.exception(e)
-        logger.error('%d errors, exit code 1', len(errors))
     return errors
 
 
@@ -359,6 +625,32 @@ def main() -> None:
     add_index_args(ep, default_config_path())
     # TODO use some way to override or provide config only via cmdline?
     ep.add_argument('--intermediate', required=False, help="Used for development, you don't need it")
+    ep.add_argument(
+        '--skip-unchanged',
+        action='store_true',
+        help="Skip sources whose inputs haven't changed since the last indexing (based on input files mtimes/sizes, see Source.fingerprint)",
+    )
+    ep.add_argument(
+        '--parallel',
+        type=int,
+        nargs='?',
+        const=0,
+        default=None,
+        metavar='WORKERS',
+        help="(experimental) Extract sources in parallel, using WORKERS processes (or number of cpus if not specified)",
+    )
+    ep.add_argument(
+        '--watch',
+        action='store_true',
+        help="(experimental) After indexing, keep watching files indexed by auto sources and reindex them as they change",
+    )
+    ep.add_argument(
+        '--watch-poll',
+        type=float,
+        default=None,
+        metavar='SECONDS',
+        help="With --watch, poll for changes every SECONDS instead of relying on inotify (e.g. for network filesystems)",
+    )
 
     sp = subp.add_parser('serve', help='Serve a link database', formatter_class=F)
     server.setup_parser(sp)
@@ -431,6 +723,10 @@ def main() -> None:
                 dry=args.dry,
                 sources_subset=args.sources,
                 overwrite_db=args.overwrite,
+                skip_unchanged=args.skip_unchanged,
+                parallel=args.parallel,
+                watch=args.watch,
+                watch_poll=args.watch_poll,
             )
             if len(errors) > 0:
                 sys.exit(1)
@@ -18,6 +18,7 @@ import urllib.parse
 from collections.abc import Collection, Iterable, Sequence
 
 # TODO eh?? they fixed mobile.twitter.com?
+from functools import lru_cache
 from itertools import chain
 from typing import Any, NamedTuple
 from urllib.parse import SplitResult, parse_qsl, urlencode, urlsplit, urlunsplit
@@ -52,6 +53,8 @@ dom_subst = [
 ]  # fmt: skip
 
 
+# there are way fewer distinct domains than urls, so cheap to cache
+@lru_cache(maxsize=4096)
 def canonify_domain(dom: str) -> str:
     # TODO perhaps not necessary now that I'm checking suffixes??
     for st in ('www.', 'amp.'):
@@ -105,26 +108,43 @@ class Spec(NamedTuple):
     fkeep: bool = False
 
     def keep_query(self, q: str) -> int | None:  # returns order
+        return self.compile().keep_query(q)
+
+    def compile(self) -> CompiledSpec:
         if self.qkeep is True:
-            return 1
+            return CompiledSpec(keep_all=True, qkeep={}, qremove=frozenset())
         qkeep = {q: i for i, q in enumerate(chain(default_qkeep, self.qkeep or []))}
-        qremove = default_qremove.union(self.qremove or {})
-        # I suppose 'remove' is only useful for logging. we remove by default anyway
+        qremove = frozenset(default_qremove.union(self.qremove or {}))
+        return CompiledSpec(keep_all=False, qkeep=qkeep, qremove=qremove)
+
+    @classmethod
+    def make(cls, **kwargs) -> Spec:
+        return cls(**kwargs)
 
-        qk = qkeep.get(q)
+
+class CompiledSpec(NamedTuple):
+    """
+    Spec with query lookup tables precomputed, so they aren't rebuilt for every query parameter.
+    """
+
+    keep_all: bool
+    qkeep: dict[str, int]
+    qremove: frozenset[str]
+
+    def keep_query(self, q: str) -> int | None:  # returns order
+        if self.keep_all:
+            return 1
+        qk = self.qkeep.get(q)
         if qk is not None:
             return qk
+        # I suppose 'remove' is only useful for logging. we remove by default anyway
         # todo later, check if spec tells both to keep and remove?
-        if q in qremove:
+        if q in self.qremove:
             return None
         # by default drop all
         # it's a better default, since if it's *too* unified, the user would notice it. but not vice versa!
         return None
 
-    @classmethod
-    def make(cls, **kwargs) -> Spec:
-        return cls(**kwargs)
-
 
 S = Spec
 
@@ -182,20 +202,42 @@ specs: dict[str, Spec] = {
 _def_spec = S()
 
 
-# TODO use cache?
+# trie of reversed domain labels, e.g. 'play.google.com' -> {'com': {'google': {'play': {_SPEC: spec}}}}
+_SPEC = '.'  # can't clash with domain labels
+SpecTrie = dict[str, Any]
+
+
+def _build_spec_trie(specs: dict[str, Spec]) -> SpecTrie:
+    trie: SpecTrie = {}
+    for dom, spec in specs.items():
+        node = trie
+        for p in reversed(dom.split('.')):
+            node = node.setdefault(p, {})
+        node[_SPEC] = (spec, spec.compile())
+    return trie
+
+
+_def_spec_compiled = (_def_spec, _def_spec.compile())
+_spec_trie = _build_spec_trie(specs)
+
+
+@lru_cache(maxsize=4096)
+def _lookup_spec(dom: str) -> tuple[Spec, CompiledSpec]:
+    node = _spec_trie
+    # shortest matching suffix wins, i.e. spec for the domain without subdomains
+    for p in reversed(dom.split('.')):
+        child = node.get(p)
+        if child is None:
+            break
+        node = child
+        res = node.get(_SPEC)
+        if res is not None:
+            return res
+    return _def_spec_compiled
+
+
 def get_spec(dom: str) -> Spec:
-    # ugh. a bit ugly way of getting stuff without subdomain...
-    parts = dom.split('.')
-    cur = None
-    for p in reversed(parts):
-        if cur is None:
-            cur = p
-        else:
-            cur = p + '.' + cur
-        sp = specs.get(cur)
-        if sp is not None:
-            return sp
-    return _def_spec
+    return _lookup_spec(dom)[0]
 
 
 # ideally we'd just be able to reference the domain name and use it in the subst?
@@ -222,10 +264,13 @@ def _yc(domain: str, path: str, qq: Parts, frag: Frag) -> tuple[Any, Any, Parts,
     return (domain, path, qq, frag)
 
 
+specs2: dict[str, Spec2] = {
+    'news.ycombinator.com': _yc,
+}
+
+
 def get_spec2(dom: str) -> Spec2 | None:
-    return {
-        'news.ycombinator.com': _yc,
-    }.get(dom)
+    return specs2.get(dom)
 
 
 class CanonifyException(Exception):
@@ -251,10 +296,14 @@ def _quote_path(path: str) -> str:
     return '/'.join(nparts)
 
 
+_GOOGLE_AMP_RE = re.compile(r'google\..*/amp/s/')
+
+
 # TODO wtf is it doing???
 def _prenormalise(url: str) -> str:
     # meh..
-    url = re.sub(r'google\..*/amp/s/', '', url)
+    if '/amp/s/' in url:  # fast path, most urls aren't amp
+        url = _GOOGLE_AMP_RE.sub('', url)
 
     if '?' not in url:
         # sometimes urls have not ? but do have query parameters starting with & for some reason; urlsplit chokes over it
@@ -270,6 +319,50 @@ Left = str | Sequence[str]
 Right = tuple[str, str, str]
 
 
+ID = r'(?P<id>[^/]+)'
+# REST = r'(?P<rest>.*)'
+
+# the idea is that we can unify certain URLs here and map them to the 'canonical' one
+# this is a dict only for grouping but should be a list really.. todo
+rules: dict[Left, Right] = {
+    # TODO m. handling might be quite common
+    # f'm.youtube.com/{REST}': ('youtube.com', '{rest}'),
+    (
+        f'youtu.be/{ID}',
+        f'youtube.com/embed/{ID}',
+    ): ('youtube.com', '/watch', 'v={id}'),
+    # TODO wonder if there is a better candidate for canonical video link?
+    # {DOMAIN} pattern? implicit?
+    (
+        'twitter.com/home',
+        'twitter.com/explore',
+    ): ('twitter.com', '', ''),
+}
+
+
+Rules = dict[str, list[tuple[re.Pattern[str], Right]]]
+
+
+def _compile_rules(rules: dict[Left, Right]) -> Rules:
+    """
+    Groups rules by domain (preserving order), so only rules for the url domain need to be checked.
+    """
+    res: Rules = {}
+    for fr, to in rules.items():
+        if isinstance(fr, str):
+            fr = (fr,)
+        if len(to) == 2:
+            to = (*to, '')
+        for f in fr:
+            dom, rest = f.split('/', maxsplit=1)
+            rest = '/' + rest  # path seems to always start with /
+            res.setdefault(dom, []).append((re.compile(rest), to))
+    return res
+
+
+_rules_by_domain = _compile_rules(rules)
+
+
 def transform_split(split: SplitResult):
     netloc = canonify_domain(split.netloc)
 
@@ -278,46 +371,11 @@ def transform_split(split: SplitResult):
 
     fragment = split.fragment
 
-    ID = r'(?P<id>[^/]+)'
-    # REST = r'(?P<rest>.*)'
-
-    # the idea is that we can unify certain URLs here and map them to the 'canonical' one
-    # this is a dict only for grouping but should be a list really.. todo
-    rules: dict[Left, Right] = {
-        # TODO m. handling might be quite common
-        # f'm.youtube.com/{REST}': ('youtube.com', '{rest}'),
-        (
-            f'youtu.be/{ID}',
-            f'youtube.com/embed/{ID}',
-        ): ('youtube.com', '/watch', 'v={id}'),
-        # TODO wonder if there is a better candidate for canonical video link?
-        # {DOMAIN} pattern? implicit?
-        (
-            'twitter.com/home',
-            'twitter.com/explore',
-        ): ('twitter.com', '', ''),
-    }
-
-    def iter_rules():
-        for fr, to in rules.items():
-            if isinstance(fr, str):
-                fr = (fr,)
-            for f in fr:
-                yield f, to
-
-    for fr, to in iter_rules():
-        # TODO precache by domain?
-        dom, rest = fr.split('/', maxsplit=1)
-        if dom != netloc:
-            continue
-
-        rest = '/' + rest  # path seems to always start with /
-        m = re.fullmatch(rest, path)
+    for rest, to in _rules_by_domain.get(netloc, ()):
+        m = rest.fullmatch(path)
         if m is None:
             continue
         gd = m.groupdict()
-        if len(to) == 2:
-            to = (*to, '')
 
         (netloc, path, qq) = (t.format(**gd) for t in to)
         qparts.extend(parse_qsl(qq, keep_blank_values=True))  # TODO hacky..
@@ -356,17 +414,25 @@ def myunsplit(domain: str, path: str, query: str, fragment: str) -> str:
 #     for re in regexes:
 
 
+_ARCHIVE_ORG_RE = re.compile(r'web.archive.org/web/(?P<timestamp>\d+)/(?P<rest>.*)')
+
+
 def handle_archive_org(url: str) -> str | None:
-    are = r'web.archive.org/web/(?P<timestamp>\d+)/(?P<rest>.*)'
-    m = re.fullmatch(are, url)
+    m = _ARCHIVE_ORG_RE.fullmatch(url)
     if m is None:
         return None
     else:
         return m.group('rest')
 
 
+# browser history has lots of repeating urls, so worth caching
+# 2 ** 16 entries are roughly ~20Mb in the worst case, and should cover most of the 'hot' urls
+_CANONIFY_CACHE_SIZE = 2**16
+
+
 # TODO ok, I suppose even though we can't distinguish + and space, likelihood of them overlapping in normalised url is so low, that it doesn't matter much
 # TODO actually, might be easier for most special charaters
+@lru_cache(maxsize=_CANONIFY_CACHE_SIZE)
 def canonify(url: str) -> str:
     # TODO check for invalid charaters?
     url = _prenormalise(url)
@@ -402,7 +468,7 @@ def canonify(url: str) -> str:
         # meh
         domain, path, qq, _frag = spec2(domain, path, qq, _frag)
 
-    spec = get_spec(domain)
+    _spec, cspec = _lookup_spec(domain)
 
     # TODO FIXME turn this logic back on?
     # frag = parts.fragment if spec.fkeep else ''
@@ -410,7 +476,7 @@ def canonify(url: str) -> str:
 
     iqq = []
     for k, v in qq:
-        order = spec.keep_query(k)
+        order = cspec.keep_query(k)
         if order is not None:
             iqq.append((order, k, v))
     qq = [(k, v) for i, k, v in sorted(iqq)]
@@ -425,6 +491,23 @@ def canonify(url: str) -> str:
     return uns
 
 
+def canonify_many(urls: Iterable[str]) -> list[str]:
+    """
+    Same as canonify, but for a batch of urls; results are in the same order as the input.
+    Each distinct url is only canonified once.
+    Raises CanonifyException on the first url that can't be canonified.
+    """
+    cache: dict[str, str] = {}
+    res = []
+    for url in urls:
+        nurl = cache.get(url)
+        if nurl is None:
+            nurl = canonify(url)
+            cache[url] = nurl
+        res.append(nurl)
+    return res
+
+
 # TODO wonder if lisp could be convenient for this. lol
 TW_PATTERNS = [
     {
@@ -1,5 +1,7 @@
 from __future__ import annotations
 
+import hashlib
+import importlib.metadata
 import itertools
 import logging
 import os
@@ -7,7 +9,7 @@ import re
 import shutil
 import tempfile
 import warnings
-from collections.abc import Callable, Iterable, Sequence
+from collections.abc import Callable, Iterable, Iterator, Sequence
 from contextlib import contextmanager
 from copy import copy
 from datetime import UTC, date, datetime
@@ -43,6 +45,9 @@ Second = int
 class Loc(NamedTuple):
     title: str
     href: str | None = None
+    # file the visit was extracted from, if any
+    # used as a key to update visits for individual files (e.g. see promnesia index --watch)
+    path: str | None = None
 
     @classmethod
     def make(cls, title: str, href: str | None = None) -> Loc:
@@ -72,7 +77,7 @@ class Loc(NamedTuple):
             except Exception:
                 pass  # todo log/warn?
         loc = f'{rel}{lstr}'
-        return cls.make(title=loc, href=f'{handler}{path}{lstr}')
+        return cls(title=loc, href=f'{handler}{path}{lstr}', path=str(path))
 
     # TODO need some uniform way of string conversion
     # but generally, it will be
@@ -171,7 +176,10 @@ class DbVisit(NamedTuple):
     duration: Second | None = None
 
     @staticmethod
-    def make(p: Visit, src: SourceName) -> Res[DbVisit]:
+    def make(p: Visit, src: SourceName, *, norm_url: Url | None = None) -> Res[DbVisit]:
+        """
+        :param norm_url: if already computed (e.g. via canonify_many), saves canonifying the url again
+        """
         try:
             # hmm, mypy gets a bit confused here.. presumably because datetime is always datetime (but date is not datetime)
             if isinstance(p.dt, datetime):
@@ -184,10 +192,13 @@ class DbVisit(NamedTuple):
         except Exception as e:
             return e
 
-        try:
-            nurl = canonify(p.url)
-        except Exception as e:
-            return e
+        if norm_url is not None:
+            nurl = norm_url
+        else:
+            try:
+                nurl = canonify(p.url)
+            except Exception as e:
+                return e
 
         return DbVisit(
             # TODO shit, can't handle errors properly here...
@@ -253,7 +264,70 @@ def _sanitize(url: str) -> str:
     return url
 
 
+@lru_cache(1)
+def _get_tlds() -> frozenset[str] | None:
+    """
+    Returns None if TLDs aren't available, then the fast path is disabled and everything is handled by urlextract
+    """
+    # NOTE: using the same list as urlextract, so fast path is consistent with it
+    # _load_cached_tlds is private API, so it might change in future urlextract versions
+    try:
+        tlds = _get_urlextractor(syntax='')._load_cached_tlds()
+        return frozenset(tld.removeprefix('.').lower() for tld in tlds)
+    except Exception as e:
+        logger.warning(f"couldn't get TLDs from urlextract ({e!r}), falling back to slower url extraction")
+        return None
+
+
+# matches urls like 'https://example.com/some/path?query#frag' surrounded by whitespace
+# deliberately strict: anything unusual (parens, quotes, brackets, trailing punctuation after domain etc.)
+# is left to urlextract, which has lots of heuristics for handling them
+_WS = ' \t\n\r\x0b\x0c'  # same as string.whitespace, which urlextract is using (e.g. \xa0 isn't a separator)
+_SIMPLE_URL_RE = re.compile(
+    rf'(?<![^{_WS}])'
+    r'https?://'
+    r'(?:[a-zA-Z0-9](?:[a-zA-Z0-9-]*[a-zA-Z0-9])?\.)+'  # subdomains
+    r'(?P<tld>[a-zA-Z]{2,63})'
+    r'(?::\d{1,5})?'  # port
+    r"(?:/[a-zA-Z0-9\-._~%/?#=&+:@!$*,]*)?"
+    rf'(?![^{_WS}])'
+)
+# urlextract is looking for urls around TLDs (which always follow a dot), or 'localhost'
+_MAYBE_URL_RE = re.compile(r'\.\w|localhost', re.IGNORECASE)
+
+
+def _iter_urls_fast(s: str) -> list[Url] | None:
+    """
+    Returns None if the string needs to be handled by urlextract
+    """
+    tlds = _get_tlds()
+    if tlds is None:
+        return None
+    res = []
+    last = 0
+    for m in _SIMPLE_URL_RE.finditer(s):
+        if _MAYBE_URL_RE.search(s, last, m.start()) is not None:
+            return None
+        if m.group('tld').lower() not in tlds:
+            return None
+        res.append(m.group())
+        last = m.end()
+    if _MAYBE_URL_RE.search(s, last) is not None:
+        return None
+    return res
+
+
 def iter_urls(s: str, *, syntax: Syntax = '') -> Iterable[Url]:
+    # fast path: most strings either don't have any urls at all, or only contain simple http urls
+    # urlextract is pretty slow, so only using it when necessary
+    if _MAYBE_URL_RE.search(s) is None:
+        return
+    fast = _iter_urls_fast(s)
+    if fast is not None:
+        for u in fast:
+            yield _sanitize(u)
+        return
+
     urlextractor = _get_urlextractor(syntax=syntax)
     # note: it also has get_indices, might be useful
     for u in urlextractor.gen_urls(s):
@@ -325,10 +399,44 @@ def _get_index_function(sourceish: PreSource) -> PreExtractor:
     return res
 
 
+# returns a string which changes whenever source's inputs change
+Fingerprinter = Callable[[], str]
+
+
+def _promnesia_version() -> str | None:
+    try:
+        return importlib.metadata.version('promnesia')
+    except Exception:
+        return None
+
+
+def _path_fingerprint(path: Path) -> Iterator[str]:
+    if path.is_dir():
+        for r, dirs, files in os.walk(path):
+            dirs.sort()  # os.walk order isn't deterministic otherwise
+            for f in sorted(files):
+                yield from _path_fingerprint(Path(r) / f)
+        return
+    try:
+        st = path.stat()
+    except OSError:  # e.g. broken symlink
+        yield f'{path}:missing'
+        return
+    yield f'{path}:{st.st_mtime_ns}:{st.st_size}'
+
+
 class Source:
     # TODO make sure it works with empty src?
     # TODO later, make it properly optional?
-    def __init__(self, ff: PreSource, *args, src: SourceName = '', name: SourceName = '', **kwargs) -> None:
+    def __init__(
+        self,
+        ff: PreSource,
+        *args,
+        src: SourceName = '',
+        name: SourceName = '',
+        fingerprint: Fingerprinter | None = None,
+        **kwargs,
+    ) -> None:
         # NOTE: in principle, would be nice to make the Source countructor to be as dumb as possible
         # so we could move _get_index_function inside extractor lambda
         # but that way we get nicer error reporting
@@ -339,6 +447,7 @@ class Source:
         self.args = args
         self.kwargs = kwargs
         self.extractor: Extractor = lambda: self.ff(*self.args, **self.kwargs)
+        self.fingerprinter = fingerprint
         if src != '':
             warnings.warn("'src' argument is deprecated, use 'name' instead", DeprecationWarning)
         if name != '':
@@ -357,6 +466,31 @@ class Source:
     def description(self) -> str:
         return f'{getattr(self.ff, "__module__", None)}:{getattr(self.ff, "__name__", None)} {self.args} {self.kwargs}'
 
+    def fingerprint(self) -> str | None:
+        """
+        Used to skip reindexing sources whose inputs haven't changed (see promnesia index --skip-unchanged).
+
+        If fingerprint function isn't passed explicitly, uses paths/mtimes/sizes of files passed as the source arguments.
+        None means that we can't tell if the source changed, so it always needs to be reindexed.
+        """
+        h = hashlib.sha256(self.description.encode('utf8'))
+        if self.fingerprinter is not None:
+            h.update(self.fingerprinter().encode('utf8'))
+            return h.hexdigest()
+
+        # same as auto.index, paths in the config are often relative to home (e.g. '~/notes')
+        paths = [
+            Path(a).expanduser()
+            for a in (*self.args, *self.kwargs.values())
+            if isinstance(a, str | Path) and str(a) != '' and Path(a).expanduser().exists()
+        ]
+        if len(paths) == 0:
+            return None
+        for p in paths:
+            for x in _path_fingerprint(p):
+                h.update(x.encode('utf8'))
+        return h.hexdigest()
+
     @property
     @deprecated("'src' property is deprecated, use 'name' instead")
     def src(self) -> str:
@@ -27,6 +27,10 @@ class Config(NamedTuple):
     # if not specified, uses user data dir
     OUTPUT_DIR: PathIsh | None = None
 
+    # if True, each source is indexed into its own database (in OUTPUT_DIR/promnesia-shards)
+    # so sources can be (re)indexed independently and in parallel
+    SHARDED_DB: bool = False
+
     CACHE_DIR: PathIsh | None = ''
     FILTERS: list[str] = []  # noqa: RUF012
 
@@ -99,6 +103,8 @@ class Config(NamedTuple):
 
 
 instance: Config | None = None
+# path the config was loaded from (if any), used to load it again in subprocesses
+instance_path: Path | None = None
 
 
 def has() -> bool:
@@ -111,14 +117,16 @@ def get() -> Config:
 
 
 def load_from(config_file: Path) -> None:
-    global instance
+    global instance, instance_path
     instance = import_config(config_file)
+    instance_path = config_file
 
 
 def reset() -> None:
-    global instance
+    global instance, instance_path
     assert instance is not None
     instance = None
+    instance_path = None
 
 
 def import_config(config_file: PathIsh) -> Config:
@@ -141,7 +149,6 @@ def import_config(config_file: PathIsh) -> Config:
     return Config(**d)
 
 
-# TODO: ugh. this causes warnings to be repeated multiple times... need to reuse the pool or something..
 def use_cores() -> int | None:
     '''
     Somewhat experimental.
@@ -1,17 +1,24 @@
 from __future__ import annotations
 
+import hashlib
 from collections.abc import Sequence
-from datetime import datetime
+from dataclasses import dataclass, field
+from datetime import UTC, datetime
+from pathlib import Path
+from urllib.parse import quote
 
 from sqlalchemy import (
     Column,
+    Index,
     Integer,
+    MetaData,
     String,
+    Table,
 )
 
 # TODO maybe later move DbVisit here completely?
 # kinda an issue that it's technically an "api" because hook in config can patch up DbVisit
-from ..common import DbVisit, Loc
+from ..common import DbVisit, Loc, SourceName
 
 
 def get_columns() -> Sequence[Column]:
@@ -24,18 +31,146 @@ def get_columns() -> Sequence[Column]:
         Column('locator_href' , String()),
         Column('src'          , String()),
         Column('context'      , String()),
-        Column('duration'     , Integer())
+        Column('duration'     , Integer()),
+        Column('dt_epoch'     , Integer()),
+        Column('locator_path' , String()),
+        Column('visit_hash'   , Integer()),
     ]
     # fmt: on
-    assert len(res) == len(DbVisit._fields) + 1  # +1 because Locator is 'flattened'
+    # +2 because Locator is 'flattened', +1 for dt_epoch, +1 for visit_hash
+    assert len(res) == len(DbVisit._fields) + 4
     return res
 
 
+# utc unix timestamp derived from dt, so we can do range queries against index (e.g. in /search_around)
+# NOTE: it's missing in databases created by older versions (see migrate_columns)
+DT_EPOCH_COLUMN = 'dt_epoch'
+# Loc.path, so visits for individual files can be updated
+# NOTE: it's missing in databases created by older versions (see migrate_columns)
+LOCATOR_PATH_COLUMN = 'locator_path'
+# content hash of the visit, so indexer only has to write visits that changed (see write_diff)
+# NOTE: it's missing in databases created by older versions (see migrate_columns)
+VISIT_HASH_COLUMN = 'visit_hash'
+# explicit rowid of the visits table (full text index refers to visits by it)
+# without it, VACUUM might renumber rowids, and the full text index would point at wrong visits
+# it's the last column and only in the visits table, so rows can still be accessed positionally (see row_to_db_visit)
+# NOTE: it's missing in databases created by older versions (see migrate_columns)
+VISIT_ID_COLUMN = 'id'
+
+
+def get_visits_table(meta: MetaData, *, name: str = 'visits') -> Table:
+    return Table(name, meta, *get_columns(), Column(VISIT_ID_COLUMN, Integer(), primary_key=True))
+
+
+def get_visits_indexes(table: Table) -> list[Index]:
+    return [
+        Index('index_norm_url', table.c.norm_url),
+        # for prefix matches, which are case insensitive (same as LIKE), see /visits in server
+        Index('index_norm_url_nocase', table.c.norm_url.collate('NOCASE')),
+        Index('index_dt_epoch', table.c.dt_epoch),
+        Index('index_locator_path', table.c.locator_path),
+        Index('index_visit_hash', table.c.src, table.c.visit_hash),
+    ]
+
+
+# ugh. this is how dt_epoch was (effectively) computed by the server before the column was introduced
+# - strips the legacy timezone name suffix (e.g. '2020-11-10T06:13:03.196376+00:00 Europe/London')
+# - naive datetimes are treated as UTC
+DT_EPOCH_SQL = "CAST(strftime('%s', substr(dt, 1, instr(dt || ' ', ' ') - 1)) AS INTEGER)"
+
+
+# materialized 'best' visit for each norm_url, maintained by the indexer
+# this lets /visited do a single index lookup per url instead of joining against the whole visits table
+URL_SUMMARY_TABLE = 'url_summary'
+
+
+def get_url_summary_table(meta: MetaData) -> Table:
+    table = Table(URL_SUMMARY_TABLE, meta, *get_columns())
+    Index('index_url_summary_norm_url', table.c.norm_url, unique=True)
+    return table
+
+
+# fingerprints of the source inputs as of the last time they were indexed
+# used to skip reindexing sources that haven't changed (see Source.fingerprint)
+SOURCES_METADATA_TABLE = 'sources_metadata'
+
+
+def get_sources_metadata_table(meta: MetaData) -> Table:
+    # fmt: off
+    return Table(
+        SOURCES_METADATA_TABLE, meta,
+        Column('src'        , String(), primary_key=True),
+        Column('fingerprint', String()),
+        Column('indexed_at' , String()),
+    )
+    # fmt: on
+
+
+@dataclass
+class SourceFingerprints:
+    # fingerprints stored in the database by the previous runs
+    previous: dict[SourceName, str]
+    # fingerprints of the sources that were fully extracted (without errors) during current run
+    current: dict[SourceName, str] = field(default_factory=dict)
+    # sources that weren't extracted since their fingerprints matched
+    skipped: list[SourceName] = field(default_factory=list)
+
+
+# full text index used by /search
+# trigram tokenizer means that MATCH works as case insensitive substring search (same as LIKE '%...%' we used before)
+# it's an 'external content' table, so it doesn't duplicate the data, kept in sync with visits via triggers
+# visits are referred to by VISIT_ID_COLUMN (which is an alias for rowid)
+FTS_TABLE = 'visits_fts'
+FTS_COLUMNS = ('norm_url', 'orig_url', 'context', 'locator_title')
+# trigram tokenizer can't match anything shorter than that
+FTS_MIN_QUERY_LENGTH = 3
+
+
+def fts_schema() -> list[str]:
+    cols = ', '.join(FTS_COLUMNS)
+    new_cols = ', '.join(f'new.{c}' for c in FTS_COLUMNS)
+    old_cols = ', '.join(f'old.{c}' for c in FTS_COLUMNS)
+    insert_new = f'INSERT INTO {FTS_TABLE}(rowid, {cols}) VALUES (new.rowid, {new_cols});'
+    delete_old = f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, {cols}) VALUES ('delete', old.rowid, {old_cols});"
+    # fmt: off
+    return [
+        f"CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5({cols}, content='visits', content_rowid='{VISIT_ID_COLUMN}', tokenize='trigram')",
+        f'CREATE TRIGGER {FTS_TABLE}_insert AFTER INSERT ON visits BEGIN {insert_new} END',
+        f'CREATE TRIGGER {FTS_TABLE}_delete AFTER DELETE ON visits BEGIN {delete_old} END',
+        f'CREATE TRIGGER {FTS_TABLE}_update AFTER UPDATE OF {cols} ON visits BEGIN {delete_old} {insert_new} END',
+    ]
+    # fmt: on
+
+
+def fts_drop() -> list[str]:
+    return [
+        f'DROP TRIGGER IF EXISTS {FTS_TABLE}_insert',
+        f'DROP TRIGGER IF EXISTS {FTS_TABLE}_delete',
+        f'DROP TRIGGER IF EXISTS {FTS_TABLE}_update',
+        f'DROP TABLE IF EXISTS {FTS_TABLE}',
+    ]
+
+
+def fts_query(s: str) -> str:
+    '''
+    Quotes the string so fts5 treats it as a single literal phrase rather than query syntax
+
+    >>> fts_query('say "hi" AND bye')
+    '"say ""hi"" AND bye"'
+    '''
+    return '"' + s.replace('"', '""') + '"'
+
+
 def db_visit_to_row(v: DbVisit) -> tuple:
     # ugh, very hacky...
     # we want to make sure the resulting tuple only consists of simple types
     # so we can use dbengine directly
-    dt_s = v.dt.isoformat()
+    dt = v.dt
+    dt_s = dt.isoformat()
+    if dt.tzinfo is None:
+        # consistent with DT_EPOCH_SQL
+        dt = dt.replace(tzinfo=UTC)
+    dt_epoch = int(dt.timestamp())
     row = (
         v.norm_url,
         v.orig_url,
@@ -45,12 +180,27 @@ def db_visit_to_row(v: DbVisit) -> tuple:
         v.src,
         v.context,
         v.duration,
+        dt_epoch,
+        v.locator.path,
     )
-    return row
+    return (*row, visit_hash(row))
+
+
+def visit_hash(row: tuple) -> int:
+    """
+    Hash of all the visit columns, fits in sqlite INTEGER
+    NOTE: not just (norm_url, dt, locator, context) -- otherwise a visit with e.g. updated orig_url or duration
+    would be considered the same, and the stale row would be kept when reindexing without --overwrite
+    It's not unique either (e.g. sources might emit exact duplicates), so it's not a primary key, see write_diff
+    """
+    digest = hashlib.blake2b(repr(row).encode('utf8'), digest_size=8).digest()
+    return int.from_bytes(digest, byteorder='big', signed=True)
 
 
 def row_to_db_visit(row: Sequence) -> DbVisit:
-    (norm_url, orig_url, dt_s, locator_title, locator_href, src, context, duration) = row
+    # NOTE: dt_epoch (if present) is ignored, it's derived from dt anyway
+    (norm_url, orig_url, dt_s, locator_title, locator_href, src, context, duration) = row[:8]
+    locator_path = row[9] if len(row) > 9 else None  # missing in databases created by older versions
     dt_s = dt_s.split()[0]  # backwards compatibility: previously it could be a string separated with tz name
     dt = datetime.fromisoformat(dt_s)
     return DbVisit(
@@ -60,8 +210,46 @@ def row_to_db_visit(row: Sequence) -> DbVisit:
         locator=Loc(
             title=locator_title,
             href=locator_href,
+            path=locator_path,
         ),
         src=src,
         context=context,
         duration=duration,
     )
+
+
+# sharded layout (see SHARDED_DB in config): each source is indexed into its own database, next to the main one
+# e.g. promnesia.sqlite -> promnesia-shards/<source name>.sqlite
+def get_shards_dir(db: Path) -> Path:
+    return db.parent / f'{db.stem}-shards'
+
+
+def get_shard_path(db: Path, name: SourceName) -> Path:
+    # source names are arbitrary strings, so need to make sure they are valid filenames
+    return get_shards_dir(db) / f'{quote(name, safe="") or "_"}.sqlite'
+
+
+def get_db_paths(db: Path) -> list[Path]:
+    """
+    All existing databases to query: the main database and/or the shards
+    """
+    res = [db] if db.exists() else []
+    shards_dir = get_shards_dir(db)
+    if shards_dir.is_dir():
+        res.extend(sorted(shards_dir.glob('*.sqlite')))
+    return res
+
+
+def has_both_layouts(db: Path) -> bool:
+    """
+    Whether both the main database and the shards exist, e.g. after SHARDED_DB was flipped without --overwrite.
+    Queries are run against all of them, so visits indexed in both layouts would be duplicated.
+    """
+    shards_dir = get_shards_dir(db)
+    return db.exists() and shards_dir.is_dir() and any(shards_dir.glob('*.sqlite'))
+
+
+def remove_db(db: Path) -> None:
+    # also need to remove WAL files, otherwise they might get picked up by the new database with the same name
+    for p in [db, db.with_name(db.name + '-wal'), db.with_name(db.name + '-shm')]:
+        p.unlink(missing_ok=True)
@@ -1,19 +1,29 @@
 from __future__ import annotations
 
+import os
 import sqlite3
-from collections.abc import Iterable
+from collections.abc import Collection, Iterable, Mapping
+from datetime import datetime
 from pathlib import Path
+from tempfile import TemporaryDirectory
 
 from more_itertools import chunked
 from sqlalchemy import (
+    Column,
     Engine,
+    Index,
+    Integer,
     MetaData,
     Table,
+    and_,
     create_engine,
     event,
     exc,
     func,
+    literal_column,
+    or_,
     select,
+    text,
 )
 from sqlalchemy.dialects import sqlite as dialect_sqlite
 
@@ -26,13 +36,27 @@ from ..common import (
     get_logger,
     now_tz,
 )
-from .common import db_visit_to_row, get_columns
+from .common import (
+    DT_EPOCH_COLUMN,
+    DT_EPOCH_SQL,
+    FTS_TABLE,
+    LOCATOR_PATH_COLUMN,
+    VISIT_HASH_COLUMN,
+    VISIT_ID_COLUMN,
+    SourceFingerprints,
+    db_visit_to_row,
+    fts_drop,
+    fts_schema,
+    get_columns,
+    get_sources_metadata_table,
+    get_url_summary_table,
+    get_visits_indexes,
+    get_visits_table,
+)
 
-# NOTE: I guess the main performance benefit from this is not creating too many tmp lists and avoiding overhead
-# since as far as sql is concerned it should all be in the same transaction. only a guess
-# not sure it's the proper way to handle it
-# see test_index_many
-_CHUNK_BY = 10
+# visits are inserted either in the table without indexes/triggers (when overwriting), or in the staging table
+# so larger batches pay off, see test_benchmark_visits_dumping
+_BULK_CHUNK_BY = 5_000
 
 # I guess 1 hour is definitely enough
 _CONNECTION_TIMEOUT_SECONDS = 3600
@@ -50,16 +74,320 @@ def begin_immediate_transaction(conn):
     conn.exec_driver_sql('BEGIN IMMEDIATE')
 
 
+# only used when overwriting the database, since we rebuild everything from scratch anyway
+# NOTE: synchronous=OFF trades durability on OS crash/power loss for speed, but the data is reproducible by reindexing
+def bulk_load_pragmas(dbapi_con, con_record) -> None:
+    dbapi_con.execute('PRAGMA synchronous = OFF')
+    dbapi_con.execute('PRAGMA cache_size = -262144')  # negative means KiB, so 256MiB
+    dbapi_con.execute('PRAGMA temp_store = MEMORY')
+
+
 Stats = dict[SourceName | None, int]
 
 
+def migrate_columns(conn, *, table: Table) -> None:
+    """
+    Databases created by older versions might not have some columns (dt_epoch/locator_path/visit_hash), so need to add and populate them
+    """
+    columns = {name for (_, name, *_) in conn.exec_driver_sql(f'PRAGMA table_info({table.name})')}
+    if DT_EPOCH_COLUMN not in columns:
+        get_logger().info(f'migrating database: adding {DT_EPOCH_COLUMN} column')
+        conn.exec_driver_sql(f'ALTER TABLE {table.name} ADD COLUMN {DT_EPOCH_COLUMN} INTEGER')
+        conn.exec_driver_sql(f'UPDATE {table.name} SET {DT_EPOCH_COLUMN} = {DT_EPOCH_SQL}')
+    if LOCATOR_PATH_COLUMN not in columns:
+        # can't be derived from other columns reliably, so it's populated when the source is reindexed next time
+        get_logger().info(f'migrating database: adding {LOCATOR_PATH_COLUMN} column')
+        conn.exec_driver_sql(f'ALTER TABLE {table.name} ADD COLUMN {LOCATOR_PATH_COLUMN} VARCHAR')
+    if VISIT_HASH_COLUMN not in columns:
+        # populated when the source is reindexed next time
+        get_logger().info(f'migrating database: adding {VISIT_HASH_COLUMN} column')
+        conn.exec_driver_sql(f'ALTER TABLE {table.name} ADD COLUMN {VISIT_HASH_COLUMN} INTEGER')
+    if VISIT_ID_COLUMN not in columns:
+        # primary key can't be added via ALTER TABLE, so need to copy everything into a new table (keeping the rowids)
+        # indexes and full text index are dropped along with the old table, they are recreated by the caller
+        get_logger().info(f'migrating database: adding {VISIT_ID_COLUMN} column')
+        for stmt in fts_drop():
+            conn.exec_driver_sql(stmt)
+        tmp = get_visits_table(MetaData(), name=f'{table.name}_migrating')
+        tmp.create(conn)
+        names = [c.name for c in get_columns()]
+        conn.execute(
+            tmp.insert().from_select(
+                [*names, VISIT_ID_COLUMN],
+                select(*(table.c[n] for n in names), literal_column('rowid')),
+            )
+        )
+        conn.exec_driver_sql(f'DROP TABLE {table.name}')
+        conn.exec_driver_sql(f'ALTER TABLE {tmp.name} RENAME TO {table.name}')
+
+
+def create_indexes(conn, *, table: Table) -> None:
+    for idx in get_visits_indexes(table):
+        idx.create(conn, checkfirst=True)
+
+
+def drop_indexes(conn, *, table: Table) -> None:
+    # dropping full text index too, otherwise its triggers would make deleting/inserting very slow
+    for stmt in fts_drop():
+        conn.exec_driver_sql(stmt)
+    for idx in get_visits_indexes(table):
+        idx.drop(conn, checkfirst=True)
+
+
+def ensure_fts(conn) -> None:
+    """
+    Creates full text index if it doesn't exist yet (populating it from the existing visits if necessary).
+    If sqlite doesn't support fts5/trigram tokenizer, the server will just fall back onto slower LIKE queries.
+    """
+    logger = get_logger()
+    [(exists,)] = conn.exec_driver_sql(
+        "SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = ?", (FTS_TABLE,)
+    )
+    if exists:
+        return
+    conn.exec_driver_sql('SAVEPOINT fts')
+    try:
+        for stmt in fts_schema():
+            conn.exec_driver_sql(stmt)
+    except exc.OperationalError as e:
+        conn.exec_driver_sql('ROLLBACK TO fts')
+        conn.exec_driver_sql('RELEASE fts')
+        logger.warning(f"couldn't create full text index, search will be slower (sqlite {sqlite3.sqlite_version}): {e}")
+        return
+    # no-op if visits is empty, otherwise indexes the existing visits (e.g. if database was created by older version)
+    conn.exec_driver_sql(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')")
+    conn.exec_driver_sql('RELEASE fts')
+
+
+def refresh_url_summary(conn, *, visits: Table, summary: Table, norm_urls: Collection[str] | None = None) -> None:
+    """
+    Rebuilds url_summary table, picking a single 'best' visit for each norm_url.
+
+    For now 'best' just means that visits with context are preferred over the ones without.
+
+    :param norm_urls: if passed, only updates the summary for these urls
+    """
+    # NOTE: visits have an extra id column, which doesn't make sense for the summary
+    columns = ', '.join(c.name for c in summary.columns)
+    summary_columns = [name for (_, name, *_) in conn.exec_driver_sql(f'PRAGMA table_info({summary.name})')]
+    if summary_columns != [c.name for c in summary.columns]:
+        # e.g. created by older version with different schema
+        norm_urls = None
+    elif norm_urls is not None and len(norm_urls) == 0:
+        return  # nothing changed
+
+    where = ''
+    if norm_urls is None:
+        # recreating rather than deleting, so it's always consistent with the current schema
+        summary.drop(conn, checkfirst=True)
+        summary.create(conn)
+    else:
+        conn.exec_driver_sql('CREATE TEMP TABLE IF NOT EXISTS summary_urls (norm_url VARCHAR PRIMARY KEY)')
+        conn.exec_driver_sql('DELETE FROM temp.summary_urls')
+        conn.exec_driver_sql(
+            'INSERT OR IGNORE INTO temp.summary_urls VALUES (?)',
+            [(u,) for u in norm_urls],
+        )
+        where = 'WHERE norm_url IN (SELECT norm_url FROM temp.summary_urls)'
+        conn.exec_driver_sql(f'DELETE FROM {summary.name} {where}')
+    # NOTE: this relies on sqlite 'bare columns' behaviour in aggregate queries
+    # i.e. for MAX(), values of other columns are taken from the row which has the max value
+    # see https://www.sqlite.org/lang_select.html#bareagg
+    conn.exec_driver_sql(f"""
+INSERT INTO {summary.name} ({columns})
+    SELECT {columns} FROM (
+        SELECT {columns}, MAX(context IS NOT NULL) FROM {visits.name} {where} GROUP BY norm_url
+    )
+""")
+
+
+def _path_condition(table: Table, path: str):
+    """
+    Matches visits extracted from the path itself, or from the files under it if it's a directory
+    """
+    column = table.c.locator_path
+    # range rather than LIKE so it can use the index
+    lo = path.rstrip(os.sep) + os.sep
+    hi = lo[:-1] + chr(ord(os.sep) + 1)
+    return or_(column == path, and_(column >= lo, column < hi))
+
+
+def _in_paths(path: str | None, paths: Collection[str]) -> bool:
+    if path is None:
+        return False
+    return any(path == p or path.startswith(p.rstrip(os.sep) + os.sep) for p in paths)
+
+
+def update_sources_metadata(
+    conn,
+    *,
+    table: Table,
+    overwrite_db: bool,
+    cleared: set[str],
+    fingerprints: SourceFingerprints | None,
+    now: datetime,
+) -> None:
+    table.create(conn, checkfirst=True)
+    # sources that were reindexed don't correspond to their old fingerprints anymore
+    # (even if we didn't compute the new ones during this run)
+    if overwrite_db:
+        conn.execute(table.delete())
+    else:
+        for src in cleared:
+            conn.execute(table.delete().where(table.c.src == src))
+    if fingerprints is None:
+        return
+    for src, fingerprint in fingerprints.current.items():
+        conn.execute(
+            dialect_sqlite.insert(table)
+            .values(src=src, fingerprint=fingerprint, indexed_at=now.isoformat())
+            .on_conflict_do_update(
+                index_elements=[table.c.src], set_={'fingerprint': fingerprint, 'indexed_at': now.isoformat()}
+            )
+        )
+
+
+# schema name the staging database is attached as
+STAGING_SCHEMA = 'staging'
+# temporary directory with the staging database, next to the main one
+STAGING_PREFIX = '.promnesia-staging'
+
+
+def get_staging_table(schema: str | None = None) -> Table:
+    return Table('staged_visits', MetaData(), *get_columns(), schema=schema)
+
+
+def stage_visits(visits: Iterable[DbVisit], *, staging_db: Path, index: bool) -> None:
+    """
+    Writes visits into a separate (temporary) database.
+    Extraction is lazy, so this might take very long, this way it doesn't hold the lock on the main database.
+
+    :param index: whether to index visits by hash (only needed for write_diff)
+    """
+    engine = create_engine(f'sqlite:///{staging_db}')
+    event.listen(engine, 'connect', bulk_load_pragmas)
+    staging = get_staging_table()
+    # using raw statement gives a massive speedup for inserting visits
+    # see test_benchmark_visits_dumping
+    insert_stmt_raw = str(staging.insert().compile(dialect=dialect_sqlite.dialect(paramstyle='qmark')))
+    with engine.begin() as conn:
+        staging.create(conn)
+        for chunk in chunked(visits, n=_BULK_CHUNK_BY):
+            bound = [db_visit_to_row(v) for v in chunk]
+            conn.exec_driver_sql(insert_stmt_raw, bound)
+        if index:
+            Index('staging_visit_hash', staging.c.src, staging.c.visit_hash).create(conn)
+    engine.dispose()
+
+
+def write_diff(
+    conn,
+    *,
+    table: Table,
+    staging: Table,
+    scopes: Mapping[str | None, Collection[str] | None],
+) -> tuple[set[str], Stats, Stats]:
+    """
+    Makes visits of each source (or only visits from the specific paths, if passed) same as in the staging table.
+    Visits are matched by visit_hash, so only rows that changed are written:
+    - visits that aren't in staging anymore are deleted
+    - visits from staging that aren't in the table yet are inserted
+
+    Exact duplicate visits are matched by their occurrence (i.e. n-th visit with the same hash in the table is same as
+    n-th one in staging), so the result is the same as with overwrite, even if the number of duplicates changed.
+
+    Returns norm_urls of the deleted/inserted visits, and inserted/deleted counts for each source.
+    """
+    rowid = literal_column('rowid', Integer())
+    # matching rowids are materialized in the staging database, otherwise window queries would run multiple times
+    schema = staging.schema
+    vanished = Table('vanished_rowids', MetaData(), Column('rid', Integer()), schema=schema)
+    new = Table('new_rowids', MetaData(), Column('rid', Integer()), schema=schema)
+    vanished.create(conn, checkfirst=True)
+    new.create(conn, checkfirst=True)
+
+    touched: set[str] = set()
+    deleted: Stats = {}
+    for src, src_paths in scopes.items():
+        in_scope = table.c.src == src
+        if src_paths is not None:
+            in_scope = and_(in_scope, or_(*(_path_condition(table, p) for p in src_paths)))
+
+        ranked = (
+            select(
+                rowid.label('rid'),
+                table.c.visit_hash,
+                func.row_number().over(partition_by=table.c.visit_hash, order_by=rowid).label('n'),
+            )
+            .where(in_scope)
+            .subquery()
+        )
+        staged = (
+            select(staging.c.visit_hash, func.count().label('count'))
+            .where(staging.c.src == src)
+            .group_by(staging.c.visit_hash)
+            .subquery()
+        )
+        conn.execute(vanished.delete())
+        conn.execute(
+            vanished.insert().from_select(
+                ['rid'],
+                select(ranked.c.rid)
+                .outerjoin(staged, ranked.c.visit_hash == staged.c.visit_hash)
+                # NOTE: hash is null in rows written by older versions, so they are just rewritten
+                .where(or_(ranked.c.visit_hash.is_(None), staged.c.count.is_(None), ranked.c.n > staged.c.count)),
+            )
+        )
+        is_vanished = rowid.in_(select(vanished.c.rid))
+        touched.update(u for (u,) in conn.execute(select(table.c.norm_url).where(is_vanished).distinct()))
+        deleted[src] = conn.execute(table.delete().where(is_vanished)).rowcount
+
+    ranked_staged = select(
+        rowid.label('rid'),
+        staging.c.src,
+        staging.c.visit_hash,
+        func.row_number().over(partition_by=(staging.c.src, staging.c.visit_hash), order_by=rowid).label('n'),
+    ).subquery()
+    existing = (
+        select(func.count())
+        .select_from(table)
+        .where(table.c.src == ranked_staged.c.src, table.c.visit_hash == ranked_staged.c.visit_hash)
+        .scalar_subquery()
+    )
+    conn.execute(new.delete())
+    conn.execute(new.insert().from_select(['rid'], select(ranked_staged.c.rid).where(ranked_staged.c.n > existing)))
+    is_new = rowid.in_(select(new.c.rid))
+
+    touched.update(u for (u,) in conn.execute(select(staging.c.norm_url).where(is_new).distinct()))
+    inserted: Stats = dict(
+        conn.execute(select(staging.c.src, func.count()).where(is_new).group_by(staging.c.src)).all()
+    )
+    # inserting all at once (rather than per source) to keep the original order of visits
+    columns = [c.name for c in staging.columns]
+    conn.execute(
+        table.insert().from_select(columns, select(*staging.columns).where(is_new).order_by(rowid)),
+    )
+    return touched, inserted, deleted
+
+
 # returns critical warnings
 def visits_to_sqlite(
     vit: Iterable[Res[DbVisit]],
     *,
     overwrite_db: bool,
-    _db_path: Path | None = None,  # only used in tests
+    fingerprints: SourceFingerprints | None = None,
+    paths: Mapping[SourceName, Collection[str]] | None = None,
+    allow_empty: bool = False,
+    _db_path: Path | None = None,
 ) -> list[Exception]:
+    """
+    :param paths:
+        if passed, only visits extracted from these files (or files under these directories) are replaced
+        for the corresponding sources (see Loc.path), rather than all visits of these sources.
+        Visits from other sources/files (e.g. errors) aren't written in this case.
+    :param allow_empty: if True, it's not an error if no visits were indexed (e.g. if the caller checks it itself)
+    :param _db_path: database to write into instead of the one from config (e.g. a shard)
+    """
     if _db_path is None:
         db_path = config.get().db
     else:
@@ -91,7 +419,9 @@ def visits_to_sqlite(
             yield ev
 
     meta = MetaData()
-    table = Table('visits', meta, *get_columns())
+    table = get_visits_table(meta)
+    summary_table = get_url_summary_table(meta)
+    metadata_table = get_sources_metadata_table(meta)
 
     def query_total_stats(conn) -> Stats:
         query = select(table.c.src, func.count(table.c.src)).select_from(table).group_by(table.c.src)
@@ -118,44 +448,87 @@ def visits_to_sqlite(
     pengine.dispose()
     ###
 
-    # needtimeout, othewise concurrent indexing might not work
-    # (note that this also requires WAL mode)
-    engine = get_engine(f'sqlite:///{db_path}', connect_args={'timeout': _CONNECTION_TIMEOUT_SECONDS})
-
-    cleared: set[str] = set()
-
-    # by default, sqlalchemy does some sort of BEGIN (implicit) transaction, which doesn't provide proper isolation??
-    # see https://docs.sqlalchemy.org/en/20/dialects/sqlite.html#serializable-isolation-savepoints-transactional-ddl
-    event.listen(engine, 'begin', begin_immediate_transaction)
-    # TODO to allow more concurrent indexing, maybe could instead write to a temporary table?
-    # or collect visits first and only then start writing to the db to minimize db access window.. not sure
-
-    # engine.begin() starts a transaction
-    # so everything inside this block will be atomic to the outside observers
-    with engine.begin() as conn:
-        table.create(conn, checkfirst=True)
-
+    def visits_to_write() -> Iterable[DbVisit]:
+        if paths is None:
+            return vit_ok()
+        return (v for v in vit_ok() if _in_paths(v.locator.path, paths.get(v.src or '', ())))
+
+    # NOTE: staging database is next to the database rather than in the system temp directory
+    # since it might take as much space as the database itself, and /tmp is often small or in RAM
+    # promnesia index --watch ignores it by STAGING_PREFIX, in case OUTPUT_DIR is inside a watched directory
+    with TemporaryDirectory(prefix=STAGING_PREFIX, dir=db_path.parent) as tdir:
+        # collect visits in a separate database first, so the main database is only locked for the final merge
+        # otherwise concurrent indexing would be blocked for the whole extraction (which might take very long)
+        staging_db = Path(tdir) / 'staging.sqlite'
+        stage_visits(visits_to_write(), staging_db=staging_db, index=not overwrite_db)
+
+        # needtimeout, othewise concurrent indexing might not work
+        # (note that this also requires WAL mode)
+        engine = get_engine(f'sqlite:///{db_path}', connect_args={'timeout': _CONNECTION_TIMEOUT_SECONDS})
         if overwrite_db:
-            conn.execute(table.delete())
-
-        insert_stmt = table.insert()
-        # using raw statement gives a massive speedup for inserting visits
-        # see test_benchmark_visits_dumping
-        insert_stmt_raw = str(insert_stmt.compile(dialect=dialect_sqlite.dialect(paramstyle='qmark')))
-
-        for chunk in chunked(vit_ok(), n=_CHUNK_BY):
-            srcs = {v.src or '' for v in chunk}
-            new = srcs.difference(cleared)
-
-            for src in new:
-                conn.execute(table.delete().where(table.c.src == src))
-                cleared.add(src)
-
-            bound = [db_visit_to_row(v) for v in chunk]
-            conn.exec_driver_sql(insert_stmt_raw, bound)
-
-        stats_after = query_total_stats(conn)
-    engine.dispose()
+            event.listen(engine, 'connect', bulk_load_pragmas)
+
+        # can't attach within a transaction, so has to happen on connect
+        def attach_staging(dbapi_con, con_record) -> None:
+            dbapi_con.execute(f'ATTACH DATABASE ? AS {STAGING_SCHEMA}', (str(staging_db),))
+
+        event.listen(engine, 'connect', attach_staging)
+
+        # by default, sqlalchemy does some sort of BEGIN (implicit) transaction, which doesn't provide proper isolation??
+        # see https://docs.sqlalchemy.org/en/20/dialects/sqlite.html#serializable-isolation-savepoints-transactional-ddl
+        event.listen(engine, 'begin', begin_immediate_transaction)
+
+        staging = get_staging_table(schema=STAGING_SCHEMA)
+        cleared: set[str] = set()
+        # norm_urls of the visits that were deleted/inserted, to update url_summary for them
+        touched: set[str] | None = None
+        inserted: Stats = {}
+        deleted: Stats = {}
+
+        # engine.begin() starts a transaction
+        # so everything inside this block will be atomic to the outside observers
+        with engine.begin() as conn:
+            table.create(conn, checkfirst=True)
+
+            if overwrite_db:
+                # bulk load mode: nothing to preserve, so drop indexes and rebuild them after inserting everything
+                drop_indexes(conn, table=table)
+                conn.execute(table.delete())
+
+            migrate_columns(conn, table=table)
+
+            if overwrite_db:
+                columns = [c.name for c in staging.columns]
+                conn.execute(table.insert().from_select(columns, select(*staging.columns).order_by(text('rowid'))))
+                create_indexes(conn, table=table)
+                ensure_fts(conn)  # populates it from scratch
+                conn.exec_driver_sql('ANALYZE')
+            else:
+                create_indexes(conn, table=table)
+                ensure_fts(conn)
+                # only write the difference, this way unchanged visits (typically most of them) aren't deleted and inserted again
+                scopes: dict[str | None, Collection[str] | None]
+                if paths is not None:
+                    scopes = {src: src_paths for src, src_paths in paths.items()}  # noqa: C416  # widens the key type for mypy
+                else:
+                    scopes = {src: None for (src,) in conn.execute(select(staging.c.src).distinct())}
+                touched, inserted, deleted = write_diff(conn, table=table, staging=staging, scopes=scopes)
+                cleared.update(src or '' for src in scopes)
+
+            if overwrite_db or len(cleared) > 0:  # otherwise nothing changed
+                refresh_url_summary(conn, visits=table, summary=summary_table, norm_urls=touched)
+
+            update_sources_metadata(
+                conn,
+                table=metadata_table,
+                overwrite_db=overwrite_db,
+                cleared=cleared,
+                fingerprints=fingerprints,
+                now=now,
+            )
+
+            stats_after = query_total_stats(conn)
+        engine.dispose()
 
     stats_changes = {}
     # map str just in case some srcs are None
@@ -171,6 +544,8 @@ def visits_to_sqlite(
     total_err = index_stats.get(SRC_ERROR, 0)
     total_ok = total_indexed - total_err
     logger.info(f'indexed (current run) : total: {total_indexed}, ok: {total_ok}, errors: {total_err} {index_stats}')
+    if fingerprints is not None and len(fingerprints.skipped) > 0:
+        logger.info(f'skipped (unchanged)   : {fingerprints.skipped}')
     logger.info(f'database "{db_path}" : {action}')
     logger.info(f'database stats before : {stats_before}')
     logger.info(f'database stats after  : {stats_after}')
@@ -180,8 +555,16 @@ def visits_to_sqlite(
     else:
         for k, v in stats_changes.items():
             logger.info(f'database stats changes: {k} {v}')
+    if not overwrite_db:
+        # unchanged visits are left as is, so these are the actual writes
+        for src in sorted({*inserted.keys(), *deleted.keys()}, key=str):
+            logger.info(
+                f'database rows written  : {src} inserted: {inserted.get(src, 0)}, deleted: {deleted.get(src, 0)}'
+            )
 
     res: list[Exception] = []
-    if total_ok == 0:
+    skipped = [] if fingerprints is None else fingerprints.skipped
+    # with paths, files might have been just deleted
+    if total_ok == 0 and len(skipped) == 0 and paths is None and not allow_empty:
         res.append(RuntimeError('No visits were indexed, something is probably wrong!'))
     return res
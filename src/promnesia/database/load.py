@@ -1,42 +1,107 @@
 from __future__ import annotations
 
+import sqlite3
 from pathlib import Path
 
 from sqlalchemy import (
+    Column,
     Engine,
-    Index,
     MetaData,
+    QueuePool,
     Table,
     create_engine,
-    exc,
+    event,
+    inspect,
+    select,
 )
 
-from .common import DbVisit, get_columns, row_to_db_visit
+from .common import (
+    FTS_TABLE,
+    SOURCES_METADATA_TABLE,
+    URL_SUMMARY_TABLE,
+    DbVisit,
+    get_columns,
+    get_sources_metadata_table,
+    get_url_summary_table,
+    row_to_db_visit,
+)
 
 DbStuff = tuple[Engine, Table]
 
 
+# enough for all threads of the server's database executor (paginated queries hold a connection per shard though)
+_POOL_SIZE = 8
+_POOL_MAX_OVERFLOW = 32
+# reads are served straight from the page cache, rather than copied into sqlite's own cache
+_MMAP_SIZE = 256 * 1024 * 1024
+
+
+def readonly_pragmas(dbapi_con, con_record) -> None:
+    dbapi_con.execute('PRAGMA query_only = ON')
+    dbapi_con.execute(f'PRAGMA mmap_size = {_MMAP_SIZE}')
+
+
 def get_db_stuff(db_path: Path) -> DbStuff:
+    """
+    Opens the database read only, with a pool of connections so they can be reused across requests/threads.
+    NOTE: indexes (e.g. index_norm_url) are created by the indexer, so if they are missing queries still work, just slower
+    """
     assert db_path.exists(), db_path
-    # todo how to open read only?
-    # actually not sure if we can since we are creating an index here
-    engine = create_engine(f'sqlite:///{db_path}')  # , echo=True)
+    engine = create_engine(
+        'sqlite://',
+        # check_same_thread=False: connections are used by one thread at a time, but not necessarily the same one
+        creator=lambda: sqlite3.connect(f'file:{db_path}?mode=ro', uri=True, check_same_thread=False),
+        poolclass=QueuePool,
+        pool_size=_POOL_SIZE,
+        max_overflow=_POOL_MAX_OVERFLOW,
+    )
+    event.listen(engine, 'connect', readonly_pragmas)
 
     meta = MetaData()
-    table = Table('visits', meta, *get_columns())
+    table = Table('visits', meta, *get_visits_columns(engine))
+    return engine, table
+
 
-    idx = Index('index_norm_url', table.c.norm_url)
+def get_visits_columns(engine: Engine) -> list[Column]:
+    """
+    Databases created by older versions might not have some of the columns (e.g. dt_epoch) until reindexed
+    """
+    columns = list(get_columns())
+    insp = inspect(engine)
+    if not insp.has_table('visits'):
+        return columns
+    existing = {c['name'] for c in insp.get_columns('visits')}
+    return [c for c in columns if c.name in existing]
+
+
+def get_url_summary(engine: Engine) -> Table | None:
+    """
+    Returns None for databases created before url_summary table was introduced.
+    """
+    if not inspect(engine).has_table(URL_SUMMARY_TABLE):
+        return None
+    return get_url_summary_table(MetaData())
+
+
+def has_fts(engine: Engine) -> bool:
+    """
+    False for databases created before full text index was introduced (or if sqlite doesn't support fts5)
+    """
+    return inspect(engine).has_table(FTS_TABLE)
+
+
+def get_source_fingerprints(db_path: Path) -> dict[str, str]:
+    if not db_path.exists():
+        return {}
+    engine = create_engine('sqlite://', creator=lambda: sqlite3.connect(f'file:{db_path}?mode=ro', uri=True))
     try:
-        idx.create(bind=engine)
-    except exc.OperationalError as e:
-        if 'already exists' in str(e):
-            # meh, but no idea how to check it properly...
-            pass
-        else:
-            raise e
-
-    # NOTE: apparently it's ok to open connection on every request? at least my comparisons didn't show anything
-    return engine, table
+        if not inspect(engine).has_table(SOURCES_METADATA_TABLE):
+            return {}
+        table = get_sources_metadata_table(MetaData())
+        with engine.connect() as conn:
+            return dict(conn.execute(select(table.c.src, table.c.fingerprint)).all())
+    finally:
+        engine.dispose()
 
 
 def get_all_db_visits(db_path: Path) -> list[DbVisit]:
@@ -0,0 +1,207 @@
+"""
+Bounded pool of threads for running database queries from async server endpoints.
+
+Jobs are picked up by priority, and jobs below HIGH priority (i.e. potentially slow scans) can't occupy all the workers,
+so cheap requests (e.g. /visited from every open tab) never queue behind them.
+Cancelled jobs are either dropped before they start, or interrupted via sqlite3.Connection.interrupt if they are running.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import sqlite3
+import threading
+from collections import deque
+from collections.abc import AsyncIterator, Callable, Iterator
+from contextlib import contextmanager
+from enum import IntEnum
+from typing import Any, TypeVar
+
+from .common import logger
+
+T = TypeVar('T')
+
+
+class Priority(IntEnum):
+    HIGH = 0  # cheap lookups, e.g. /status, /visited
+    NORMAL = 1  # index lookups which might return many visits, e.g. /visits
+    LOW = 2  # scans, e.g. /search, /search_around
+
+
+_PENDING = 'pending'
+_RUNNING = 'running'
+_DONE = 'done'
+_CANCELLED = 'cancelled'
+
+
+class _Job:
+    def __init__(self, fn: Callable[[], Any], *, priority: Priority) -> None:
+        self.fn = fn
+        self.priority = priority
+        self.state = _PENDING  # guarded by executor's lock
+        self.future: asyncio.Future[Any] | None = None
+        self.loop: asyncio.AbstractEventLoop | None = None
+        # connections currently executing queries for this job, guarded by the lock
+        self.lock = threading.Lock()
+        self.connections: list[sqlite3.Connection] = []
+        self.interrupted = False
+
+    def interrupt(self) -> None:
+        with self.lock:
+            self.interrupted = True
+            for conn in self.connections:
+                conn.interrupt()
+
+
+_current = threading.local()
+
+
+@contextmanager
+def interruptible(conn: sqlite3.Connection) -> Iterator[None]:
+    """
+    Makes the query executed within the block interrupted if the current job is cancelled
+    NOTE: connection has to be unregistered before it's returned to the pool, otherwise might interrupt someone else's query
+    """
+    job: _Job | None = getattr(_current, 'job', None)
+    if job is None:  # not running in the executor, e.g. in tests
+        yield
+        return
+    with job.lock:
+        if job.interrupted:
+            # might be cancelled in between queries, sqlite3 interrupt would be a no-op then
+            raise sqlite3.OperationalError('interrupted')
+        job.connections.append(conn)
+    try:
+        yield
+    finally:
+        with job.lock:
+            job.connections.remove(conn)
+
+
+class DbExecutor:
+    """
+    :param workers: total number of threads
+    :param reserved: number of threads only used for HIGH priority jobs
+    """
+
+    def __init__(self, *, workers: int, reserved: int) -> None:
+        assert 0 <= reserved < workers, (workers, reserved)
+        self.workers = workers
+        self.reserved = reserved
+        self.cond = threading.Condition()
+        self.queues: dict[Priority, deque[_Job]] = {p: deque() for p in Priority}
+        self.busy_low = 0  # workers running jobs below HIGH priority
+        self.threads: list[threading.Thread] = []
+
+    def _start(self) -> None:
+        # started lazily, e.g. so it works after fork in server workers
+        with self.cond:
+            if len(self.threads) > 0:
+                return
+            for i in range(self.workers):
+                t = threading.Thread(target=self._worker, name=f'promnesia-db-{i}', daemon=True)
+                t.start()
+                self.threads.append(t)
+
+    def _pick(self) -> _Job | None:
+        for priority, queue in self.queues.items():
+            while len(queue) > 0 and queue[0].state == _CANCELLED:
+                queue.popleft()
+            if len(queue) == 0:
+                continue
+            if priority != Priority.HIGH and self.busy_low >= self.workers - self.reserved:
+                return None  # lower priority jobs would have to wait too
+            return queue.popleft()
+        return None
+
+    def _worker(self) -> None:
+        while True:
+            with self.cond:
+                while (job := self._pick()) is None:
+                    self.cond.wait()
+                job.state = _RUNNING
+                if job.priority != Priority.HIGH:
+                    self.busy_low += 1
+
+            _current.job = job
+            try:
+                res = job.fn()
+            except BaseException as e:
+                self._resolve(job, exc=e)
+            else:
+                self._resolve(job, res=res)
+            finally:
+                _current.job = None
+
+            with self.cond:
+                job.state = _DONE
+                if job.priority != Priority.HIGH:
+                    self.busy_low -= 1
+                self.cond.notify_all()
+
+    def _resolve(self, job: _Job, *, res: Any = None, exc: BaseException | None = None) -> None:
+        fut = job.future
+        loop = job.loop
+        assert fut is not None
+        assert loop is not None
+
+        def resolve() -> None:
+            if fut.cancelled():
+                if exc is not None and not (isinstance(exc, sqlite3.OperationalError) and str(exc) == 'interrupted'):
+                    logger.debug('error in cancelled job: %r', exc)
+                return
+            if exc is None:
+                fut.set_result(res)
+            else:
+                fut.set_exception(exc)
+
+        try:
+            loop.call_soon_threadsafe(resolve)
+        except RuntimeError:
+            pass  # event loop is closed already, nobody is waiting for the result
+
+    def _cancel(self, job: _Job) -> None:
+        with self.cond:
+            if job.state == _PENDING:
+                job.state = _CANCELLED
+                return
+        # if it's running, it'll finish with 'interrupted' error
+        job.interrupt()
+
+    async def run(self, fn: Callable[[], T], *, priority: Priority) -> T:
+        """
+        Runs fn in a worker thread. If the awaiting task is cancelled, the job is cancelled/interrupted as well.
+        """
+        self._start()
+        loop = asyncio.get_running_loop()
+        job = _Job(fn, priority=priority)
+        job.loop = loop
+        job.future = loop.create_future()
+        with self.cond:
+            self.queues[priority].append(job)
+            self.cond.notify_all()
+        try:
+            return await job.future
+        except asyncio.CancelledError:
+            self._cancel(job)
+            raise
+
+    async def iterate(self, it: Iterator[T], *, priority: Priority) -> AsyncIterator[T]:
+        """
+        Runs each step of the (blocking) iterator as a separate job, so other requests can be served in between
+        """
+        done = object()
+        try:
+            while True:
+                x = await self.run(lambda: next(it, done), priority=priority)
+                if x is done:
+                    return
+                yield x  # type: ignore[misc]
+        finally:
+            close = getattr(it, 'close', None)
+            if close is not None:
+                try:
+                    close()
+                except ValueError:
+                    # still executing in the worker (i.e. was just interrupted), will be finalized by the error anyway
+                    pass
@@ -1,10 +1,17 @@
 from __future__ import annotations
 
+import multiprocessing
+import pickle
 import re
-from collections.abc import Iterable, Sequence
+from collections.abc import Iterable, Iterator, Sequence
+from concurrent.futures import Future, ProcessPoolExecutor
 from functools import lru_cache
+from pathlib import Path
+from typing import TYPE_CHECKING, Any
 
-from .cannon import CanonifyException
+from more_itertools import chunked
+
+from .cannon import CanonifyException, canonify_many
 from .common import (
     DbVisit,
     Filter,
@@ -17,6 +24,9 @@ from .common import (
     logger,
 )
 
+if TYPE_CHECKING:
+    from .config import HookT
+
 DEFAULT_FILTERS = (
     r'^chrome-\w+://',
     r'chrome://newtab',
@@ -55,6 +65,14 @@ def extract_visits(source: Source, *, src: SourceName) -> Iterable[Res[DbVisit]]
         return
 
     handled: set[Visit] = set()
+    # visits are canonified in batches, see as_db_visits
+    batch: list[Visit] = []
+
+    def flush() -> Iterable[Res[DbVisit]]:
+        nonlocal batch
+        visits, batch = batch, []
+        return as_db_visits(visits, src=src)
+
     try:
         for p in vit:
             if isinstance(p, Exception):
@@ -63,6 +81,7 @@ def extract_visits(source: Source, *, src: SourceName) -> Iterable[Res[DbVisit]]
                 # eh, exception type is ignored by format_exception completely, apparently??
                 # parts.extend(traceback.format_exception(Exception, p, p.__traceback__))
                 # logger.error(''.join(parts))
+                yield from flush()  # keep the original order
                 yield p
                 continue
 
@@ -70,15 +89,155 @@ def extract_visits(source: Source, *, src: SourceName) -> Iterable[Res[DbVisit]]
                 continue
             handled.add(p)
 
-            yield from as_db_visit(p, src=src)
+            batch.append(p)
+            if len(batch) >= _CANONIFY_BATCH:
+                yield from flush()
+        yield from flush()
     except Exception as e:
         # todo critical error?
         logger.exception(e)
+        yield from flush()
         yield e
 
     logger.info('extracting via %s: got %d visits', source.description, len(handled))
 
 
+def extract_visits_with_hook(source: Source, *, hook: HookT | None) -> Iterator[Res[DbVisit]]:
+    for v in extract_visits(source, src=source.name):
+        if hook is None:
+            yield v
+        else:
+            try:
+                yield from hook(v)
+            except Exception as e:
+                yield e
+
+
+# number of visits sent from worker process at once, to amortize the IPC overhead
+_PARALLEL_CHUNK_BY = 1_000
+# how many chunks can be in flight, so memory stays bounded if the database writer is slower than extractors
+_PARALLEL_QUEUE_SIZE = 100
+
+_worker_queue: Any = None
+_worker_cancelled: Any = None
+
+
+def _init_worker(queue, cancelled, config_path: Path) -> None:
+    global _worker_queue, _worker_cancelled
+    from . import config
+
+    _worker_queue = queue
+    _worker_cancelled = cancelled
+    # NOTE: sources might be defined in the config itself, so they can't be pickled -- need to load config again
+    config.load_from(config_path)
+
+
+def _picklable(e: BaseException) -> Exception:
+    try:
+        if not isinstance(e, Exception):
+            raise TypeError(e)  # noqa: TRY301
+        pickle.dumps(e)
+    except Exception:
+        return RuntimeError(f'{type(e).__name__}: {e}')
+    else:
+        return e
+
+
+def _extract_in_worker(idx: int) -> None:
+    from . import config
+
+    queue, cancelled = _worker_queue, _worker_cancelled
+    try:
+        source = list(config.get().sources)[idx]
+        assert isinstance(source, Source), source  # should be checked by the caller
+        for chunk in chunked(extract_visits_with_hook(source, hook=config.get().hook), n=_PARALLEL_CHUNK_BY):
+            if cancelled.is_set():
+                return
+            queue.put((idx, [v if isinstance(v, DbVisit) else _picklable(v) for v in chunk]))
+    except Exception as e:
+        logger.exception(e)
+        queue.put((idx, [_picklable(e)]))
+    finally:
+        queue.put((idx, None))  # done marker
+
+
+def extract_visits_parallel(
+    sources: Sequence[tuple[int, Source]],
+    *,
+    config_path: Path,
+    workers: int,
+) -> Iterator[tuple[Source, Res[DbVisit]]]:
+    """
+    Runs extraction (+ canonifying and config hook) for each source in a separate process.
+    Visits are streamed back as soon as they are extracted, so sources are interleaved in the output.
+
+    :param sources: pairs of (index in config.sources, source)
+    """
+    if len(sources) == 0:
+        return
+
+    by_idx = dict(sources)
+    ctx = multiprocessing.get_context()
+    queue = ctx.Queue(maxsize=_PARALLEL_QUEUE_SIZE)
+    cancelled = ctx.Event()
+    # NOTE: using ProcessPoolExecutor rather than multiprocessing.Pool since its workers aren't daemonic
+    # so sources can use their own process pools (e.g. auto with PROMNESIA_CORES)
+    with ProcessPoolExecutor(
+        max_workers=workers or None,
+        mp_context=ctx,
+        initializer=_init_worker,
+        initargs=(queue, cancelled, config_path),
+    ) as pool:
+        pending: set[int] = set()
+        for idx in by_idx:
+            fut = pool.submit(_extract_in_worker, idx)
+            pending.add(idx)
+
+            def on_done(f: Future, idx: int = idx) -> None:
+                e = f.exception()
+                if e is not None:
+                    # worker process crashed (e.g. killed by OOM), so it couldn't send the done marker itself
+                    queue.put((idx, [_picklable(e)]))
+                    queue.put((idx, None))
+
+            fut.add_done_callback(on_done)
+
+        try:
+            while len(pending) > 0:
+                idx, chunk = queue.get()
+                source = by_idx[idx]
+                if chunk is None:
+                    pending.discard(idx)
+                    continue
+                for v in chunk:
+                    yield source, v
+        finally:
+            if len(pending) > 0:
+                # e.g. if consumer crashed -- make sure workers aren't stuck on the full queue
+                cancelled.set()
+                while len(pending) > 0:
+                    idx, chunk = queue.get()
+                    if chunk is None:
+                        pending.discard(idx)
+
+
+# amortizes domain lookups and duplicate urls, while keeping extraction streaming
+_CANONIFY_BATCH = 1_000
+
+
+def as_db_visits(vs: Sequence[Visit], *, src: SourceName) -> Iterable[Res[DbVisit]]:
+    vs = [v for v in vs if not filtered(v.url)]
+    try:
+        nurls = canonify_many(v.url for v in vs)
+    except Exception:
+        # some url in the batch is broken, so fall back onto one by one to report errors for specific visits
+        for v in vs:
+            yield from as_db_visit(v, src=src)
+        return
+    for v, nurl in zip(vs, nurls, strict=True):
+        yield DbVisit.make(v, src=src, norm_url=nurl)
+
+
 def as_db_visit(v: Visit, *, src: SourceName) -> Iterable[Res[DbVisit]]:
     if filtered(v.url):
         return
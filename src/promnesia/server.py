@@ -1,13 +1,22 @@
 from __future__ import annotations
 
 import argparse
+import asyncio
+import base64
+import heapq
 import importlib.metadata
 import json
 import logging
+import math
 import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from collections.abc import Callable, Generator, Hashable, Iterator, Sequence
 from dataclasses import dataclass
-from datetime import timedelta
+from datetime import datetime, timedelta
 from functools import lru_cache
+from itertools import repeat
 from pathlib import Path
 from typing import Any, NamedTuple, Protocol
 from zoneinfo import ZoneInfo
@@ -15,28 +24,33 @@ from zoneinfo import ZoneInfo
 import fastapi
 from sqlalchemy import (
     Column,
+    Select,
     Table,
     and_,
-    between,
-    exc,
+    bindparam,
+    column,
     func,
-    literal,
+    literal_column,
     or_,
     select,
+    tuple_,
     types,
 )
+from sqlalchemy import table as sql_table
+from sqlalchemy.dialects import sqlite as dialect_sqlite
 from sqlalchemy.sql import text
-from sqlalchemy.sql.elements import ColumnElement
+from sqlalchemy.sql.elements import BindParameter, ClauseElement, ColumnElement
 
-from .cannon import canonify
+from .cannon import canonify, canonify_many
 from .common import (
-    DbVisit,
     PathWithMtime,
     default_output_dir,
     get_system_tz,
     setup_logger,
 )
-from .database.load import DbStuff, get_db_stuff, row_to_db_visit
+from .database.common import DT_EPOCH_COLUMN, FTS_MIN_QUERY_LENGTH, FTS_TABLE, fts_query, get_db_paths, has_both_layouts
+from .database.load import DbStuff, get_db_stuff, get_url_summary, has_fts
+from .db_executor import DbExecutor, Priority, interruptible
 
 Json = dict[str, Any]
 
@@ -102,24 +116,44 @@ class EnvConfig:
 # todo how to return exception in error?
 
 
-def as_json(v: DbVisit) -> Json:
+# visits often share timestamps (e.g. all visits extracted from the same file), so worth caching
+@lru_cache(1 << 16)
+def format_dt(dt_s: str, timezone: ZoneInfo | None) -> str:
+    """
+    :param dt_s: dt as it's stored in the database
+    :param timezone: used for naive timestamps, if None they are formatted without the timezone
+    """
+    dt_s = dt_s.split(maxsplit=1)[0]  # backwards compatibility, see row_to_db_visit
+    dt = datetime.fromisoformat(dt_s)
+    if dt.tzinfo is None and timezone is not None:
+        dt = dt.replace(tzinfo=timezone)
     # yep, this is NOT %Y-%m-%d as is seems to be the only format with timezone that Date.parse in JS accepts. Just forget it.
-    dts = v.dt.strftime('%d %b %Y %H:%M:%S %z')
-    loc = v.locator
+    return dt.strftime('%d %b %Y %H:%M:%S %z')
+
+
+# index of the context column in visits rows
+_CONTEXT = 6
+
+
+def as_json(row: Sequence[Any], *, timezone: ZoneInfo | None) -> Json:
+    """
+    Converts a visits table row straight to json, without constructing DbVisit (see row_to_db_visit)
+    """
+    (norm_url, orig_url, dt_s, locator_title, locator_href, src, context, duration) = row[:8]
     # TODO is locator always present??
     return {
         # TODO do not display year if it's current year??
-        'dt': dts,
+        'dt': format_dt(dt_s, timezone),
         # TODO the frontend had some bug with handling empty string as src. fix that later
-        'src': v.src or 'unnamed',
-        'context': v.context,
-        'duration': v.duration,
+        'src': src or 'unnamed',
+        'context': context,
+        'duration': duration,
         'locator': {
-            'title': loc.title,
-            'href': loc.href,
+            'title': locator_title,
+            'href': locator_href,
         },
-        'original_url': v.orig_url,
-        'normalised_url': v.norm_url,
+        'original_url': orig_url,
+        'normalised_url': norm_url,
     }
 
 
@@ -130,14 +164,52 @@ def get_db_path(*, check: bool = True) -> Path:
     return db
 
 
-# NOTE:
-# - this logging might appear multiple times in the logs for the same db/mtime because server uses multiple threads
-# - lru cache isn't ideal perhaps because there is no cleanup happening? but hasn't caused any issues so far
-@lru_cache(1)
-# PathWithMtime aids lru_cache in reloading the sqlalchemy binder
+def get_all_db_paths() -> list[PathWithMtime]:
+    """
+    The main database and/or its shards (if indexed with SHARDED_DB), queries are run against each of them
+    """
+    db = get_db_path(check=False)
+    paths = get_db_paths(db)
+    assert len(paths) > 0, db
+    _dispose_removed(paths)
+    return [PathWithMtime.make(p) for p in paths]
+
+
+# each shard is a separate database, so need to keep more than one in the caches below
+# NOTE: these only keep tables/statements, connections are only held by the engines (see _get_stuff)
+_DB_CACHE_SIZE = 128
+
+
+# engine for each database (main one or a shard), along with the mtime it was loaded for
+# each engine keeps a pool of connections, so when the database changes (e.g. reindexed), the old one is disposed
+_engines: dict[Path, tuple[float, DbStuff]] = {}
+_engines_lock = threading.Lock()
+
+
+# NOTE: this logging might appear multiple times in the logs for the same db/mtime because server uses multiple threads
+# mtime aids in reloading the sqlalchemy binder, e.g. if reindexing added new columns
 def _get_stuff(db_path: PathWithMtime) -> DbStuff:
-    get_logger().debug(f'reloading db: {db_path}')
-    return get_db_stuff(db_path=db_path.path)
+    with _engines_lock:
+        cached = _engines.get(db_path.path)
+        # if it's older, the request just started before reindexing, so fine to use the new one
+        if cached is not None and cached[0] >= db_path.mtime:
+            return cached[1]
+        get_logger().debug(f'reloading db: {db_path}')
+        stuff = get_db_stuff(db_path=db_path.path)
+        _engines[db_path.path] = (db_path.mtime, stuff)
+    if cached is not None:
+        # connections which are still checked out are closed once they are returned
+        engine, _ = cached[1]
+        engine.dispose()
+    return stuff
+
+
+def _dispose_removed(paths: Sequence[Path]) -> None:
+    # e.g. shards removed by reindexing with --overwrite
+    with _engines_lock:
+        removed = [_engines.pop(p) for p in set(_engines) - set(paths)]
+    for _, (engine, _) in removed:
+        engine.dispose()
 
 
 def get_stuff(db_path: Path | None = None) -> DbStuff:  # TODO better name
@@ -147,68 +219,518 @@ def get_stuff(db_path: Path | None = None) -> DbStuff:  # TODO better name
     return _get_stuff(PathWithMtime.make(db_path))
 
 
-def db_stats(db_path: Path) -> Json:
-    engine, table = get_stuff(db_path)
-    query = select(func.count()).select_from(table)
-    with engine.connect() as conn:
-        [(total,)] = conn.execute(query)
+@lru_cache(_DB_CACHE_SIZE)
+def _get_url_summary(db_path: PathWithMtime) -> Table | None:
+    engine, _ = _get_stuff(db_path)
+    summary = get_url_summary(engine)
+    if summary is None:
+        get_logger().warning(f'{db_path.path}: no url summary table, /visited will be slow. Rerun indexer to create it')
+    return summary
+
+
+@lru_cache(_DB_CACHE_SIZE)
+def _has_fts(db_path: PathWithMtime) -> bool:
+    engine, _ = _get_stuff(db_path)
+    res = has_fts(engine)
+    if not res:
+        get_logger().warning(f'{db_path.path}: no full text index, /search will be slow. Rerun indexer to create it')
+    return res
+
+
+def db_stats(db_paths: Sequence[Path]) -> Json:
+    total = 0
+    for db_path in db_paths:
+        engine, table = get_stuff(db_path)
+        query = select(func.count()).select_from(table)
+        with engine.connect() as conn:
+            [(count,)] = conn.execute(query)
+        total += count
     return {
         'total_visits': total,
     }
 
 
-class Where(Protocol):
-    def __call__(self, table: Table, url: str) -> ColumnElement[bool]: ...
+# named placeholders, so compiled statements can be executed by sqlite3 directly with a dict of parameters
+_DIALECT = dialect_sqlite.dialect(paramstyle='named')
 
+# LIKE can't use the index on norm_url, so prefix matches are done via range instead
+# this character sorts after any other (valid) character, so 'url' <= x < 'url' + _MAX_CHAR means that x starts with 'url'
+# NOTE: compared with NOCASE collation (and index), since LIKE is case insensitive for ASCII characters
+_MAX_CHAR = '\U0010ffff'
 
-@dataclass
-class VisitsResponse:
-    original_url: str
-    normalised_url: str
-    visits: Any
+
+def _like_escape(s: str) -> str:
+    return s.replace('/', '//').replace('%', '/%').replace('_', '/_')
+
+
+class Statement(NamedTuple):
+    sql: str
+    # same, but ordered by (dt_epoch, rowid) descending, starting after :cursor_dt/:cursor_rowid, up to :limit rows
+    # selects dt_epoch and rowid as two extra columns, see Search
+    paged: str
+
+
+class Statements(NamedTuple):
+    """
+    SQL for the hot endpoints, compiled once per database (columns might differ for databases created by older versions)
+    """
+
+    visits: Statement
+    search_fts: Statement | None  # None if there is no full text index
+    search_like: Statement
+    search_around: Statement
+    visited: str | None  # None if there is no url_summary table
 
 
-def search_common(url: str, where: Where) -> VisitsResponse:
+def _compile(stmt: ClauseElement) -> str:
+    return str(stmt.compile(dialect=_DIALECT))
+
+
+@lru_cache(_DB_CACHE_SIZE)
+def _get_statements(db_path: PathWithMtime) -> Statements:
     logger = get_logger()
-    config = EnvConfig.get()
+    _, table = _get_stuff(db_path)
+    select_visits = table.select()
+    rowid: ColumnElement[int] = literal_column(f'{table.name}.rowid')
+
+    dt_epoch: ColumnElement[int]
+    if DT_EPOCH_COLUMN in table.c:
+        dt_epoch = table.c.dt_epoch
+    else:
+        # database created by older version, have to compute timestamps on the fly (can't use index)
+        logger.warning(
+            f'{db_path.path}: no {DT_EPOCH_COLUMN} column in the database, /search_around and pagination will be slow. Rerun indexer'
+        )
+        # this is a bit fragile, relies on cachew internal timestamp format, e.g.
+        # 2020-11-10T06:13:03.196376+00:00 Europe/London
+        # instr finds the first match, but if not found it defaults to 0.. which we hack by concatting with ' '
+        # NOTE: strftime is tz aware, e.g. would distinguish +05:00 vs -03:00
+        dt_epoch = literal_column(
+            f"CAST(strftime('%s', substr({table.name}.dt, 1, instr(CAST({table.name}.dt AS TEXT) || ' ', ' ') - 1)) AS INTEGER)",
+            type_=types.Integer,
+        )
+
+    def statement(where: ColumnElement[bool]) -> Statement:
+        stmt = select_visits.where(where)
+        paged = (
+            stmt.add_columns(dt_epoch, rowid)
+            .where(tuple_(dt_epoch, rowid) < tuple_(bindparam('cursor_dt'), bindparam('cursor_rowid')))
+            .order_by(dt_epoch.desc(), rowid.desc())
+            .limit(bindparam('limit'))
+            # otherwise sqlite dialect renders OFFSET with a separate (anonymous) parameter
+            .offset(literal_column('0'))
+        )
+        return Statement(sql=_compile(stmt), paged=_compile(paged))
 
-    original_url = url and url.strip()
-    url = canonify(original_url)
-    if not url:  # Don't eliminate a "#tag" query.
-        url = original_url
-    logger.debug(f'normalised url {original_url!r} to {url!r}')
+    visits = statement(
+        or_(
+            # exact match
+            table.c.norm_url == bindparam('url'),
+            # + child visits, but only 'interesting' ones
+            and_(
+                table.c.context != None,  # noqa: E711
+                table.c.norm_url.collate('NOCASE') >= bindparam('url'),
+                table.c.norm_url.collate('NOCASE') < bindparam('url_upper'),
+            ),
+        )
+    )
 
-    engine, table = get_stuff()
+    search_fts: Statement | None = None
+    if _has_fts(db_path):
+        fts = sql_table(FTS_TABLE, column('rowid'), column(FTS_TABLE))
+        matching = select(fts.c.rowid).where(fts.c[FTS_TABLE].match(bindparam('fts_query')))
+        search_fts = statement(rowid.in_(matching))
 
-    query = table.select().where(where(table=table, url=url))
-    logger.debug('query: %s', query)
+    pattern: BindParameter[str] = bindparam('pattern')
+    search_like = statement(
+        # todo hmm. think about it, not sure if I need proper indexer for fuzzy search etc?
+        or_(*(table.c[c].like(pattern, escape='/') for c in ['norm_url', 'orig_url', 'context', 'locator_title']))
+    )
 
-    with engine.connect() as conn:
+    search_around = statement(dt_epoch.between(bindparam('lo'), bindparam('hi')))
+
+    visited: str | None = None
+    summary = _get_url_summary(db_path)
+    if summary is not None:
+        # url_summary has unique index on norm_url, so this is just an index lookup per url
+        # json_each lets us pass all urls as a single parameter, so the statement doesn't depend on their count
+        urls: Select = select(literal_column('value')).select_from(func.json_each(bindparam('urls')))
+        visited = _compile(summary.select().where(summary.c.norm_url.in_(urls)))
+
+    return Statements(
+        visits=visits,
+        search_fts=search_fts,
+        search_like=search_like,
+        search_around=search_around,
+        visited=visited,
+    )
+
+
+def _fetchall(db_path: PathWithMtime, sql: str, params: dict[str, Any]) -> Sequence[Any]:
+    return list(_iter_rows(db_path, sql, params))
+
+
+_FETCH_CHUNK = 1000
+
+
+def _iter_rows(db_path: PathWithMtime, sql: str, params: dict[str, Any]) -> Iterator[Any]:
+    """
+    Yields rows as sqlite produces them, the connection is held until the iterator is exhausted or closed
+    """
+    engine, _ = _get_stuff(db_path)
+    # raw DBAPI connection from the pool, skips sqlalchemy compilation/result machinery on the hot path
+    conn = engine.raw_connection()
+    try:
+        dbapi_conn = conn.driver_connection
+        assert isinstance(dbapi_conn, sqlite3.Connection), dbapi_conn
+        cursor = conn.cursor()
+        try:
+            with interruptible(dbapi_conn):
+                cursor.execute(sql, params)
+            while True:
+                with interruptible(dbapi_conn):
+                    rows = cursor.fetchmany(_FETCH_CHUNK)
+                if len(rows) == 0:
+                    break
+                yield from rows
+        finally:
+            cursor.close()
+    finally:
+        conn.close()  # returns it to the pool
+
+
+class Query(Protocol):
+    # db is passed since some features (e.g. full text index) might only be present in some of the databases
+    def __call__(self, db: PathWithMtime, url: str) -> tuple[Statement, dict[str, Any]]: ...
+
+
+# position of the last returned visit in the (dt_epoch DESC, database name, rowid DESC) order
+class Cursor(NamedTuple):
+    dt_epoch: int
+    db: str
+    rowid: int
+
+    def encode(self) -> str:
+        return base64.urlsafe_b64encode(json.dumps(self).encode('utf8')).decode('ascii')
+
+    @classmethod
+    def decode(cls, cursor: str) -> Cursor:
+        try:
+            dt_epoch, db, rowid = json.loads(base64.urlsafe_b64decode(cursor))
+            return cls(dt_epoch=int(dt_epoch), db=str(db), rowid=int(rowid))
+        except Exception as e:
+            raise fastapi.HTTPException(status_code=400, detail=f'invalid cursor: {cursor!r}') from e
+
+    def params(self, db: str) -> dict[str, Any]:
+        # rows are compared as (dt_epoch, rowid) < (cursor_dt, cursor_rowid) within each database
+        # so in databases before/after the cursor's one, only dt_epoch matters
+        if db < self.db:
+            rowid = _MIN_ROWID  # strictly older than the cursor
+        elif db > self.db:
+            rowid = _MAX_ROWID  # same or older
+        else:
+            rowid = self.rowid
+        return {'cursor_dt': self.dt_epoch, 'cursor_rowid': rowid}
+
+
+_MIN_ROWID = -(2**63)
+_MAX_ROWID = 2**63 - 1
+# i.e. start from the most recent visit
+_NO_CURSOR_PARAMS = {'cursor_dt': _MAX_ROWID, 'cursor_rowid': _MAX_ROWID}
+
+
+class Search:
+    """
+    Visits matching the query in all databases, converted to json lazily
+
+    :param limit: if set, returns at most that many (most recent) visits, and sets next_cursor if there are more
+    :param after: continue from this cursor (i.e. next_cursor from the previous page)
+    """
+
+    def __init__(self, url: str, query: Query, *, limit: int | None = None, after: Cursor | None = None) -> None:
+        logger = get_logger()
+        original_url = url and url.strip()
+        url = canonify(original_url)
+        if not url:  # Don't eliminate a "#tag" query.
+            url = original_url
+        logger.debug(f'normalised url {original_url!r} to {url!r}')
+
+        self.original_url = original_url
+        self.normalised_url = url
+        self.query = query
+        self.limit = limit
+        self.after = after
+        self.next_cursor: str | None = None  # only known once visits are exhausted
+
+    def _rows(self) -> Generator[tuple[str, Any], None, None]:
+        logger = get_logger()
+        # with sharded database, just query each shard and merge the results
+        dbs = get_all_db_paths()
+        if self.limit is None:
+            for db in dbs:
+                statement, params = self.query(db=db, url=self.normalised_url)
+                logger.debug('query: %s %s', statement.sql, params)
+                yield from ((db.path.name, row) for row in _iter_rows(db, statement.sql, params))
+            return
+
+        pages = []
+        for db in dbs:
+            name = db.path.name
+            statement, params = self.query(db=db, url=self.normalised_url)
+            cursor_params = _NO_CURSOR_PARAMS if self.after is None else self.after.params(name)
+            # one extra row to find out if there is a next page
+            params = {**params, **cursor_params, 'limit': self.limit + 1}
+            logger.debug('query: %s %s', statement.paged, params)
+            pages.append(zip(repeat(name), _iter_rows(db, statement.paged, params)))
+        # each page is already ordered, dt_epoch and rowid are the last two columns
+        yield from heapq.merge(*pages, key=lambda p: (-p[1][-2], p[0], -p[1][-1]))
+
+    def visits(self) -> Iterator[Json]:
+        timezone = EnvConfig.get().timezone
+        rows = self._rows()
+        last: tuple[str, Any] | None = None
         try:
-            # TODO make more defensive here
-            visits: list[DbVisit] = [row_to_db_visit(row) for row in conn.execute(query)]
-        except exc.OperationalError as e:
-            if getattr(e, 'msg', None) == 'no such table: visits':
-                logger.warning('you may have to run indexer first!')
-                # result['visits'] = [{an error with a msg}] # TODO
-                # return result
+            for i, (name, row) in enumerate(rows):
+                if i == self.limit:
+                    assert last is not None
+                    (last_name, last_row) = last
+                    self.next_cursor = Cursor(dt_epoch=last_row[-2], db=last_name, rowid=last_row[-1]).encode()
+                    break
+                last = (name, row)
+                # naive timestamps are assumed to be in the configured timezone
+                yield as_json(row, timezone=timezone)
+        except sqlite3.OperationalError as e:
+            if str(e) == 'no such table: visits':
+                get_logger().warning('you may have to run indexer first!')
             raise
+        finally:
+            rows.close()  # releases database connections straightaway
 
-    logger.debug(f'got {len(visits)} visits from db, responding')
 
-    vlist: list[DbVisit] = []
-    for vis in visits:
-        dt = vis.dt
-        if dt.tzinfo is None:  # FIXME need this for /visits endpoint as well?
-            dt = dt.replace(tzinfo=config.timezone)
-            vis = vis._replace(dt=dt)
-        vlist.append(vis)
+# NOTE: converted with vars() rather than dataclasses.asdict(), which would deep copy all visits
+@dataclass
+class VisitsResponse:
+    original_url: str
+    normalised_url: str
+    visits: Any
+    next_cursor: str | None = None
+
+
+def search_common(url: str, query: Query, *, limit: int | None = None, after: Cursor | None = None) -> VisitsResponse:
+    search = Search(url=url, query=query, limit=limit, after=after)
+    visits = list(search.visits())
+    get_logger().debug(f'got {len(visits)} visits from db, responding')
 
     # TODO respond with normalised result, then frontent could choose how to present children/siblings/whatever?
     return VisitsResponse(
-        original_url=original_url,
-        normalised_url=url,
-        visits=list(map(as_json, vlist)),
+        original_url=search.original_url,
+        normalised_url=search.normalised_url,
+        visits=visits,
+        next_cursor=search.next_cursor,
+    )
+
+
+@lru_cache(1)
+def _orjson() -> Any | None:
+    try:
+        import orjson  # type: ignore[import-not-found,unused-ignore]
+    except ModuleNotFoundError as e:
+        if e.name != 'orjson':
+            raise e
+        get_logger().debug(
+            'orjson is not installed, using builtin json (pip3 install --user orjson for faster responses)'
+        )
+        return None
+    return orjson
+
+
+def dump_json(obj: Any) -> bytes:
+    orjson = _orjson()
+    if orjson is not None:
+        return orjson.dumps(obj)
+    # same as what fastapi.responses.JSONResponse does
+    return json.dumps(obj, ensure_ascii=False, allow_nan=False, indent=None, separators=(',', ':')).encode('utf-8')
+
+
+def _db_version() -> tuple[Hashable, ...]:
+    """
+    Changes whenever any of the databases is written to (e.g. reindexed)
+    """
+    res: list[Hashable] = []
+    for db in get_all_db_paths():
+        # in WAL mode the database file itself might only be modified on checkpoints
+        wal = db.path.with_name(db.path.name + '-wal')
+        try:
+            st = wal.stat()
+        except FileNotFoundError:
+            wal_key = None
+        else:
+            wal_key = (st.st_mtime_ns, st.st_size)
+        res.append((db, wal_key))
+    return tuple(res)
+
+
+class ResponseCache:
+    """
+    Bounded LRU cache for serialized responses, shared between the server threads.
+
+    Entries are only valid for a particular database version, so the whole cache is dropped once it changes.
+    """
+
+    def __init__(self, *, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.version: Hashable = None
+        self.entries: OrderedDict[Hashable, bytes] = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, *, version: Hashable, compute: Callable[[], bytes]) -> bytes:
+        with self.lock:
+            if version != self.version:
+                self._clear()
+                self.version = version
+            res = self.entries.get(key)
+            if res is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return res
+            self.misses += 1
+
+        # computing without the lock, so slow requests don't block the rest
+        res = compute()
+
+        # a single huge response (e.g. /search_around) shouldn't evict everything else
+        if len(res) > self.max_bytes // 8:
+            return res
+        with self.lock:
+            if version != self.version or key in self.entries:
+                return res
+            self.entries[key] = res
+            self.size += len(res)
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+        return res
+
+    def _clear(self) -> None:
+        self.entries.clear()
+        self.size = 0
+
+    def stats(self) -> Json:
+        with self.lock:
+            return {
+                'hits'   : self.hits,
+                'misses' : self.misses,
+                'entries': len(self.entries),
+                'bytes'  : self.size,
+            }  # fmt: skip
+
+
+_RESPONSE_CACHE_BYTES = 64 * 1024 * 1024
+
+response_cache = ResponseCache(max_bytes=_RESPONSE_CACHE_BYTES)
+
+
+def cached_response(key: Hashable, compute: Callable[[], Any]) -> fastapi.Response:
+    """
+    :param key: endpoint along with the normalised request, database version is added to it
+    :param compute: computes the json-like response, only called on cache miss
+    """
+    content = response_cache.get(key, version=_db_version(), compute=lambda: dump_json(compute()))
+    return fastapi.Response(content=content, media_type='application/json')
+
+
+@dataclass(kw_only=True)
+class PageRequest:
+    """
+    Optional pagination/streaming for endpoints returning visits. By default all visits are returned at once.
+    """
+
+    # if set, at most that many visits are returned (most recent first), along with next_cursor to request more
+    limit: int | None = None
+    # next_cursor from the previous response
+    cursor: str | None = None
+    # if true, responds with newline delimited json instead, see _ndjson
+    stream: bool = False
+
+
+_NDJSON_CHUNK = 1000
+
+
+def _ndjson(search: Search) -> Iterator[bytes]:
+    """
+    First line is {original_url, normalised_url}, then a line per visit, and the last one is {next_cursor}
+    """
+    yield dump_json({'original_url': search.original_url, 'normalised_url': search.normalised_url}) + b'\n'
+    lines: list[bytes] = []
+    for v in search.visits():
+        lines.append(dump_json(v))
+        if len(lines) == _NDJSON_CHUNK:
+            yield b'\n'.join(lines) + b'\n'
+            lines = []
+    if len(lines) > 0:
+        yield b'\n'.join(lines) + b'\n'
+    yield dump_json({'next_cursor': search.next_cursor}) + b'\n'
+
+
+_DB_WORKERS = 8
+# cheap requests (/status, /visited) can always use these
+_DB_RESERVED_WORKERS = 2
+
+db_executor = DbExecutor(workers=_DB_WORKERS, reserved=_DB_RESERVED_WORKERS)
+
+
+async def _wait_disconnect(request: fastapi.Request) -> None:
+    # request body is already consumed at this point, so the only message left is disconnect
+    while (await request.receive())['type'] != 'http.disconnect':
+        pass
+
+
+async def run_db(
+    request: fastapi.Request,
+    fn: Callable[[], fastapi.Response],
+    *,
+    priority: Priority,
+) -> fastapi.Response:
+    """
+    Runs fn in the database executor, cancels (i.e. interrupts the queries) if the client disconnects in the meantime
+    """
+    job = asyncio.ensure_future(db_executor.run(fn, priority=priority))
+    disconnected = asyncio.ensure_future(_wait_disconnect(request))
+    try:
+        done, _ = await asyncio.wait([job, disconnected], return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        disconnected.cancel()
+        job.cancel()  # noop if it's completed already
+    if job not in done:
+        get_logger().debug(f'{request.url.path}: client disconnected, cancelled')
+        return fastapi.Response(status_code=499)  # 'client closed request', nobody is going to receive it anyway
+    return job.result()
+
+
+def search_response(
+    key: Hashable,
+    page: PageRequest,
+    *,
+    url: str,
+    query: Query,
+    priority: Priority,
+) -> fastapi.Response:
+    if page.limit is not None and page.limit <= 0:
+        raise fastapi.HTTPException(status_code=400, detail=f'limit should be positive: {page.limit}')
+    after = None if page.cursor is None else Cursor.decode(page.cursor)
+    if page.stream:
+        # not cached, the whole point is not to keep the response in memory
+        search = Search(url=url, query=query, limit=page.limit, after=after)
+        return fastapi.responses.StreamingResponse(
+            db_executor.iterate(_ndjson(search), priority=priority),
+            media_type='application/x-ndjson',
+        )
+    return cached_response(
+        (key, page.limit, page.cursor),
+        lambda: vars(search_common(url=url, query=query, limit=page.limit, after=after)),
     )
 
 
@@ -216,14 +738,18 @@ def search_common(url: str, where: Where) -> VisitsResponse:
 # perhasp should switch to get for most endpoint
 @app.get ('/status', response_model=Json)  # fmt: skip
 @app.post('/status', response_model=Json)  # fmt: skip
-def status(fastapi_request: fastapi.Request) -> Json:
+async def status(fastapi_request: fastapi.Request) -> Json:
     '''
     Ideally, status will always respond, regardless the internal state of the backend?
     '''
     get_logger().debug(f'{fastapi_request.url.path}')
+    return await db_executor.run(_status, priority=Priority.HIGH)
 
+
+def _status() -> Json:
     db = get_db_path(check=False)
-    db_exists: bool = db.exists()
+    db_paths = get_db_paths(db)  # might be sharded, then main database doesn't exist
+    db_exists: bool = len(db_paths) > 0
     if db_exists:
         db_path = str(db)
     else:
@@ -232,7 +758,7 @@ def status(fastapi_request: fastapi.Request) -> Json:
     stats: Json
     if db_exists:
         try:
-            stats = db_stats(db)
+            stats = db_stats(db_paths)
         except Exception as e:
             stats = {'ERROR': str(e)}
     else:
@@ -250,59 +776,74 @@ def status(fastapi_request: fastapi.Request) -> Json:
         'version': version,
         'db'     : db_path,
         'stats'  : stats,
+        'cache'  : response_cache.stats(),
     }  # fmt: skip
 
 
-@dataclass
-class VisitsRequest:
+def visits_query(db: PathWithMtime, url: str) -> tuple[Statement, dict[str, Any]]:
+    # the url itself and all its children
+    return _get_statements(db).visits, {'url': url, 'url_upper': url + _MAX_CHAR}
+
+
+@dataclass(kw_only=True)
+class VisitsRequest(PageRequest):
     url: str
 
 
 @app.get ('/visits', response_model=VisitsResponse)  # fmt: skip
 @app.post('/visits', response_model=VisitsResponse)  # fmt: skip
-def visits(request: VisitsRequest, fastapi_request: fastapi.Request) -> VisitsResponse:
+async def visits(request: VisitsRequest, fastapi_request: fastapi.Request) -> fastapi.Response:
     get_logger().debug(f'{fastapi_request.url.path} {request}')
-    return search_common(
-        url=request.url,
-        # odd, doesn't work just with: x or (y and z)
-        where=lambda table, url: or_(
-            # exact match
-            table.c.norm_url == url,
-            # + child visits, but only 'interesting' ones
-            and_(table.c.context != None, table.c.norm_url.startswith(url, autoescape=True)),  # noqa: E711
+    return await run_db(
+        fastapi_request,
+        lambda: search_response(
+            ('visits', request.url.strip()),
+            request,
+            url=request.url,
+            query=visits_query,
+            priority=Priority.NORMAL,
         ),
+        priority=Priority.NORMAL,
     )
 
 
-@dataclass
-class SearchRequest:
+@dataclass(kw_only=True)
+class SearchRequest(PageRequest):
     url: str
 
 
 @app.get ('/search', response_model=VisitsResponse)  # fmt: skip
 @app.post('/search', response_model=VisitsResponse)  # fmt: skip
-def search(request: SearchRequest, fastapi_request: fastapi.Request) -> VisitsResponse:
+async def search(request: SearchRequest, fastapi_request: fastapi.Request) -> fastapi.Response:
     get_logger().debug(f'{fastapi_request.url.path} {request}')
-    return search_common(
-        url=request.url,
-        where=lambda table, url: or_(
-            # todo hmm. think about it, not sure if I need proper indexer for fuzzy search etc?
-            table.c.norm_url     .contains(url, autoescape=True),
-            table.c.orig_url     .contains(url, autoescape=True),
-            table.c.context      .contains(url, autoescape=True),
-            table.c.locator_title.contains(url, autoescape=True),
+
+    def query(db: PathWithMtime, url: str) -> tuple[Statement, dict[str, Any]]:
+        statements = _get_statements(db)
+        if statements.search_fts is not None and len(url) >= FTS_MIN_QUERY_LENGTH:
+            return statements.search_fts, {'fts_query': fts_query(url)}
+        return statements.search_like, {'pattern': f'%{_like_escape(url)}%'}
+
+    return await run_db(
+        fastapi_request,
+        lambda: search_response(
+            ('search', request.url.strip()),
+            request,
+            url=request.url,
+            query=query,
+            priority=Priority.LOW,
         ),
-    )  # fmt: skip
+        priority=Priority.LOW,
+    )
 
 
-@dataclass
-class SearchAroundRequest:
+@dataclass(kw_only=True)
+class SearchAroundRequest(PageRequest):
     timestamp: float
 
 
 @app.get ('/search_around', response_model=VisitsResponse)  # fmt: skip
 @app.post('/search_around', response_model=VisitsResponse)  # fmt: skip
-def search_around(request: SearchAroundRequest, fastapi_request: fastapi.Request) -> VisitsResponse:
+async def search_around(request: SearchAroundRequest, fastapi_request: fastapi.Request) -> fastapi.Response:
     get_logger().debug(f'{fastapi_request.url.path} {request}')
     utc_timestamp = request.timestamp  # old 'timestamp' name is legacy
 
@@ -311,25 +852,22 @@ def search_around(request: SearchAroundRequest, fastapi_request: fastapi.Request
     delta_front = timedelta(minutes=2).total_seconds()
     # TODO not sure about delta_front.. but it also serves as quick hack to accommodate for all the truncations etc
 
-    return search_common(
-        url='http://dummy.org',  # NOTE: not used in the where query (below).. perhaps need to get rid of this
-        where=lambda table, url: between(  # noqa: ARG005
-            func.strftime(
-                '%s',  # NOTE: it's tz aware, e.g. would distinguish +05:00 vs -03:00
-                # this is a bit fragile, relies on cachew internal timestamp format, e.g.
-                # 2020-11-10T06:13:03.196376+00:00 Europe/London
-                func.substr(
-                    table.c.dt,
-                    1,  # substr is 1-indexed
-                    # instr finds the first match, but if not found it defaults to 0.. which we hack by concatting with ' '
-                    func.instr(func.cast(table.c.dt, types.Unicode).op('||')(' '), ' ') - 1,
-                    # for fucks sake.. seems that cast is necessary otherwise it tries to treat ' ' as datetime???
-                ),
-            )
-            - literal(utc_timestamp),
-            literal(-delta_back),
-            literal(delta_front),
+    # NOTE: for databases without dt_epoch, the same bounds are compared against timestamps computed on the fly
+    params = {
+        'lo': math.ceil(utc_timestamp - delta_back),
+        'hi': math.floor(utc_timestamp + delta_front),
+    }
+
+    return await run_db(
+        fastapi_request,
+        lambda: search_response(
+            ('search_around', params['lo'], params['hi']),
+            request,
+            url='http://dummy.org',  # NOTE: not used in the query (below).. perhaps need to get rid of this
+            query=lambda db, url: (_get_statements(db).search_around, params),  # noqa: ARG005
+            priority=Priority.LOW,
         ),
+        priority=Priority.LOW,
     )
 
 
@@ -362,24 +900,11 @@ class VisitedRequest:
 VisitedResponse = list[Json | None]
 
 
-@app.get ('/visited', response_model=VisitedResponse)  # fmt: skip
-@app.post('/visited', response_model=VisitedResponse)  # fmt: skip
-def visited(request: VisitedRequest, fastapi_request: fastapi.Request) -> VisitedResponse:
-    # not printing full request here, for pages with many urls it can be really spammy
-    get_logger().debug(f'{fastapi_request.url.path} {len(request.urls)=} {request.client_version=}')
-
-    urls = request.urls
-    client_version = request.client_version
-
-    _version = as_version(client_version)  # todo use it?
-
-    nurls = [canonify(u) for u in urls]
-    snurls = sorted(set(nurls))
-
-    if len(snurls) == 0:
-        return []
-
-    engine, table = get_stuff()
+def _visited_legacy(snurls: list[str], db_path: PathWithMtime) -> dict[str, Any]:
+    """
+    Fallback for databases indexed before url_summary table was introduced
+    """
+    engine, table = _get_stuff(db_path)
 
     # sqlalchemy doesn't seem to support SELECT FROM (VALUES (...)) in its api
     # also doesn't support array binding...
@@ -405,17 +930,55 @@ SELECT queried, visits.*
             *table.columns,
         )
     )
-    # TODO might be very beneficial for performance to have an intermediate table
-    # SELECT visits.* FROM visits GROUP BY visits.norm_url ORDER BY visits.context IS NULL DESC
-    # + unique index in norm_url
-    # brings down large queries to 50ms...
     with engine.connect() as conn:
         res = list(conn.execute(query))
-        present: dict[str, Any] = {row[0]: row_to_db_visit(row[1:]) for row in res}
+        return {row[0]: row[1:] for row in res}
+
+
+@app.get ('/visited', response_model=VisitedResponse)  # fmt: skip
+@app.post('/visited', response_model=VisitedResponse)  # fmt: skip
+async def visited(request: VisitedRequest, fastapi_request: fastapi.Request) -> fastapi.Response:
+    # not printing full request here, for pages with many urls it can be really spammy
+    get_logger().debug(f'{fastapi_request.url.path} {len(request.urls)=} {request.client_version=}')
+    return await run_db(
+        fastapi_request,
+        lambda: cached_response(('visited', tuple(request.urls)), lambda: _visited(request)),
+        priority=Priority.HIGH,
+    )
+
+
+def _visited(request: VisitedRequest) -> VisitedResponse:
+    urls = request.urls
+    client_version = request.client_version
+
+    _version = as_version(client_version)  # todo use it?
+
+    nurls = canonify_many(urls)
+    snurls = sorted(set(nurls))
+
+    if len(snurls) == 0:
+        return []
+
+    present: dict[str, Any] = {}
+    for db in get_all_db_paths():
+        sql = _get_statements(db).visited
+        found: dict[str, Any]
+        if sql is not None:
+            rows = _fetchall(db, sql, {'urls': json.dumps(snurls)})
+            found = {row[0]: row for row in rows}
+        else:
+            found = _visited_legacy(snurls, db)
+        for nu, v in found.items():
+            # same url might be present in several shards, visits with context are preferred (same as in url_summary)
+            prev = present.get(nu)
+            if prev is None or (prev[_CONTEXT] is None and v[_CONTEXT] is not None):
+                present[nu] = v
+
     results = []
     for nu in nurls:
         r = present.get(nu)
-        results.append(None if r is None else as_json(r))
+        # NOTE: naive timestamps are formatted without timezone here, unlike other endpoints
+        results.append(None if r is None else as_json(r, timezone=None))
 
     # no need for it anymore, extension has been updated since
     # just keeping as an example
@@ -426,19 +989,35 @@ SELECT queried, visits.*
     return results
 
 
-def _run(*, host: str, port: str, quiet: bool, config: ServerConfig) -> None:
+def _run(*, host: str, port: str, quiet: bool, config: ServerConfig, workers: int = 1) -> None:
     logger = get_logger()
 
-    logger.info('Running server with %s', config)
+    logger.info('Running server with %s (workers: %d)', config, workers)
+    if has_both_layouts(config.db):
+        logger.warning(
+            "both %s and its shards exist (was SHARDED_DB changed?), visits indexed in both would be duplicated. "
+            "Reindex with --overwrite to remove the stale ones.",
+            config.db,
+        )
 
+    # also passed to worker processes (if any), since they inherit the environment
     EnvConfig.set(config)
 
     import uvicorn
 
-    uvicorn.run('promnesia.server:app', host=host, port=int(port), log_level='debug')
+    # NOTE: each worker is a separate process, with its own database connections, executor and caches
+    uvicorn.run(
+        'promnesia.server:app',
+        host=host,
+        port=int(port),
+        log_level='info' if quiet else 'debug',
+        workers=workers,
+    )
 
 
 def run(args: argparse.Namespace) -> None:
+    if args.workers < 1:
+        raise ValueError(f'--workers should be positive: {args.workers}')
     _run(
         port=args.port,
         host=args.host,
@@ -447,6 +1026,7 @@ def run(args: argparse.Namespace) -> None:
             db=args.db,
             timezone=args.timezone,
         ),
+        workers=args.workers,
     )
 
 
@@ -477,6 +1057,12 @@ def setup_parser(p: argparse.ArgumentParser) -> None:
         action='store_true',
         help='Pass to log less',
     )
+    p.add_argument(
+        '--workers',
+        type=int,
+        default=1,
+        help='(experimental) Number of server processes, might help if the server is shared by many browsers',
+    )
     # TODO need to keep consistent with the backend...
     # todo use output_dir instead?
     p.add_argument(
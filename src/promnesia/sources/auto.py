@@ -9,16 +9,22 @@
 from __future__ import annotations
 
 import csv
-import itertools
-import json
+import io
 import os
+import shutil
 from collections.abc import Callable, Iterable, Iterator, Sequence
+from concurrent.futures import FIRST_COMPLETED, Future, as_completed, wait
 from concurrent.futures import ProcessPoolExecutor as Pool
-from contextlib import nullcontext
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
 from fnmatch import fnmatch
-from functools import wraps
-from pathlib import Path
-from typing import Any, NamedTuple
+from functools import lru_cache, wraps
+from pathlib import Path, PurePosixPath
+from tempfile import TemporaryDirectory
+from timeit import default_timer as timer
+from typing import IO, Any, NamedTuple
+
+from more_itertools import chunked
 
 from promnesia.common import (
     Loc,
@@ -30,7 +36,7 @@ from promnesia.common import (
     extract_urls,
     file_mtime,
     get_logger,
-    get_tmpdir,
+    get_system_tz,
     logger,
     mime,
     traverse,
@@ -38,36 +44,35 @@ from promnesia.common import (
 )
 from promnesia.config import use_cores
 
+from .auto_cache import AutoCache, FileKey
+from .auto_json import iter_file_strings as iter_json_strings
 from .auto_logseq import logseq_replacer
 from .auto_obsidian import obsidian_replacer
 from .filetypes import Ctx, EUrl
 
 
-def _collect(thing, path: list[str], result: list[EUrl]) -> None:
+def _collect(thing, path: list[str]) -> Iterator[EUrl]:
     if isinstance(thing, str):
         ctx: Ctx = tuple(path)
-        result.extend([EUrl(url=u, ctx=ctx) for u in extract_urls(thing)])
+        for u in extract_urls(thing):
+            yield EUrl(url=u, ctx=ctx)
     elif isinstance(thing, list):
         path.append('[]')
         for x in thing:
-            _collect(x, path, result)
+            yield from _collect(x, path)
         path.pop()
     elif isinstance(thing, dict):
         for k, v in thing.items():
             path.append(k)
-            _collect(k, path, result)
-            _collect(v, path, result)
+            yield from _collect(k, path)
+            yield from _collect(v, path)
             path.pop()
     else:
         pass
 
 
-# TODO mm. okay, I suppose could use kython consuming thingy?..
-def collect_from(thing) -> list[EUrl]:
-    uuu: list[EUrl] = []
-    path: list[str] = []
-    _collect(thing, path, uuu)
-    return uuu
+def collect_from(thing) -> Iterator[EUrl]:
+    return _collect(thing, [])
 
 
 Urls = Iterator[EUrl]
@@ -77,14 +82,30 @@ def _csv(path: Path) -> Urls:
     # TODO these could also have Loc to be fair..
     with path.open() as fo:
         # TODO shit need to urldecode
-        reader = csv.DictReader(fo)
-        for line in reader:
-            yield from collect_from(line)
+        reader = csv.reader(fo)
+        header = next(reader, None)
+        if header is None:
+            return
+        # same as collect_from for each row as dict, but without allocating dicts/lists for each row
+        # NOTE: urls in the header are emitted for each row, same as before
+        columns = [((k,), extract_urls(k)) for k in header]
+        for row in reader:
+            for (ctx, kurls), v in zip(columns, row, strict=False):
+                for u in kurls:
+                    yield EUrl(url=u, ctx=ctx)
+                for u in extract_urls(v):
+                    yield EUrl(url=u, ctx=ctx)
+            # extra values without a header
+            for v in row[len(columns) :]:
+                for u in extract_urls(v):
+                    yield EUrl(url=u, ctx=())
 
 
 def _json(path: Path) -> Urls:
-    jj = json.loads(path.read_text())
-    yield from collect_from(jj)
+    # parsed incrementally, so huge files don't take the memory
+    for ctx, s in iter_json_strings(path):
+        for u in extract_urls(s):
+            yield EUrl(url=u, ctx=ctx)
 
 
 def _plaintext(path: Path) -> Results:
@@ -191,14 +212,20 @@ def index(
     ignored: Sequence[str] | str = (),
     follow: bool = True,
     replacer: Replacer = None,
+    cache: bool = True,
+    only: Iterable[PathIsh] | None = None,
 ) -> Results:
     '''
     path   : a path or list of paths to recursively index
     ignored: a glob or list of globs to exclude from indexing
     follow : whether to follow symlinks or not
+    cache  : whether to cache results for each file (in CACHE_DIR), so unchanged files aren't parsed again next time
+    only   : if passed, only these files (or directories) are indexed, as long as they are within the paths (used by promnesia index --watch)
     '''
     # TODO document replacer?
     ignored = (ignored,) if isinstance(ignored, str) else ignored
+    cache_db = _cache_db() if cache else None
+    only_paths = None if only is None else [Path(o).expanduser().resolve().absolute() for o in only]
     for p in paths:
         # TODO for displaying maybe better not to expand/absolute, but need it for correct mime handling
         apath = Path(p).expanduser().resolve().absolute()
@@ -220,8 +247,20 @@ def index(
             follow=follow,
             replacer=replacer,
             root=root,
+            cache=cache_db,
         )
-        yield from _index(apath, opts=opts)
+        yield from _index(apath, opts=opts, only=only_paths)
+
+
+def _cache_db() -> Path | None:
+    from promnesia import config
+
+    if not config.has():
+        return None
+    cache_dir = config.get().cache_dir
+    if cache_dir is None:  # disabled by the user
+        return None
+    return cache_dir / 'auto.sqlite'
 
 
 class Options(NamedTuple):
@@ -231,33 +270,156 @@ class Options(NamedTuple):
     # TODO I don't like this replacer thing... think about removing it
     replacer: Replacer
     root: Path | None = None
+    cache: Path | None = None
+
+    def cache_key(self) -> str:
+        # other options don't affect results for an individual file
+        replacer = self.replacer
+        replacer_name = None if replacer is None else f'{replacer.__module__}.{replacer.__qualname__}'
+        return repr((str(self.root), replacer_name))
 
 
 def _index_file_aux(path: Path, opts: Options) -> Exception | list[Result]:
     # just a helper for the concurrent version (the generator isn't picklable)
+    before = timer()
     try:
         return list(_index_file(path, opts=opts))
     except Exception as e:
         # possible due to unavoidable race conditions
         return e
+    finally:
+        # useful to spot files which take most of the time
+        logger.debug('indexed %s in %.3fs', path, timer() - before)
 
 
-def _index(path: Path, opts: Options) -> Results:
-    logger = get_logger()
+IndexedFile = tuple[Path, Exception | list[Result]]
+
+
+def _index_files_aux(paths: Sequence[Path], opts: Options) -> list[IndexedFile]:
+    return [(p, _index_file_aux(p, opts)) for p in paths]
+
+
+# files are sent to the workers in chunks, to amortize overhead of pickling options/results
+_POOL_CHUNK_SIZE = 8
+# .. but big files are sent on their own
+_POOL_CHUNK_BYTES = 1_000_000
+# how many files are considered at once when ordering them by size
+_SCHEDULE_WINDOW = 10_000
+# how many chunks per worker can be in flight, so traversal results don't pile up in memory
+_POOL_CHUNKS_PER_WORKER = 4
+
+_in_worker = False
+
+
+def _init_worker() -> None:
+    global _in_worker
+    _in_worker = True
+
 
+@lru_cache(None)
+def _get_pool(workers: int | None) -> Pool:
+    # NOTE: the pool is shared by all auto.index calls during the run (e.g. multiple paths or sources)
+    # it's shut down on interpreter exit by concurrent.futures
+    logger.debug('starting process pool for auto indexer, workers=%s', workers)
+    return Pool(workers, initializer=_init_worker)
+
+
+def _file_size(path: Path) -> int:
+    try:
+        return path.stat().st_size
+    except OSError:
+        # possible due to unavoidable race conditions, will be handled during indexing
+        return 0
+
+
+def _schedule(paths: Iterable[Path]) -> Iterator[list[Path]]:
+    """
+    Splits files into chunks for the pool, largest files first (within the window).
+    Otherwise a huge file (e.g. big json export) at the end of the traversal keeps one worker busy while the rest are idle.
+    """
+    for window in chunked(paths, _SCHEDULE_WINDOW):
+        sized = sorted(((_file_size(p), p) for p in window), key=lambda x: x[0], reverse=True)
+        chunk: list[Path] = []
+        chunk_bytes = 0
+        for size, p in sized:
+            chunk.append(p)
+            chunk_bytes += size
+            if len(chunk) >= _POOL_CHUNK_SIZE or chunk_bytes >= _POOL_CHUNK_BYTES:
+                yield chunk
+                chunk = []
+                chunk_bytes = 0
+        if len(chunk) > 0:
+            yield chunk
+
+
+def _index_files(paths: Iterable[Path], opts: Options) -> Iterator[IndexedFile]:
+    """
+    If PROMNESIA_CORES is set, indexes the files in the process pool, in which case results come in completion order
+    """
     cores = use_cores()
-    if cores is None:  # do not use cores
-        # todo use ExitStack instead?
-        pool = nullcontext()
-        mapper = map  # dummy pool
-    else:
-        workers = None if cores == 0 else cores
-        pool = Pool(workers)  # type: ignore[assignment]
-        mapper = pool.map  # type: ignore[attr-defined]
+    if cores is None or _in_worker:  # don't use cores, or e.g. indexing .xz file contents, already in the pool
+        for p in paths:
+            yield p, _index_file_aux(p, opts)
+        return
+
+    workers = None if cores == 0 else cores
+    max_in_flight = (workers or os.cpu_count() or 1) * _POOL_CHUNKS_PER_WORKER
+
+    pool: Pool | None = None
+    # pool each chunk was submitted to, to report chunk errors if that pool breaks
+    submitted: dict[Future[list[IndexedFile]], tuple[Pool, list[Path]]] = {}
+
+    def discard(broken: Pool) -> None:
+        # e.g. worker was killed by OOM killer -- the pool can't run anything after that, so need to start a new one
+        nonlocal pool
+        if broken is not pool:
+            return  # already discarded
+        broken.shutdown(wait=False, cancel_futures=True)
+        _get_pool.cache_clear()
+        pool = None
+
+    def submit(chunk: list[Path]) -> Future[list[IndexedFile]]:
+        nonlocal pool
+        for _attempt in range(2):
+            if pool is None:
+                pool = _get_pool(workers)
+            try:
+                fut = pool.submit(_index_files_aux, chunk, opts)
+            except BrokenProcessPool:
+                discard(pool)
+                continue
+            submitted[fut] = (pool, chunk)
+            return fut
+        raise RuntimeError("couldn't start process pool for auto indexer")
+
+    def results(fut: Future[list[IndexedFile]]) -> list[IndexedFile]:
+        fut_pool, chunk = submitted.pop(fut)
+        try:
+            return fut.result()
+        except BrokenProcessPool as e:
+            logger.error('process pool for auto indexer is broken, %d files in the chunk are not indexed', len(chunk))
+            discard(fut_pool)
+            return [(p, e) for p in chunk]
+
+    pending: set[Future[list[IndexedFile]]] = set()
+    for chunk in _schedule(paths):
+        pending.add(submit(chunk))
+        if len(pending) >= max_in_flight:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in done:
+                yield from results(fut)
+    for fut in as_completed(pending):
+        yield from results(fut)
+
+
+def _index(path: Path, opts: Options, *, only: Sequence[Path] | None = None) -> Results:
+    logger = get_logger()
+
+    starts = [path] if only is None else [o for o in only if o.is_relative_to(path) and o.exists()]
 
     # iterate over resolved paths, to avoid duplicates
     def rit() -> Iterable[Path]:
-        it = traverse(path, follow=opts.follow, ignore=IGNORE)
+        it = (p for start in starts for p in traverse(start, follow=opts.follow, ignore=IGNORE))
         for p in it:
             if any(fnmatch(str(p), o) for o in opts.ignored):
                 # TODO not sure if should log here... might end up with quite a bit of logs
@@ -278,12 +440,42 @@ def _index(path: Path, opts: Options) -> Results:
 
     it = unique_everseen(rit())
 
-    with pool:
-        for r in mapper(_index_file_aux, it, itertools.repeat(opts)):
+    if opts.cache is None:
+        for _p, r in _index_files(it, opts):
             if isinstance(r, Exception):
                 yield r
             else:
                 yield from r
+        return
+
+    with AutoCache(opts.cache, opts_key=opts.cache_key()) as cache:
+        seen: set[Path] = set()
+        todo: dict[Path, FileKey | None] = {}
+        for p in it:
+            seen.add(p)
+            try:
+                key = FileKey.make(p)
+            except OSError:
+                # possible due to unavoidable race conditions, will be handled during indexing
+                todo[p] = None
+                continue
+            cached = cache.get(p, key)
+            if cached is None:
+                todo[p] = key
+            else:
+                yield from cached
+
+        for p, r in _index_files(todo, opts):
+            if isinstance(r, Exception):
+                yield r
+                continue
+            fkey = todo[p]
+            if fkey is not None:
+                cache.put(p, fkey, r)
+            yield from r
+
+        if path.is_dir() and only is None:  # otherwise haven't seen all files
+            cache.evict(path, seen=seen)
 
 
 Mime = str
@@ -304,30 +496,98 @@ def by_path(pp: Path) -> tuple[Ex | None, Mime | None]:
         return None, None
 
 
-def _index_file(pp: Path, opts: Options) -> Results:
+# these are decompressed into temporary files and indexed as usual
+_COMPRESSED = {'.xz', '.gz', '.bz2', '.zst'}
+_ARCHIVES = {'.zip'}
+# decompressed data is copied in chunks, so huge archives don't take the memory
+_COPY_CHUNK_SIZE = 1 << 20
+
+
+def _open_compressed(path: Path) -> io.BufferedIOBase:
+    suf = path.suffix.lower()
+    if suf == '.xz':
+        import lzma
+
+        return lzma.open(path, 'rb')
+    if suf == '.gz':
+        import gzip
+
+        return gzip.open(path, 'rb')
+    if suf == '.bz2':
+        import bz2
+
+        return bz2.open(path, 'rb')
+    assert suf == '.zst', path
+    try:
+        from compression import zstd  # type: ignore[import-not-found,unused-ignore]  # python 3.14+
+    except ModuleNotFoundError:
+        import zstandard  # type: ignore[import-not-found,unused-ignore]
+
+        return zstandard.open(path, 'rb')
+    return zstd.open(path, 'rb')
+
+
+def _iter_members(path: Path) -> Iterator[tuple[str, io.BufferedIOBase | IO[bytes], datetime | None]]:
+    """
+    Yields name, file object and modification time (if the archive keeps it) for each file in the archive/compressed file
+    """
+    if path.suffix.lower() == '.zip':
+        import zipfile
+
+        with zipfile.ZipFile(path) as zf:
+            for info in zf.infolist():
+                if info.is_dir():
+                    continue
+                # zip keeps local time without timezone
+                mtime = datetime(*info.date_time, tzinfo=get_system_tz())
+                with zf.open(info) as fo:
+                    yield info.filename, fo, mtime
+    else:
+        with _open_compressed(path) as fo:
+            # chop off suffix, so the downstream indexer can handle it
+            yield path.name[: -len(path.suffix)], fo, None
+
+
+def _index_archive(pp: Path, opts: Options) -> Results:
+    is_archive = pp.suffix.lower() in _ARCHIVES
+    try:
+        archive_mtime = file_mtime(pp)
+        with TemporaryDirectory(suffix='promnesia') as td:
+            tdir = Path(td)
+            for name, fo, member_mtime in _iter_members(pp):
+                # member names can be anything, so make sure it doesn't escape the temporary directory
+                parts = [p for p in PurePosixPath(name).parts if p not in ('/', '..')]
+                if len(parts) == 0:
+                    continue
+                rel = Path(*parts)
+                member = tdir / rel
+                member.parent.mkdir(parents=True, exist_ok=True)
+                try:
+                    with member.open('wb') as fb:
+                        shutil.copyfileobj(fo, fb, _COPY_CHUNK_SIZE)
+                    # indexers use file mtime as visit time if there is nothing better, so it shouldn't be just 'now'
+                    ts = (archive_mtime if member_mtime is None else member_mtime).timestamp()
+                    os.utime(member, (ts, ts))
+                    # show locators relative to the original file, temporary file won't exist anyway
+                    shown_as = pp / rel if is_archive else pp
+                    yield from _index_file(member, opts=opts, shown_as=shown_as)
+                finally:
+                    # remove straightaway, otherwise huge archives might take all the space in tmp
+                    member.unlink(missing_ok=True)
+    except Exception as e:
+        # e.g. corrupted archive or missing zstandard module
+        yield echain(RuntimeError(f'While indexing {pp}'), e)
+
+
+def _index_file(pp: Path, opts: Options, *, shown_as: Path | None = None) -> Results:
     logger = get_logger()
     # TODO need to keep debug logs here...
     # logger.info(f"indexing {pp}")
-    # TODO use kompress?
-    # TODO not even sure if it's used...
     suf = pp.suffix.lower()
 
-    if suf == '.xz':  # TODO zstd?
-        import lzma
-
-        uname = pp.name[: -len('.xz')]  # chop off suffix, so the downstream indexer can handle it
-
-        assert pp.is_absolute(), pp
-        # make sure to keep hierarchy, otherwise might end up with some name conflicts if filenames clash
-        uncomp = Path(get_tmpdir().name) / Path(*pp.parts[1:-1]) / uname
-        uncomp.parent.mkdir(parents=True, exist_ok=True)
-        # todo would dump_file = wdir / Path(*cleaned_db.parts[1:])  # cut off '/' and use relative path
-        with lzma.open(pp, 'rb') as cf:
-            with uncomp.open('wb') as fb:
-                fb.write(cf.read())
-        # TODO maybe keep the original name?
-        # currently it would end up with something like /tmp/tmpxpgx1jy2promnesia/reddit-20190401231025.json
-        yield from _index(path=uncomp, opts=opts)
+    if suf in _COMPRESSED or suf in _ARCHIVES:
+        # NOTE: no point caching temporary files, the archive itself is cached anyway
+        yield from _index_archive(pp, opts=opts)
         return
 
     ex = RuntimeError(f'While indexing {pp}')
@@ -370,6 +630,13 @@ def _index_file(pp: Path, opts: Options) -> Results:
             v = r
 
         loc = v.locator
+        if loc is not None and shown_as is not None:  # type: ignore[redundant-expr]
+            loc = loc._replace(
+                title=loc.title.replace(str(pp), str(shown_as)),
+                href=None if loc.href is None else loc.href.replace(str(pp), str(shown_as)),
+                path=str(shown_as),
+            )
+            v = v._replace(locator=loc)
         # FIXME double checke that v.locator indeed can't be none and remove the check?
         if loc is not None and root is not None:  # type: ignore[redundant-expr]
             # meh. but it works
@@ -0,0 +1,124 @@
+"""
+Per-file cache for the auto indexer, so unchanged files don't have to be parsed again on every run.
+
+Results are keyed by resolved path, mtime and size of the file, and the cache version.
+Files with extraction errors aren't cached, so they are retried next time.
+"""
+
+from __future__ import annotations
+
+import pickle
+import sqlite3
+from pathlib import Path
+from typing import NamedTuple, Self
+
+from promnesia.common import Result, _promnesia_version, logger
+
+# bump if extractors change in a way that affects the results
+# (also the cache is invalidated on every promnesia version change)
+_CACHE_VERSION = 3
+
+# wait a bit if the cache is used concurrently (e.g. by several auto sources indexed in parallel)
+_TIMEOUT_SECONDS = 60
+# commit now and then so the database isn't locked for the whole indexing
+_COMMIT_EVERY = 100
+
+
+class FileKey(NamedTuple):
+    mtime_ns: int
+    size: int
+
+    @classmethod
+    def make(cls, path: Path) -> FileKey:
+        st = path.stat()
+        return cls(mtime_ns=st.st_mtime_ns, size=st.st_size)
+
+
+class AutoCache:
+    """
+    :param opts_key: everything apart from the file itself that affects extraction results (e.g. the replacer)
+    """
+
+    def __init__(self, db: Path, *, opts_key: str) -> None:
+        self.db = db
+        self.opts_key = opts_key
+        self.version = f'{_CACHE_VERSION}:{_promnesia_version()}'
+        self.conn: sqlite3.Connection | None = None
+        self.hits = 0
+        self.misses = 0
+        self.pending = 0
+
+    def __enter__(self) -> Self:
+        self.db.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(self.db, timeout=_TIMEOUT_SECONDS)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS files (
+            path     TEXT    NOT NULL,
+            opts     TEXT    NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            size     INTEGER NOT NULL,
+            version  TEXT    NOT NULL,
+            results  BLOB    NOT NULL,
+            PRIMARY KEY (path, opts)
+        )
+        ''')
+        conn.commit()
+        self.conn = conn
+        return self
+
+    def __exit__(self, *args) -> None:
+        assert self.conn is not None
+        try:
+            self.conn.commit()
+        finally:
+            self.conn.close()
+            self.conn = None
+        logger.debug('auto cache %s: %d hits, %d misses', self.db, self.hits, self.misses)
+
+    def get(self, path: Path, key: FileKey) -> list[Result] | None:
+        assert self.conn is not None
+        row = self.conn.execute(
+            'SELECT mtime_ns, size, version, results FROM files WHERE path = ? AND opts = ?',
+            (str(path), self.opts_key),
+        ).fetchone()
+        if row is None or FileKey(mtime_ns=row[0], size=row[1]) != key or row[2] != self.version:
+            self.misses += 1
+            return None
+        try:
+            res = pickle.loads(row[3])
+        except Exception as e:
+            # e.g. if some class was renamed.. just reindex the file
+            logger.debug('auto cache: failed to load results for %s: %s', path, e)
+            self.misses += 1
+            return None
+        self.hits += 1
+        return res
+
+    def put(self, path: Path, key: FileKey, results: list[Result]) -> None:
+        assert self.conn is not None
+        if any(isinstance(r, Exception) for r in results):
+            # worth retrying these, and exceptions don't pickle very well anyway (e.g. __cause__ is lost)
+            return
+        self.conn.execute(
+            'INSERT OR REPLACE INTO files (path, opts, mtime_ns, size, version, results) VALUES (?, ?, ?, ?, ?, ?)',
+            (str(path), self.opts_key, key.mtime_ns, key.size, self.version, pickle.dumps(results)),
+        )
+        self.pending += 1
+        if self.pending >= _COMMIT_EVERY:
+            self.conn.commit()
+            self.pending = 0
+
+    def evict(self, root: Path, *, seen: set[Path]) -> None:
+        """
+        Removes entries for files under root which weren't seen during indexing (e.g. deleted or ignored now)
+        """
+        assert self.conn is not None
+        stale = [
+            (p, opts)
+            for p, opts in self.conn.execute('SELECT path, opts FROM files WHERE opts = ?', (self.opts_key,))
+            if Path(p).is_relative_to(root) and Path(p) not in seen
+        ]
+        if len(stale) > 0:
+            logger.debug('auto cache: evicting %d entries under %s', len(stale), root)
+            self.conn.executemany('DELETE FROM files WHERE path = ? AND opts = ?', stale)
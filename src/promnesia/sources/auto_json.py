@@ -0,0 +1,229 @@
+"""
+Incremental JSON parsing for the auto indexer, so huge json files (e.g. takeout exports) aren't loaded in memory at once.
+
+Only strings are interesting for url extraction, so other values are just validated and skipped.
+If ijson is installed, it's used instead of the builtin parser, since it's considerably faster.
+"""
+
+from __future__ import annotations
+
+import re
+from collections.abc import Iterator
+from functools import lru_cache
+from json import JSONDecodeError
+from json.decoder import scanstring  # type: ignore[attr-defined]  # C accelerated, not in stubs
+from pathlib import Path
+from typing import IO, Any
+
+from promnesia.common import logger
+
+_CHUNK_SIZE = 1 << 16
+
+_WS_CHARS = ' \t\n\r'
+_WS_RE = re.compile(f'[{_WS_CHARS}]*')
+# anything up to the next delimiter, validated separately
+_SCALAR_RE = re.compile(r'[^\s,:\[\]{}"]+')
+# same as what json.loads accepts (including NaN/Infinity)
+_SCALAR_VALID_RE = re.compile(r'-?(?:0|[1-9]\d*)(?:\.\d+)?(?:[eE][-+]?\d+)?|true|false|null|NaN|-?Infinity')
+
+# parser states, i.e. what's expected next
+_VALUE = 0
+_VALUE_OR_END = 1  # right after '['
+_KEY = 2
+_KEY_OR_END = 3  # right after '{'
+_COLON = 4
+_COMMA_OR_END = 5
+_DONE = 6
+
+
+class _Reader:
+    def __init__(self, fo: IO[str], *, chunk_size: int) -> None:
+        self.fo = fo
+        self.chunk_size = chunk_size
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def more(self, at_least: int = 0) -> bool:
+        """
+        Reads more data in the buffer, dropping the consumed part. NOTE: pos is changed after that!
+        """
+        if self.eof:
+            return False
+        self.buf = self.buf[self.pos :]
+        self.pos = 0
+        data = self.fo.read(max(self.chunk_size, at_least))
+        if len(data) == 0:
+            self.eof = True
+            return False
+        self.buf += data
+        return True
+
+    def peek(self) -> str:
+        """
+        Skips whitespace and returns next character (empty string on EOF)
+        """
+        if self.pos < len(self.buf):
+            c = self.buf[self.pos]
+            if c not in _WS_CHARS:  # fast path, most of the time there is no whitespace between tokens
+                return c
+        while True:
+            self.pos = _WS_RE.match(self.buf, self.pos).end()  # type: ignore[union-attr]  # always matches
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.more():
+                return ''
+
+    def error(self, msg: str) -> JSONDecodeError:
+        return JSONDecodeError(msg, self.buf, self.pos)
+
+    def string(self) -> str:
+        while True:
+            try:
+                s, end = scanstring(self.buf, self.pos + 1)
+            except JSONDecodeError:
+                # string might be split between chunks.. read more and retry
+                # doubling the buffer, otherwise a huge string would be rescanned too many times
+                if not self.more(at_least=len(self.buf)):
+                    raise
+                continue
+            self.pos = end
+            return s
+
+    def scalar(self) -> None:
+        while True:
+            m = _SCALAR_RE.match(self.buf, self.pos)
+            if m is not None and m.end() == len(self.buf) and self.more():
+                continue  # might be split between chunks
+            if m is None or _SCALAR_VALID_RE.fullmatch(m.group()) is None:
+                raise self.error('Expecting value')
+            self.pos = m.end()
+            return
+
+
+Strings = Iterator[tuple[tuple[str, ...], str]]
+
+
+def iter_file_strings(path: Path) -> Strings:
+    """
+    Yields all strings in the json file (including object keys), along with their path in the document.
+    Path consists of object keys, and '[]' for array elements, same as in auto.collect_from.
+    """
+    ijson = _ijson()
+    if ijson is None:
+        with path.open() as fo:
+            yield from iter_strings(fo)
+    else:
+        with path.open('rb') as fo:
+            yield from _iter_strings_ijson(ijson, fo)
+
+
+@lru_cache(1)
+def _ijson() -> Any | None:
+    try:
+        import ijson  # type: ignore[import-not-found,import-untyped,unused-ignore]
+    except ModuleNotFoundError as e:
+        if e.name != 'ijson':
+            raise e
+        logger.debug(
+            'ijson is not installed, using builtin json parser for auto indexer (pip3 install --user ijson for faster parsing)'
+        )
+        return None
+    return ijson
+
+
+def _iter_strings_ijson(ijson, fo: IO[bytes]) -> Strings:
+    path: list[str] = []
+    for _prefix, event, value in ijson.parse(fo, use_float=True):
+        if event == 'string':
+            yield tuple(path), value
+        elif event == 'map_key':
+            path[-1] = value
+            yield tuple(path), value
+        elif event == 'start_map':
+            path.append('')  # placeholder for the key
+        elif event == 'start_array':
+            path.append('[]')
+        elif event in ('end_map', 'end_array'):
+            path.pop()
+
+
+def iter_strings(fo: IO[str], *, chunk_size: int = _CHUNK_SIZE) -> Strings:
+    """
+    Same as iter_file_strings, but using the builtin incremental parser.
+    """
+    r = _Reader(fo, chunk_size=chunk_size)
+    stack: list[str] = []  # '[' or '{' for each open container
+    path: list[str] = []
+    expect = _VALUE
+
+    def value_done() -> int:
+        if len(stack) == 0:
+            return _DONE
+        if stack[-1] == '{':
+            path.pop()  # key for this value
+        return _COMMA_OR_END
+
+    while True:
+        c = r.peek()
+        if c == '':
+            if expect != _DONE:
+                raise r.error('Unexpected end of data')
+            return
+
+        if expect == _DONE:
+            raise r.error('Extra data')
+        elif expect in (_VALUE, _VALUE_OR_END):
+            if c == ']' and expect == _VALUE_OR_END:
+                r.pos += 1
+                stack.pop()
+                path.pop()
+                expect = value_done()
+            elif c == '{':
+                r.pos += 1
+                stack.append(c)
+                expect = _KEY_OR_END
+            elif c == '[':
+                r.pos += 1
+                stack.append(c)
+                path.append('[]')
+                expect = _VALUE_OR_END
+            elif c == '"':
+                s = r.string()
+                yield tuple(path), s
+                expect = value_done()
+            else:
+                r.scalar()
+                expect = value_done()
+        elif expect in (_KEY, _KEY_OR_END):
+            if c == '}' and expect == _KEY_OR_END:
+                r.pos += 1
+                stack.pop()
+                expect = value_done()
+            elif c == '"':
+                k = r.string()
+                path.append(k)
+                yield tuple(path), k
+                expect = _COLON
+            else:
+                raise r.error('Expecting property name enclosed in double quotes')
+        elif expect == _COLON:
+            if c != ':':
+                raise r.error("Expecting ':' delimiter")
+            r.pos += 1
+            expect = _VALUE
+        else:
+            assert expect == _COMMA_OR_END, expect
+            r.pos += 1
+            if c == ',':
+                expect = _KEY if stack[-1] == '{' else _VALUE
+            elif c == '}' and stack[-1] == '{':
+                stack.pop()
+                expect = value_done()
+            elif c == ']' and stack[-1] == '[':
+                stack.pop()
+                path.pop()
+                expect = value_done()
+            else:
+                r.pos -= 1
+                raise r.error("Expecting ',' delimiter")
@@ -1,5 +1,6 @@
 from __future__ import annotations
 
+import shutil
 from functools import lru_cache
 from pathlib import Path
 
@@ -16,8 +17,6 @@ if _is_windows:
 
 @lru_cache
 def _has_grep() -> bool:
-    import shutil
-
     return shutil.which('grep') is not None
 
 
@@ -85,34 +84,35 @@ def _extract_from_file(path: str) -> Command:
     )
 
 
+# xzgrep decompresses on the fly, and handles other formats too (as long as the decompressor is installed)
+_COMPRESSED = {'.xz', '.gz', '.bz2', '.zst'}
+
+
+def _extract_from_compressed(path: str) -> Command:
+    if shutil.which('xzgrep') is None:
+        raise RuntimeError(f"xzgrep isn't available, can't index compressed file with plaintext indexer: {path}")
+    return [
+        'xzgrep',
+        # xzgrep rejects --exclude-dir, and it's pointless for a single file anyway
+        *(a for a in _GREP_ARGS if not a.startswith('--exclude-dir')),
+        '-E',
+        _URL_REGEX,
+        path,
+    ]
+
+
 def extract_from_path(path: PathIsh) -> Command:
     pp = Path(path)
 
     if pp.is_dir():  # TODO handle archives here???
         return _extract_from_dir(str(pp))
 
-    if any(
-        pp.suffix == ex
-        for ex in (
-            '.xz',
-            '.bz2',
-            '.gz',
-            '.zip',
-        )
-    ):
+    suf = pp.suffix.lower()
+    if suf == '.zip':
         # todo should be debug?
-        # or should delete it completely, feels like unpacking archives here is a bit too much
-        raise RuntimeError(f"Archives aren't supported yet: {path}")
-        # logger.info(f"Extracting from compressed file {path}")
-        # import lzma
-        # from tempfile import NamedTemporaryFile
-        # # TODO hopefully, no collisions
-        # import os.path
-        # fname = os.path.join(tdir.name, os.path.basename(path))
-        # with open(fname, 'wb') as fo:
-        #     with lzma.open(path, 'r') as cf:
-        #         fo.write(cf.read())
-        #     return _extract_from_file(fname)
+        raise RuntimeError(f"Zip archives aren't supported by plaintext indexer, use auto indexer instead: {path}")
+    if suf in _COMPRESSED:
+        return _extract_from_compressed(str(pp))
 
     r = _extract_from_file(str(pp))
     return r
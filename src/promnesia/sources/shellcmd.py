@@ -83,7 +83,7 @@ def index(command: str | Sequence[PathIsh]) -> Results:
 
     r = run(cmd, stdout=PIPE, check=False)
     if r.returncode > 0:
-        if not (cmd[0] in {'grep', 'findstr'} and r.returncode == 1):  # ugh. grep returns 1 on no matches...
+        if not (cmd[0] in {'grep', 'xzgrep', 'findstr'} and r.returncode == 1):  # ugh. grep returns 1 on no matches...
             r.check_returncode()
     output = r.stdout
     assert output is not None
@@ -39,7 +39,12 @@ class Backend:
 
 
 @contextmanager
-def run_server(db: PathIsh | None = None, *, timezone: str | None = None) -> Iterator[Backend]:
+def run_server(
+    db: PathIsh | None = None,
+    *,
+    timezone: str | None = None,
+    workers: int | None = None,
+) -> Iterator[Backend]:
     # TODO not sure, perhaps best to use a thread or something?
     # but for some tests makes more sense to test in a separate process
     with free_port() as pp:
@@ -54,6 +59,7 @@ def run_server(db: PathIsh | None = None, *, timezone: str | None = None) -> Ite
             '--port', port,
             *([] if timezone is None else ['--timezone', timezone]),
             *([] if db_ is None else ['--db', db_]),
+            *([] if workers is None else ['--workers', str(workers)]),
         ]  # fmt: skip
         with tmp_popen(promnesia_bin(*args)) as server_process:
             server = Backend(host=host, port=port, db=db_, process=server_process)
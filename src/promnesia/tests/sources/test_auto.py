@@ -1,8 +1,18 @@
+import io
+import json
 import os
+import tracemalloc
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
 from itertools import groupby
+from pathlib import Path
 
-from ...sources import auto
-from ..common import get_testdata, throw
+import pytest
+
+from ... import config
+from ...common import get_system_tz
+from ...sources import auto, auto_json
+from ..common import get_testdata, throw, write_config
 
 sa2464 = 'https://www.scottaaronson.com/blog/?p=2464'
 
@@ -36,6 +46,86 @@ def test_json() -> None:
     # TODO line number?
 
 
+_JSON_DOCS = [
+    '"https://example.com"',
+    '[]',
+    '{}',
+    '[1, -2.5e10, true, false, null, "x", {}, [[]]]',
+    '{"https://key.com": "value https://value.com", "nested": {"list": [{"a": "https://a.com"}, "https://b.com"]}}',
+    '{"escapes \\"\\\\ \\u00e9 \\ud83d\\ude00": ["https://example.com/\\u00e9 text\\nhttps://other.com"]}',
+    '  { "spaces" :\n [ "https://x.org" , 123 ] }  ',
+]
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 7, 1000])
+def test_json_streaming(chunk_size: int) -> None:
+    for doc in _JSON_DOCS:
+        expected = list(auto.collect_from(json.loads(doc)))
+        got = [
+            auto.EUrl(url=u, ctx=ctx)
+            for ctx, s in auto_json.iter_strings(io.StringIO(doc), chunk_size=chunk_size)
+            for u in auto.extract_urls(s)
+        ]
+        assert got == expected, doc
+
+    for bad in ['', '{', '[1,]', '{"a" 1}', '[1 2]', '"abc', '[tru]', '{"a": 1} x', '[01]', '{,}', '[}']:
+        with pytest.raises(json.JSONDecodeError):
+            list(auto_json.iter_strings(io.StringIO(bad), chunk_size=chunk_size))
+
+
+def test_json_streaming_ijson() -> None:
+    ijson = pytest.importorskip('ijson')
+    for doc in _JSON_DOCS:
+        expected = list(auto_json.iter_strings(io.StringIO(doc)))
+        assert list(auto_json._iter_strings_ijson(ijson, io.BytesIO(doc.encode('utf8')))) == expected, doc
+
+
+def test_json_streaming_memory() -> None:
+    class Items:
+        # generates a huge json list on the fly, without keeping it in memory
+        def __init__(self, count: int) -> None:
+            self.left = count
+            self.started = False
+
+        def read(self, _size: int) -> str:
+            if not self.started:
+                self.started = True
+                return '['
+            if self.left == 0:
+                return ''
+            self.left -= 1
+            return f'{{"url": "https://example.com/{self.left}", "n": {self.left}}}' + (',' if self.left > 0 else ']')
+
+    count = 100_000  # about 5Mb of json
+    tracemalloc.start()
+    try:
+        strings = auto_json.iter_strings(Items(count), chunk_size=1024)  # type: ignore[arg-type]
+        total = sum(1 for _ in strings)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert total == count * 3  # two keys and url
+    assert peak < 100_000
+
+
+def test_csv(tmp_path: Path) -> None:
+    path = tmp_path / 'links.csv'
+    path.write_text(
+        'title,url\n'
+        'first,https://example.com/1\n'
+        '\n'
+        '"quoted, https://quoted.com",https://example.com/2,https://extra.com\n'
+        'short\n'
+    )
+    urls = list(auto._csv(path))
+    assert urls == [
+        auto.EUrl(url='https://example.com/1', ctx=('url',)),
+        auto.EUrl(url='https://quoted.com', ctx=('title',)),
+        auto.EUrl(url='https://example.com/2', ctx=('url',)),
+        auto.EUrl(url='https://extra.com', ctx=()),
+    ]
+
+
 def test_auto() -> None:
     mm = makemap(auto.index(get_testdata('auto')))
     org_link = 'https://www.youtube.com/watch?v=rHIkrotSwcc'
@@ -51,6 +141,126 @@ def test_auto() -> None:
     assert "I've enjoyed [Chandler Carruth's" in v.context
 
 
+def test_auto_pool(monkeypatch) -> None:
+    expected = makemap(auto.index(get_testdata('auto')))
+
+    monkeypatch.setenv('PROMNESIA_CORES', '2')
+    auto._get_pool.cache_clear()
+    # results come in completion order, but should be the same otherwise
+    assert makemap(auto.index(get_testdata('auto'))) == expected
+    assert makemap(auto.index(get_testdata('obsidian-vault'), get_testdata('auto'))).keys() >= expected.keys()
+    # pool should be reused between calls
+    assert auto._get_pool.cache_info().misses == 1
+
+
+def test_auto_pool_broken(monkeypatch) -> None:
+    expected = makemap(auto.index(get_testdata('auto')))
+
+    monkeypatch.setenv('PROMNESIA_CORES', '2')
+    auto._get_pool.cache_clear()
+
+    index_file_aux = auto._index_file_aux
+
+    def crashing_index_file_aux(path: Path, opts):
+        if path.name == 'pocket.json':
+            os._exit(1)  # simulate worker killed, e.g. by OOM killer
+        return index_file_aux(path, opts)
+
+    with monkeypatch.context() as m:
+        m.setattr(auto, '_index_file_aux', crashing_index_file_aux)  # workers are forked, so they pick it up
+        results = list(auto.index(get_testdata('auto')))
+    # chunks in the broken pool are reported as errors rather than crashing the whole indexer
+    errors = [r for r in results if isinstance(r, Exception)]
+    assert len(errors) > 0
+    assert all(isinstance(e, BrokenProcessPool) for e in errors)
+
+    # and next time a new pool is started
+    assert makemap(auto.index(get_testdata('auto'))) == expected
+
+
+def test_schedule(tmp_path: Path) -> None:
+    sizes = {'small1': 10, 'huge': 5_000_000, 'small2': 20, 'big': 800_000, 'medium': 300_000}
+    for name, size in sizes.items():
+        (tmp_path / name).write_bytes(b'x' * size)
+    paths = [tmp_path / name for name in sizes]
+
+    chunks = [[p.name for p in chunk] for chunk in auto._schedule(paths)]
+    # largest first, and big files don't share the chunk with others
+    assert chunks == [['huge'], ['big', 'medium'], ['small2', 'small1']]
+
+
+@pytest.mark.parametrize('suffix', ['.xz', '.gz', '.bz2', '.zst', '.zip'])
+def test_compressed(tmp_path: Path, suffix: str) -> None:
+    import bz2
+    import gzip
+    import lzma
+    import zipfile
+
+    json_data = (get_testdata('auto') / 'pocket.json').read_bytes()
+    text_data = b'line\nsee https://example.com/compressed\n'
+
+    if suffix == '.zip':
+        path = tmp_path / 'archive.zip'
+        with zipfile.ZipFile(path, 'w') as zf:
+            zf.writestr('pocket.json', json_data)
+            zf.writestr('nested/notes.txt', text_data)
+            zf.writestr('../escape.txt', text_data)
+    else:
+        if suffix == '.zst':
+            zstandard = pytest.importorskip('zstandard')
+            compress = zstandard.compress
+        else:
+            compress = {'.xz': lzma.compress, '.gz': gzip.compress, '.bz2': bz2.compress}[suffix]
+        path = tmp_path / ('pocket.json' + suffix)
+        path.write_bytes(compress(json_data))
+
+    mm = makemap(auto.index(path))
+    assert _JSON_URLS.issubset(mm.keys())
+    [v1, _v2] = mm[sa2464]
+    assert v1.context == 'list::yyy::given_url'
+    if suffix == '.zip':
+        assert v1.locator.title == str(path / 'pocket.json')
+
+        titles = {v.locator.title for v in mm['https://example.com/compressed']}
+        assert titles == {str(path / 'escape.txt') + ':2', str(path / 'nested' / 'notes.txt') + ':2'}
+        assert not (tmp_path / 'escape.txt').exists()
+    else:
+        assert v1.locator.title == str(path)
+
+
+@pytest.mark.parametrize('suffix', ['.gz', '.zip'])
+def test_compressed_mtime(tmp_path: Path, suffix: str) -> None:
+    import gzip
+    import zipfile
+
+    text_data = b'see https://example.com/compressed\n'
+    archive_dt = datetime(2001, 2, 3, 4, 5, 6, tzinfo=get_system_tz())
+    if suffix == '.zip':
+        path = tmp_path / 'archive.zip'
+        with zipfile.ZipFile(path, 'w') as zf:
+            # members keep their own mtime
+            zf.writestr(zipfile.ZipInfo('notes.txt', date_time=(2000, 1, 2, 3, 4, 6)), text_data)
+        expected_dt = datetime(2000, 1, 2, 3, 4, 6, tzinfo=get_system_tz())
+    else:
+        path = tmp_path / ('notes.txt' + suffix)
+        path.write_bytes(gzip.compress(text_data))
+        expected_dt = archive_dt
+    ts = archive_dt.timestamp()
+    os.utime(path, (ts, ts))
+
+    # shouldn't use mtime of the temporary file the member is extracted to
+    [v] = makemap(auto.index(path))['https://example.com/compressed']
+    assert v.dt == expected_dt
+
+
+def test_compressed_errors(tmp_path: Path) -> None:
+    path = tmp_path / 'broken.json.gz'
+    path.write_bytes(b'definitely not gzip')
+    [err] = list(auto.index(path))
+    assert isinstance(err, Exception)
+    assert str(path) in str(err)
+
+
 def test_obsidian() -> None:
     mm = makemap(auto.index(get_testdata('obsidian-vault')))
     example_url = 'https://example.com'
@@ -63,3 +273,64 @@ def test_logseq() -> None:
     example_url = 'https://example.com'
     [v] = mm[example_url]
     assert v.locator.href.startswith('logseq://')
+
+
+def test_cache(tmp_path: Path, monkeypatch) -> None:
+    def cfg(cache_dir: str) -> None:
+        CACHE_DIR = cache_dir  # noqa: F841
+
+    notes = tmp_path / 'notes'
+    notes.mkdir()
+    (notes / 'a.txt').write_text('https://a.com')
+    (notes / 'b.org').write_text('* https://b.com')
+    (notes / 'c.org').write_text('* https://c.com')
+
+    cfg_path = tmp_path / 'config.py'
+    write_config(cfg_path, cfg, cache_dir=tmp_path / 'cache')
+    config.load_from(cfg_path)
+
+    indexed: list[str] = []
+    index_file_aux = auto._index_file_aux
+
+    def _index_file_aux(path: Path, opts: auto.Options):
+        indexed.append(path.name)
+        return index_file_aux(path, opts)
+
+    monkeypatch.setattr(auto, '_index_file_aux', _index_file_aux)
+
+    def urls(**kwargs) -> set[str]:
+        return {v.url for v in auto.index(notes, **kwargs) if not isinstance(v, Exception)}
+
+    try:
+        assert urls() == {'https://a.com', 'https://b.com', 'https://c.com'}
+        assert sorted(indexed) == ['a.txt', 'b.org', 'c.org']
+        assert (tmp_path / 'cache' / 'auto.sqlite').exists()
+
+        indexed.clear()
+        assert urls() == {'https://a.com', 'https://b.com', 'https://c.com'}
+        assert indexed == []  # served from cache
+
+        (notes / 'a.txt').write_text('https://a.com https://aa.com')
+        (notes / 'c.org').unlink()
+        assert urls() == {'https://a.com', 'https://aa.com', 'https://b.com'}
+        assert indexed == ['a.txt']
+
+        # should work the same way with the process pool
+        with monkeypatch.context() as m:
+            m.setattr(auto, '_index_file_aux', index_file_aux)  # local function can't be pickled
+            m.setenv('PROMNESIA_CORES', '2')
+            (notes / 'b.org').write_text('* https://bb.com')
+            assert urls() == {'https://a.com', 'https://aa.com', 'https://bb.com'}
+
+        indexed.clear()
+        assert urls(cache=False) == {'https://a.com', 'https://aa.com', 'https://bb.com'}
+        assert sorted(indexed) == ['a.txt', 'b.org']
+    finally:
+        config.reset()
+
+    # files that are gone should be evicted from the cache
+    from ...sqlite import sqlite_connection
+
+    with sqlite_connection(tmp_path / 'cache' / 'auto.sqlite') as conn:
+        cached = {Path(p).name for (p,) in conn.execute('SELECT path FROM files')}
+    assert cached == {'a.txt', 'b.org'}
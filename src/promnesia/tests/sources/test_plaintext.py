@@ -1,3 +1,9 @@
+import gzip
+import shutil
+from pathlib import Path
+
+import pytest
+
 from ...common import Source
 from ...extract import extract_visits
 from ...sources import plaintext, shellcmd
@@ -25,3 +31,18 @@ def test_plaintext_path_extractor() -> None:
     [wa] = [v for v in visits if unwrap(v).orig_url == 'http://what.about.this.link']
     f2 = get_testdata('custom') / 'file2.txt'
     assert unwrap(wa).locator.href == f'editor://{f2}:3'  # occurs line 3
+
+
+@pytest.mark.skipif(shutil.which('xzgrep') is None, reason='needs xzgrep')
+def test_plaintext_compressed(tmp_path: Path) -> None:
+    path = tmp_path / 'file.txt.gz'
+    path.write_bytes(gzip.compress(b'first line\nand the link: https://example.com/compressed\n'))
+    visits = list(
+        extract_visits(
+            Source(shellcmd.index, plaintext.extract_from_path(path)),
+            src='whatever',
+        )
+    )
+    [v] = [unwrap(v) for v in visits]
+    assert v.orig_url == 'https://example.com/compressed'
+    assert v.locator.href == f'editor://{path}:2'
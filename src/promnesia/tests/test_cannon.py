@@ -1,8 +1,16 @@
+import os
+import random
+import time
+import tracemalloc
 from typing import cast
 
 import pytest
 
-from ..cannon import CanonifyException, canonify
+from ..cannon import CanonifyException, Spec, canonify, canonify_many, get_spec
+from .common import (
+    gc_control,  # noqa: F401
+    running_on_ci,
+)
 
 # TODO should actually understand 'sequences'?
 # e.g.
@@ -340,3 +348,176 @@ def test_empty_query_parameter(url, expected):
 )
 def test_qkeep_true(url, expected):
     assert canonify(url) == expected
+
+
+def test_get_spec() -> None:
+    assert get_spec('en.wikipedia.org').fkeep
+    assert get_spec('wikipedia.org').fkeep
+    assert get_spec('play.google.com').qkeep == {'id'}
+    assert get_spec('google.com') == Spec()
+    assert get_spec('news.ycombinator.com').keep_query('id') is not None
+    assert get_spec('news.ycombinator.com').keep_query('utm_source') is None
+    assert get_spec('') == Spec()
+
+
+def test_canonify_many() -> None:
+    urls = [
+        'https://www.youtube.com/watch?v=1NHbPN9pNPM&feature=share',
+        'https://youtu.be/1NHbPN9pNPM',
+        'https://example.com/page',
+        'https://www.youtube.com/watch?v=1NHbPN9pNPM&feature=share',
+    ]
+    assert canonify_many(urls) == [canonify(u) for u in urls]
+    assert canonify_many(urls) == [
+        'youtube.com/watch?v=1NHbPN9pNPM',
+        'youtube.com/watch?v=1NHbPN9pNPM',
+        'example.com/page',
+        'youtube.com/watch?v=1NHbPN9pNPM',
+    ]
+    assert canonify_many([]) == []
+
+    with pytest.raises(CanonifyException):
+        canonify_many([*urls, 'https://example.com＃@bing.com'])
+
+
+def synthetic_urls(count: int, *, seed: int = 0) -> list[str]:
+    """
+    Generates a url mix resembling browser history: mostly popular sites, tracking query parameters,
+    percent-encoded paths, archive.org wrappers, and lots of repeating urls.
+    """
+    rnd = random.Random(seed)
+
+    def ident(n: int = 11) -> str:
+        return ''.join(rnd.choices('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789-_', k=n))
+
+    def utm() -> str:
+        params = [
+            f'utm_source={ident(6)}',
+            f'utm_medium={ident(5)}',
+            f'utm_campaign={ident(20)}',
+            f'fbclid={ident(40)}',
+        ]
+        return '&'.join(rnd.sample(params, k=rnd.randint(1, len(params))))
+
+    def youtube() -> str:
+        v = ident()
+        return rnd.choice(
+            [
+                f'https://www.youtube.com/watch?v={v}',
+                f'https://www.youtube.com/watch?v={v}&t={rnd.randint(1, 999)}s&list={ident(34)}&index={rnd.randint(1, 50)}',
+                f'https://m.youtube.com/watch?feature=share&v={v}',
+                f'https://youtu.be/{v}',
+            ]
+        )
+
+    def twitter() -> str:
+        user = ident(8)
+        return rnd.choice(
+            [
+                f'https://twitter.com/{user}/status/{rnd.randint(10**17, 10**19)}',
+                f'https://mobile.twitter.com/{user}/status/{rnd.randint(10**17, 10**19)}?s=20&{utm()}',
+                f'https://twitter.com/{user}',
+                'https://twitter.com/home',
+            ]
+        )
+
+    def reddit() -> str:
+        sub = ident(8)
+        return rnd.choice(
+            [
+                f'https://www.reddit.com/r/{sub}/comments/{ident(6)}/{ident(30)}/',
+                f'https://old.reddit.com/r/{sub}/comments/{ident(6)}/{ident(30)}/{ident(7)}/?context=3',
+                f'https://www.reddit.com/r/{sub}/',
+            ]
+        )
+
+    def encoded() -> str:
+        title = '_'.join(ident(rnd.randint(3, 10)) for _ in range(rnd.randint(1, 4)))
+        return rnd.choice(
+            [
+                f'https://en.wikipedia.org/wiki/{title}_%28disambiguation%29#{ident(5)}',
+                f'https://launchpad.net/ubuntu/%2Bsource/{ident(8)}',
+                f'https://github.com/{ident(8)}/{ident(10)}/blob/master/{title}.md?{utm()}',
+                f'https://news.ycombinator.com/item?id={rnd.randint(1, 10**8)}',
+                f'https://www.google.com/search?q={title}+%22quoted%22&hl=en&{utm()}',
+            ]
+        )
+
+    def other() -> str:
+        domain = f'{ident(rnd.randint(4, 12)).lower()}.{rnd.choice(["com", "org", "net", "co.uk", "io"])}'
+        path = '/'.join(ident(rnd.randint(3, 12)) for _ in range(rnd.randint(0, 5)))
+        return f'{rnd.choice(["http", "https"])}://{rnd.choice(["", "www."])}{domain}/{path}?{utm()}'
+
+    def archived() -> str:
+        return f'https://web.archive.org/web/{rnd.randint(2005, 2025)}0101000000/{unique()}'
+
+    gens = [youtube, twitter, reddit, encoded, other, archived]
+    weights = [20, 15, 15, 20, 28, 2]
+
+    def unique() -> str:
+        [gen] = rnd.choices(gens, weights=weights)
+        return gen()
+
+    # roughly every third visit is to some page which was already visited
+    res: list[str] = []
+    for _ in range(count):
+        if len(res) > 0 and rnd.random() < 0.3:
+            res.append(res[min(int(rnd.expovariate(1 / 100)), len(res) - 1)])
+        else:
+            res.append(unique())
+    return res
+
+
+# throughput depends on the machine, so the baseline (urls/sec for synthetic_urls) has to be measured on the same one
+# e.g. see benchmarks/20261018.org, ~39K urls/sec in a sandboxed VM, python3.12
+# the test fails if throughput drops considerably below, so make sure to update when canonify changes intentionally
+_BENCHMARK_BASELINE_ENV = 'PROMNESIA_CANONIFY_BASELINE'
+_BENCHMARK_TOLERANCE = 0.5
+
+
+def _benchmark_baseline() -> float | None:
+    baseline = os.environ.get(_BENCHMARK_BASELINE_ENV)
+    return None if baseline is None else float(baseline)
+
+
+@pytest.mark.parametrize('count', [10_000, 100_000, 1_000_000])
+@pytest.mark.parametrize('gc_on', [True, False], ids=['gc_on', 'gc_off'])
+def test_benchmark_canonify(count: int, gc_control) -> None:
+    if count > 10_000 and running_on_ci:
+        pytest.skip("test would be too slow on CI, only meant to run manually")
+
+    urls = synthetic_urls(count)
+
+    # make sure results cached by other tests don't affect the benchmark
+    canonify.cache_clear()
+    before = time.perf_counter()
+    for url in urls:
+        canonify(url)
+    took = time.perf_counter() - before
+    canonify.cache_clear()
+
+    # measuring allocations on a subset, since tracemalloc slows things down a lot
+    sample = urls[:10_000]
+    tracemalloc.start()
+    try:
+        for url in sample:
+            canonify(url)
+        _current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    canonify.cache_clear()
+
+    urls_per_sec = count / took
+    print(
+        f'\ncanonify: {count} urls in {took:.2f}s, {urls_per_sec:.0f} urls/sec, peak memory {peak / len(sample):.0f} bytes/url'
+    )
+
+    if running_on_ci:
+        # throughput on CI machines is too noisy to compare against the baseline
+        return
+    baseline = _benchmark_baseline()
+    if baseline is None:
+        return
+    assert urls_per_sec > baseline * _BENCHMARK_TOLERANCE, (
+        f'throughput regressed: {urls_per_sec:.0f} urls/sec, baseline {baseline:.0f} urls/sec'
+    )
@@ -1,5 +1,7 @@
 from __future__ import annotations
 
+import os
+from collections.abc import Iterator
 from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta, timezone
 from pathlib import Path
@@ -13,7 +15,7 @@ from hypothesis import given, settings
 from hypothesis.strategies import from_type
 
 from ..common import Loc
-from ..database.common import DbVisit
+from ..database.common import DbVisit, fts_drop, fts_query
 from ..database.dump import visits_to_sqlite
 from ..database.load import get_all_db_visits
 from ..sqlite import sqlite_connection
@@ -71,11 +73,15 @@ def test_one_visit(tmp_path: Path) -> None:
     with sqlite_connection(db, row_factory='dict') as conn:
         [sqlite_visit] = conn.execute('SELECT * FROM visits')
 
+    assert isinstance(sqlite_visit.pop('visit_hash'), int)
+    assert sqlite_visit.pop('id') == 1
     assert sqlite_visit == {
         'context': None,
         'dt': '2023-11-14T23:11:01+01:00',
+        'dt_epoch': int(datetime.fromisoformat('2023-11-14T22:11:01+00:00').timestamp()),
         'duration': 123,
         'locator_href': 'https://whatever.com',
+        'locator_path': None,
         'locator_title': 'title',
         'norm_url': 'google.com',
         'orig_url': 'https://google.com',
@@ -86,6 +92,241 @@ def test_one_visit(tmp_path: Path) -> None:
     assert visits_in_db == [visit]
 
 
+def test_url_summary(tmp_path: Path) -> None:
+    dt = datetime.fromisoformat('2023-11-14T23:11:01+01:00')
+
+    def visit(url: str, *, src: str, context: str | None = None) -> DbVisit:
+        return DbVisit(
+            norm_url=url,
+            orig_url='https://' + url,
+            dt=dt,
+            locator=Loc.make(title='title'),
+            src=src,
+            context=context,
+        )
+
+    db = tmp_path / 'db.sqlite'
+    errors = visits_to_sqlite(
+        vit=[
+            visit('reddit.com', src='first'),
+            visit('reddit.com', src='first', context='some context'),
+            visit('reddit.com', src='first'),
+            visit('google.com', src='first'),
+        ],
+        overwrite_db=True,
+        _db_path=db,
+    )
+    assert len(errors) == 0, errors
+
+    def summary() -> dict[str, str | None]:
+        with sqlite_connection(db) as conn:
+            return dict(conn.execute('SELECT norm_url, context FROM url_summary'))
+
+    # visit with context should be picked over the ones without
+    assert summary() == {'reddit.com': 'some context', 'google.com': None}
+
+    # update indexing for a different source should keep the summary in sync with all the visits
+    errors = visits_to_sqlite(
+        vit=[visit('google.com', src='second', context='other context'), visit('github.com', src='second')],
+        overwrite_db=False,
+        _db_path=db,
+    )
+    assert len(errors) == 0, errors
+    assert summary() == {'reddit.com': 'some context', 'google.com': 'other context', 'github.com': None}
+
+
+def test_diff_writes(tmp_path: Path) -> None:
+    def visit(i: int, *, src: str = 'first', context: str | None = None) -> DbVisit:
+        return DbVisit(
+            norm_url=f'reddit.com/{i}',
+            orig_url=f'https://reddit.com/{i}',
+            dt=_dt_aware,
+            locator=Loc.make(title='title'),
+            src=src,
+            context=context,
+        )
+
+    db = tmp_path / 'db.sqlite'
+
+    def rows() -> dict[int, tuple[str, str, str | None]]:
+        with sqlite_connection(db) as conn:
+            query = 'SELECT rowid, src, norm_url, context FROM visits'
+            return {rowid: (src, url, ctx) for rowid, src, url, ctx in conn.execute(query)}
+
+    def summary() -> dict[str, str | None]:
+        with sqlite_connection(db) as conn:
+            return dict(conn.execute('SELECT norm_url, context FROM url_summary'))
+
+    visits_to_sqlite([visit(i) for i in range(5)], overwrite_db=False, _db_path=db)
+    visits_to_sqlite([visit(0, src='second')], overwrite_db=False, _db_path=db)
+    before = rows()
+    assert len(before) == 6
+
+    # reindexing the same visits shouldn't touch the rows at all
+    visits_to_sqlite([visit(i) for i in range(5)], overwrite_db=False, _db_path=db)
+    assert rows() == before
+
+    # only changed visits are deleted/inserted, the rest are kept
+    visits_to_sqlite(
+        [visit(0), visit(1, context='updated'), visit(3), visit(4), visit(5)],
+        overwrite_db=False,
+        _db_path=db,
+    )
+    after = rows()
+    kept = {rowid: row for rowid, row in before.items() if row[1] in {'reddit.com/0', 'reddit.com/3', 'reddit.com/4'}}
+    assert len(kept) == 4  # including the visit from the other source
+    assert {rowid: row for rowid, row in after.items() if rowid in kept} == kept
+    assert sorted(row for rowid, row in after.items() if rowid not in kept) == [
+        ('first', 'reddit.com/1', 'updated'),
+        ('first', 'reddit.com/5', None),
+    ]
+    assert summary() == {
+        'reddit.com/0': None,
+        'reddit.com/1': 'updated',
+        'reddit.com/3': None,
+        'reddit.com/4': None,
+        'reddit.com/5': None,
+    }
+
+
+def test_diff_writes_duplicates(tmp_path: Path) -> None:
+    def visit(i: int) -> DbVisit:
+        return DbVisit(
+            norm_url=f'reddit.com/{i}',
+            orig_url=f'https://reddit.com/{i}',
+            dt=_dt_aware,
+            locator=Loc.make(title='title'),
+            src='first',
+        )
+
+    db = tmp_path / 'db.sqlite'
+
+    def urls() -> list[str]:
+        with sqlite_connection(db) as conn:
+            return sorted(u for (u,) in conn.execute('SELECT norm_url FROM visits'))
+
+    def overwritten(visits: list[DbVisit]) -> list[str]:
+        with TemporaryDirectory() as td:
+            odb = Path(td) / 'db.sqlite'
+            visits_to_sqlite(visits, overwrite_db=True, _db_path=odb)
+            with sqlite_connection(odb) as conn:
+                return sorted(u for (u,) in conn.execute('SELECT norm_url FROM visits'))
+
+    # exact duplicates should be kept as many times as the source emits them, same as with overwrite
+    for visits in [
+        [visit(0), visit(1)],
+        [visit(0), visit(0), visit(1)],
+        [visit(0), visit(0), visit(0), visit(1), visit(1)],
+        [visit(0), visit(1)],
+        [visit(1), visit(1)],
+    ]:
+        visits_to_sqlite(visits, overwrite_db=False, _db_path=db)
+        assert urls() == overwritten(visits)
+    assert urls() == ['reddit.com/1', 'reddit.com/1']
+
+
+def test_fts(tmp_path: Path) -> None:
+    def visit(i: int, *, src: str) -> DbVisit:
+        return DbVisit(
+            norm_url=f'reddit.com/r/{src}{i}',
+            orig_url=f'https://reddit.com/r/{src}{i}',
+            dt=_dt_aware,
+            locator=Loc.make(title=f'Saved from {src}'),
+            src=src,
+            context=f'comment {i}',
+        )
+
+    db = tmp_path / 'db.sqlite'
+
+    def search(q: str) -> set[str]:
+        with sqlite_connection(db) as conn:
+            query = 'SELECT norm_url FROM visits WHERE rowid IN (SELECT rowid FROM visits_fts WHERE visits_fts MATCH ?)'
+            return {u for (u,) in conn.execute(query, (fts_query(q),))}
+
+    visits_to_sqlite([visit(i, src='first') for i in range(3)], overwrite_db=True, _db_path=db)
+    visits_to_sqlite([visit(i, src='second') for i in range(3)], overwrite_db=False, _db_path=db)
+    assert search('SECOND1') == {'reddit.com/r/second1'}  # substring + case insensitive
+    assert search('comment 2') == {'reddit.com/r/first2', 'reddit.com/r/second2'}
+    assert search('Saved from first') == {f'reddit.com/r/first{i}' for i in range(3)}
+
+    # reindexing should keep full text index in sync
+    visits_to_sqlite([visit(i, src='first') for i in range(1)], overwrite_db=False, _db_path=db)
+    assert search('comment 2') == {'reddit.com/r/second2'}
+
+    visits_to_sqlite([visit(i, src='third') for i in range(1)], overwrite_db=True, _db_path=db)
+    assert search('comment') == {'reddit.com/r/third0'}
+
+    # should index existing visits for databases created before full text index was introduced
+    with sqlite_connection(db) as conn:
+        for stmt in fts_drop():
+            conn.execute(stmt)
+    visits_to_sqlite([visit(i, src='fourth') for i in range(1)], overwrite_db=False, _db_path=db)
+    assert search('comment') == {'reddit.com/r/third0', 'reddit.com/r/fourth0'}
+
+
+def test_fts_vacuum(tmp_path: Path) -> None:
+    def visit(i: int, *, src: str) -> DbVisit:
+        return DbVisit(
+            norm_url=f'reddit.com/r/{src}{i}',
+            orig_url=f'https://reddit.com/r/{src}{i}',
+            dt=_dt_aware,
+            locator=Loc.make(title='title'),
+            src=src,
+            context=f'comment {src}{i}',
+        )
+
+    db = tmp_path / 'db.sqlite'
+
+    def search(q: str) -> set[str]:
+        with sqlite_connection(db) as conn:
+            query = 'SELECT norm_url FROM visits WHERE rowid IN (SELECT rowid FROM visits_fts WHERE visits_fts MATCH ?)'
+            return {u for (u,) in conn.execute(query, (fts_query(q),))}
+
+    visits_to_sqlite([visit(i, src='first') for i in range(5)], overwrite_db=False, _db_path=db)
+    visits_to_sqlite([visit(i, src='second') for i in range(5)], overwrite_db=False, _db_path=db)
+    # leaves gaps in rowids
+    visits_to_sqlite([visit(i, src='first') for i in range(3, 5)], overwrite_db=False, _db_path=db)
+    assert search('comment second1') == {'reddit.com/r/second1'}
+
+    # VACUUM might renumber implicit rowids (depending on sqlite version), full text index should still point at the same visits
+    # so visits need an explicit INTEGER PRIMARY KEY, which is stable
+    with sqlite_connection(db) as conn:
+        [(pk_type, pk)] = conn.execute("SELECT type, pk FROM pragma_table_info('visits') WHERE name = 'id'")
+        assert (pk_type, pk) == ('INTEGER', 1)
+        conn.execute('VACUUM')
+    assert search('comment second1') == {'reddit.com/r/second1'}
+    assert search('comment first4') == {'reddit.com/r/first4'}
+
+
+def test_migrate_id(tmp_path: Path) -> None:
+    db = tmp_path / 'db.sqlite'
+    visits_to_sqlite([make_testvisit(i) for i in range(5)], overwrite_db=True, _db_path=db)
+
+    # emulate database created before id column was introduced
+    with sqlite_connection(db) as conn:
+        for stmt in fts_drop():
+            conn.execute(stmt)
+        conn.execute('CREATE TABLE visits_old AS SELECT * FROM visits')
+        conn.execute('ALTER TABLE visits_old DROP COLUMN id')
+        conn.execute('DROP TABLE visits')
+        conn.execute('ALTER TABLE visits_old RENAME TO visits')
+        conn.execute('DELETE FROM visits WHERE rowid = 2')
+        before = dict(conn.execute('SELECT rowid, norm_url FROM visits'))
+
+    errors = visits_to_sqlite(
+        [make_testvisit(i)._replace(src='new') for i in range(5, 7)], overwrite_db=False, _db_path=db
+    )
+    assert len(errors) == 0, errors
+
+    with sqlite_connection(db) as conn:
+        after = dict(conn.execute('SELECT id, norm_url FROM visits'))
+        [(fts_count,)] = conn.execute("SELECT COUNT(*) FROM visits_fts WHERE visits_fts MATCH 'google'")
+    # existing rows keep their rowids
+    assert {k: v for k, v in after.items() if k in before} == before
+    assert len(after) == len(before) + 2
+    assert fts_count == len(after)
+
+
 def test_read_db_visits(tmp_path: Path) -> None:
     """
     Deliberately test against "hardcoded" database to check for backwards compatibility
@@ -133,6 +374,44 @@ INSERT INTO visits VALUES(
     )
 
 
+def test_migrate_dt_epoch(tmp_path: Path) -> None:
+    db = tmp_path / 'db.sqlite'
+    with sqlite_connection(db) as conn:
+        conn.execute(
+            '''
+CREATE TABLE visits (
+    norm_url VARCHAR,
+    orig_url VARCHAR,
+    dt VARCHAR,
+    locator_title VARCHAR,
+    locator_href VARCHAR,
+    src VARCHAR,
+    context VARCHAR,
+    duration INTEGER
+);
+'''
+        )
+        conn.execute(
+            '''
+INSERT INTO visits VALUES
+    ('legacy.com', 'https://legacy.com', '2019-04-13T11:55:09-04:00 America/New_York', 'title', NULL, 'legacy', NULL, NULL),
+    ('naive.com' , 'https://naive.com' , '2019-04-13T11:55:09'                       , 'title', NULL, 'legacy', NULL, NULL);
+'''
+        )
+
+    new_visit = make_testvisit(1)
+    errors = visits_to_sqlite(vit=[new_visit], overwrite_db=False, _db_path=db)
+    assert len(errors) == 0, errors
+
+    with sqlite_connection(db) as conn:
+        res = dict(conn.execute('SELECT norm_url, dt_epoch FROM visits'))
+    assert res == {
+        'legacy.com': int(datetime.fromisoformat('2019-04-13T15:55:09+00:00').timestamp()),
+        'naive.com': int(datetime.fromisoformat('2019-04-13T11:55:09+00:00').timestamp()),
+        new_visit.norm_url: int(new_visit.dt.timestamp()),
+    }
+
+
 def _test_random_visit_aux(visit: DbVisit, tmp_path: Path) -> None:
     db = tmp_path / 'db.sqlite'
     errors = visits_to_sqlite(
@@ -173,17 +452,20 @@ def make_testvisit(i: int) -> DbVisit:
     )
 
 
-@pytest.mark.parametrize('count', [99, 100_000, 1_000_000])
+@pytest.mark.parametrize('count', [99, 100_000, 1_000_000, 10_000_000])
 @pytest.mark.parametrize('gc_on', [True, False], ids=['gc_on', 'gc_off'])
 def test_benchmark_visits_dumping(count: int, gc_control, tmp_path: Path) -> None:
     # [20231212] testing differernt CHUNK_BY values with 1_000_000 visits on @karlicoss desktop pc
     # 1: 25s (perhaps most overhead is from temporary lists?)
-    # 10 (current default): 8s
+    # 10 (default at the time): 8s
     # 100: 6s
     # 1000: 6s
-    # TODO maybe consider changing default to 100?
+    # NOTE: now both modes insert in chunks of _BULK_CHUNK_BY (update mode inserts into the staging table first)
+    # overwrite_db=True uses bulk load mode, see benchmarks/20261018.org
     if count > 99 and running_on_ci:
         pytest.skip("test would be too slow on CI, only meant to run manually")
+    if count >= 10_000_000 and 'PROMNESIA_BENCHMARK_HUGE' not in os.environ:
+        pytest.skip("takes minutes, set PROMNESIA_BENCHMARK_HUGE=1 to run")
 
     visits = (make_testvisit(i) for i in range(count))
     db = tmp_path / 'db.sqlite'
@@ -222,5 +504,33 @@ def test_concurrent(tmp_path: Path, mode: str) -> None:
     assert db_path.exists()  # just in case
 
 
+@pytest.mark.parametrize('mode', ['update', 'overwrite'])
+def test_write_while_extracting(tmp_path: Path, mode: str) -> None:
+    overwrite_db = {'overwrite': True, 'update': False}[mode]
+    db = tmp_path / 'db.sqlite'
+    _populate_db(db, overwrite_db=True, count=1)
+
+    def visits() -> Iterator[DbVisit]:
+        yield make_testvisit(1)
+        # database shouldn't be locked during extraction, so another indexer can write in the meantime
+        # (otherwise this would block until the connection timeout)
+        other = make_testvisit(2)._replace(src='other')
+        errors = visits_to_sqlite([other], overwrite_db=False, _db_path=db)
+        assert len(errors) == 0, errors
+        yield make_testvisit(3)
+
+    errors = visits_to_sqlite(visits(), overwrite_db=overwrite_db, _db_path=db)
+    assert len(errors) == 0, errors
+
+    with sqlite_connection(db) as conn:
+        res = sorted(conn.execute('SELECT src, norm_url FROM visits'))
+    if overwrite_db:
+        assert res == [('whatever', 'google.com/1'), ('whatever', 'google.com/3')]
+    else:
+        assert res == [('other', 'google.com/2'), ('whatever', 'google.com/1'), ('whatever', 'google.com/3')]
+    # staging database should be cleaned up
+    assert sorted(p.name for p in tmp_path.iterdir() if not p.name.startswith('db.sqlite')) == []
+
+
 # TODO test to make sure db is readable while we're indexing?
 # kinda nicer version of test_query_while_indexing
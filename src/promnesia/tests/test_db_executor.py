@@ -0,0 +1,102 @@
+from __future__ import annotations
+
+import asyncio
+import sqlite3
+import threading
+import time
+from functools import partial
+
+import pytest
+
+from ..db_executor import DbExecutor, Priority, interruptible
+
+
+def test_priority() -> None:
+    executor = DbExecutor(workers=2, reserved=1)
+    release = threading.Event()
+    started: list[str] = []
+
+    def slow(name: str) -> str:
+        started.append(name)
+        release.wait(timeout=10)
+        return name
+
+    async def main() -> None:
+        scans = [
+            asyncio.ensure_future(executor.run(partial(slow, f'scan{i}'), priority=Priority.LOW)) for i in range(3)
+        ]
+        await asyncio.sleep(0.1)
+        # only one worker is available for scans, the other one is reserved
+        assert started == ['scan0']
+
+        # cheap request shouldn't wait for the scans
+        assert await asyncio.wait_for(executor.run(lambda: 'cheap', priority=Priority.HIGH), timeout=1) == 'cheap'
+
+        release.set()
+        assert await asyncio.gather(*scans) == ['scan0', 'scan1', 'scan2']
+
+    asyncio.run(main())
+
+
+def test_cancel_pending() -> None:
+    executor = DbExecutor(workers=1, reserved=0)
+    release = threading.Event()
+    called: list[str] = []
+
+    async def main() -> None:
+        blocking = asyncio.ensure_future(executor.run(lambda: release.wait(timeout=10), priority=Priority.LOW))
+        pending = asyncio.ensure_future(executor.run(lambda: called.append('pending'), priority=Priority.LOW))
+        await asyncio.sleep(0.1)
+        pending.cancel()
+        release.set()
+        assert await blocking
+        assert await executor.run(lambda: 'next', priority=Priority.LOW) == 'next'
+        with pytest.raises(asyncio.CancelledError):
+            await pending
+
+    asyncio.run(main())
+    assert called == []
+
+
+def test_interrupt() -> None:
+    executor = DbExecutor(workers=1, reserved=0)
+    conn = sqlite3.connect(':memory:', check_same_thread=False)
+
+    def endless_query() -> None:
+        with interruptible(conn):
+            conn.execute(
+                'WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c) SELECT count(*) FROM c'
+            ).fetchall()
+
+    async def main() -> None:
+        query = asyncio.ensure_future(executor.run(endless_query, priority=Priority.LOW))
+        await asyncio.sleep(0.2)
+        query.cancel()
+        # the only worker should be released straightaway
+        start = time.perf_counter()
+        assert await asyncio.wait_for(executor.run(lambda: 'next', priority=Priority.LOW), timeout=5) == 'next'
+        assert time.perf_counter() - start < 1
+
+    asyncio.run(main())
+
+
+def test_iterate_cancel() -> None:
+    executor = DbExecutor(workers=1, reserved=0)
+    closed = threading.Event()
+
+    def items():
+        try:
+            yield from range(1000)
+        finally:
+            closed.set()
+
+    async def main() -> None:
+        res = []
+        async for i in executor.iterate(items(), priority=Priority.LOW):
+            res.append(i)
+            if i == 2:
+                break
+        assert res == [0, 1, 2]
+
+    asyncio.run(main())
+    assert closed.is_set()
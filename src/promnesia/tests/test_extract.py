@@ -28,6 +28,25 @@ def test_with_error() -> None:
     assert isinstance(v2, DbVisit)
 
 
+def test_errors_in_batch() -> None:
+    dt = datetime.fromtimestamp(0, tz=UTC)
+    loc = Loc.make('whatever')
+
+    def indexer():
+        for i in range(2500):
+            url = 'https://example.com＃@bing.com' if i == 1234 else f'http://test{i}'
+            yield Visit(url=url, dt=dt, locator=loc)
+        raise RuntimeError('extractor crashed')
+
+    res = list(extract_visits(source=Source(indexer), src='whatever'))
+    assert len(res) == 2501
+    # the broken url shouldn't affect the rest of the batch
+    errors = [i for i, r in enumerate(res) if isinstance(r, Exception)]
+    assert errors == [1234, 2500]
+    assert [unwrap(r).orig_url for r in res[:3]] == ['http://test0', 'http://test1', 'http://test2']
+    assert unwrap(res[2499]).norm_url == 'test2499'
+
+
 def test_urls_are_normalised() -> None:
     # generally this stuff is covered by cannon tests, but good to check it's actually inserted in the db
     # TODO maybe this should be a separate test which takes DbVisit.make separately?
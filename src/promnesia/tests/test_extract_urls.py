@@ -1,4 +1,7 @@
-from ..common import extract_urls
+import pytest
+
+from ..common import _get_tlds, _get_urlextractor, _sanitize, extract_urls
+from .common import get_testdata
 
 
 def test_extract_simple() -> None:
@@ -41,3 +44,61 @@ python.org/one.html ?? https://python.org/two.html some extra text
         'https://python.org/two.html',
         'whatever.org',
     }
+
+
+def _iter_test_strings():
+    for path in sorted(get_testdata('').rglob('*')):
+        if not path.is_file():
+            continue
+        try:
+            text = path.read_text()
+        except UnicodeDecodeError:
+            continue
+        yield text
+        yield from text.splitlines()
+    yield from [
+        'https://example.com/path?q=1#frag',
+        'see https://example.com. and (https://en.wikipedia.org/wiki/Widget_(beer))',
+        'http://localhost:8080/test',
+        '[[https://example.com/page][title]]',
+        'https://example.com,https://example.org',
+        'https://example.notatld/path',
+        'https://example.com#frag',
+        'https://example.com:8080',
+        'no urls here. at all',
+        'https://пример.рф/path',
+        'https://example.com/a\xa0b',
+    ]
+
+
+@pytest.mark.parametrize('syntax', ['', 'org', 'markdown'])
+def test_fast_path_equivalent_to_urlextract(syntax: str) -> None:
+    """
+    extract_urls avoids calling urlextract for strings it can handle itself, check the results are the same
+    """
+    urlextractor = _get_urlextractor(syntax=syntax)
+    for s in _iter_test_strings():
+        # NOTE: there is a known difference: for 'https://example.com.com' urlextract emits the url twice
+        expected = [_sanitize(u) for u in urlextractor.gen_urls(s)]
+        assert extract_urls(s, syntax=syntax) == expected, s
+
+
+def test_fast_path_without_tlds(monkeypatch: pytest.MonkeyPatch) -> None:
+    """
+    _load_cached_tlds is private urlextract API, if it's gone should fall back onto urlextract
+    """
+    urlextractor = _get_urlextractor(syntax='')  # NOTE: constructed (and cached) before patching
+
+    def removed() -> set[str]:
+        raise AttributeError('_load_cached_tlds')
+
+    monkeypatch.setattr(urlextractor, '_load_cached_tlds', removed)
+    _get_tlds.cache_clear()
+    try:
+        assert _get_tlds() is None
+        assert extract_urls('see https://example.com/page and https://github.com') == [
+            'https://example.com/page',
+            'https://github.com',
+        ]
+    finally:
+        _get_tlds.cache_clear()
@@ -1,3 +1,4 @@
+import os
 from collections import Counter
 from pathlib import Path
 from subprocess import Popen, check_call
@@ -6,7 +7,8 @@ import pytest
 
 from ..__main__ import do_index, read_example_config
 from ..common import DbVisit, _is_windows
-from ..database.load import get_all_db_visits
+from ..database.common import get_db_paths
+from ..database.load import get_all_db_visits, get_source_fingerprints
 from .common import (
     get_testdata,
     promnesia_bin,
@@ -67,6 +69,212 @@ def test_indexing_mode(tmp_path: Path, mode: str) -> None:
         assert stats == {'demo2': 30, 'demo3': 40}
 
 
+@pytest.mark.parametrize('mode', ['update', 'overwrite'])
+@pytest.mark.parametrize('parallel', [None, 2])
+def test_sharded(tmp_path: Path, mode: str, parallel: int | None) -> None:
+    def cfg1() -> None:
+        from promnesia.common import Source
+        from promnesia.sources import demo
+
+        def indexer_crashed():
+            raise RuntimeError("indexer crashed")
+
+        SHARDED_DB = True  # noqa: F841
+        SOURCES = [  # noqa: F841
+            Source(demo.index, count=10, base_dt='2000-01-01', delta=30, name='demo1'),
+            Source(demo.index, count=20, base_dt='2001-01-01', delta=30, name='demo2'),
+            Source(indexer_crashed, name='crashed'),
+        ]
+
+    shards = tmp_path / 'promnesia-shards'
+
+    def get_shard_stats() -> dict[str, Counter]:
+        return {p.stem: Counter(v.src for v in get_all_db_visits(p)) for p in shards.glob('*.sqlite')}
+
+    cfg_path = tmp_path / 'config1.py'
+    write_config(cfg_path, cfg1)
+    errors = do_index(cfg_path, parallel=parallel)
+    assert len(errors) == 1, errors  # crashed source
+
+    assert not (tmp_path / 'promnesia.sqlite').exists()
+    assert get_shard_stats() == {
+        'demo1': {'demo1': 10},
+        'demo2': {'demo2': 20},
+        'crashed': {'error': 1},
+    }
+
+    def cfg2() -> None:
+        from promnesia.common import Source
+        from promnesia.sources import demo
+
+        SHARDED_DB = True  # noqa: F841
+        SOURCES = [  # noqa: F841
+            Source(demo.index, count=30, base_dt='2005-01-01', delta=30, name='demo2'),
+            Source(demo.index, count=40, base_dt='2010-01-01', delta=30, name='demo3'),
+        ]
+
+    cfg_path = tmp_path / 'config2.py'
+    write_config(cfg_path, cfg2)
+    errors = do_index(cfg_path, overwrite_db={'overwrite': True, 'update': False}[mode], parallel=parallel)
+    assert len(errors) == 0, errors
+
+    if mode == 'update':
+        # other shards are left intact
+        assert get_shard_stats() == {
+            'demo1': {'demo1': 10},
+            'demo2': {'demo2': 30},
+            'demo3': {'demo3': 40},
+            'crashed': {'error': 1},
+        }
+    else:
+        # shards of sources that aren't in the config anymore are removed
+        assert get_shard_stats() == {
+            'demo2': {'demo2': 30},
+            'demo3': {'demo3': 40},
+        }
+
+    # reindexing a single source only touches its own shard
+    mtimes = {p.name: p.stat().st_mtime_ns for p in shards.glob('*.sqlite')}
+    errors = do_index(cfg_path, sources_subset=['demo3'])
+    assert len(errors) == 0, errors
+    assert {p.name: p.stat().st_mtime_ns for p in shards.glob('*.sqlite') if p.name != 'demo3.sqlite'} == {
+        k: v for k, v in mtimes.items() if k != 'demo3.sqlite'
+    }
+
+
+def test_sharded_flip(tmp_path: Path, caplog) -> None:
+    def cfg(use_shards: str) -> None:
+        from promnesia.common import Source
+        from promnesia.sources import demo
+
+        SHARDED_DB = use_shards == 'True'  # noqa: F841
+        SOURCES = [  # noqa: F841
+            Source(demo.index, count=10, name='demo1'),
+            Source(demo.index, count=20, name='demo2'),
+        ]
+
+    db = tmp_path / 'promnesia.sqlite'
+    shards = tmp_path / 'promnesia-shards'
+    cfg_path = tmp_path / 'config.py'
+
+    def all_stats() -> Counter:
+        return Counter(v.src for p in get_db_paths(db) for v in get_all_db_visits(p))
+
+    write_config(cfg_path, cfg, use_shards=False)
+    assert do_index(cfg_path) == []
+    assert all_stats() == {'demo1': 10, 'demo2': 20}
+
+    # without --overwrite, the old database is kept, so visits end up in both layouts
+    write_config(cfg_path, cfg, use_shards=True)
+    caplog.clear()
+    assert do_index(cfg_path) == []
+    assert db.exists()
+    assert all_stats() == {'demo1': 20, 'demo2': 40}
+    assert 'SHARDED_DB' in caplog.text
+
+    # --overwrite removes the database of the other layout
+    assert do_index(cfg_path, overwrite_db=True) == []
+    assert not db.exists()
+    assert all_stats() == {'demo1': 10, 'demo2': 20}
+
+    # and same when flipping it back
+    write_config(cfg_path, cfg, use_shards=False)
+    assert do_index(cfg_path, overwrite_db=True) == []
+    assert list(shards.glob('*.sqlite')) == []
+    assert all_stats() == {'demo1': 10, 'demo2': 20}
+
+
+def test_skip_unchanged(tmp_path: Path) -> None:
+    def cfg(links_file: str) -> None:
+        from datetime import datetime
+        from pathlib import Path
+
+        from promnesia.common import Loc, Source, Visit
+        from promnesia.sources import demo
+
+        def links(path: str):
+            for line in Path(path).read_text().splitlines():
+                yield Visit(url=line, dt=datetime.fromisoformat('2000-01-01'), locator=Loc.make(path))
+
+        SOURCES = [  # noqa: F841
+            Source(links, links_file, name='links'),
+            # no files in the arguments, so can't tell if it changed -- should always be reindexed
+            Source(demo.index, count=3, name='demo'),
+        ]
+
+    links_file = tmp_path / 'links.txt'
+    links_file.write_text('https://first.com\n')
+    cfg_path = tmp_path / 'config.py'
+    write_config(cfg_path, cfg, links_file=links_file)
+
+    def urls() -> set[str]:
+        return {v.norm_url for v in get_all_db_visits(tmp_path / 'promnesia.sqlite') if v.src == 'links'}
+
+    errors = do_index(cfg_path, skip_unchanged=True)
+    assert len(errors) == 0, errors
+    assert urls() == {'first.com'}
+    assert get_stats(tmp_path) == {'links': 1, 'demo': 3}
+
+    # same size, and restore mtime -- so should be considered unchanged and skipped
+    st = links_file.stat()
+    links_file.write_text('https://other.com\n')
+    os.utime(links_file, ns=(st.st_atime_ns, st.st_mtime_ns))
+    errors = do_index(cfg_path, skip_unchanged=True)
+    assert len(errors) == 0, errors
+    assert urls() == {'first.com'}
+    assert get_stats(tmp_path) == {'links': 1, 'demo': 3}
+
+    # without the flag, everything is reindexed as before
+    errors = do_index(cfg_path)
+    assert len(errors) == 0, errors
+    assert urls() == {'other.com'}
+
+    # since the previous run didn't compute fingerprints, shouldn't skip
+    links_file.write_text('https://third.com\n')
+    os.utime(links_file, ns=(st.st_atime_ns, st.st_mtime_ns))
+    errors = do_index(cfg_path, skip_unchanged=True)
+    assert len(errors) == 0, errors
+    assert urls() == {'third.com'}
+
+    links_file.write_text('https://first.com\nhttps://second.com\n')
+    errors = do_index(cfg_path, skip_unchanged=True)
+    assert len(errors) == 0, errors
+    assert urls() == {'first.com', 'second.com'}
+
+
+def test_skip_unchanged_home(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setenv('HOME', str(tmp_path))
+
+    def cfg() -> None:
+        from promnesia.common import Source
+        from promnesia.sources import auto
+
+        SOURCES = [  # noqa: F841
+            Source(auto.index, '~/notes', name='notes'),
+        ]
+
+    notes = tmp_path / 'notes'
+    notes.mkdir()
+    (notes / 'a.txt').write_text('https://first.com\n')
+    cfg_path = tmp_path / 'config.py'
+    write_config(cfg_path, cfg)
+
+    errors = do_index(cfg_path, skip_unchanged=True)
+    assert len(errors) == 0, errors
+    db = tmp_path / 'promnesia.sqlite'
+    [(_, fingerprint)] = get_source_fingerprints(db).items()
+    # paths relative to home should be expanded, otherwise the source can't be fingerprinted and is never skipped
+    assert fingerprint is not None
+
+    # same size and mtime -- so should be considered unchanged and skipped
+    st = (notes / 'a.txt').stat()
+    (notes / 'a.txt').write_text('https://other.com\n')
+    os.utime(notes / 'a.txt', ns=(st.st_atime_ns, st.st_mtime_ns))
+    errors = do_index(cfg_path, skip_unchanged=True)
+    assert len(errors) == 0, errors
+    assert {v.norm_url for v in get_all_db_visits(db)} == {'first.com'}
+
+
 # TODO check both modes?
 def test_concurrent_indexing(tmp_path: Path) -> None:
     def cfg_fast() -> None:
@@ -107,9 +315,9 @@ def test_concurrent_indexing(tmp_path: Path) -> None:
                 total_runs += 1
         assert slow_indexer.poll() == 0, slow_indexer
 
-    # FIXME ok, need to uncomment this once proper concurrent indexing is supported
-    # if not, slow indexer is too fast, so crank up the count in it
-    # assert total_runs > 20
+    # visits are collected in a staging database first, so fast indexers aren't blocked by the slow one
+    # if this fails, slow indexer is too fast, so crank up the count in it
+    assert total_runs > 20
 
 
 def test_filter(tmp_path: Path, reset_filters) -> None:
@@ -189,6 +397,45 @@ def test_errors_during_indexing(tmp_path: Path) -> None:
     }
 
 
+def test_parallel(tmp_path: Path) -> None:
+    def cfg() -> None:
+        from promnesia.common import Source
+        from promnesia.sources import demo
+
+        def indexer_crashed():
+            raise RuntimeError("indexer crashed")
+
+        def indexer_with_error():
+            yield from demo.index(count=3, base_dt='2000-01-01')
+            yield RuntimeError("some error during visits extraction")
+
+        SOURCES = [  # noqa: F841
+            Source(demo.index, count=1000, name='demo1'),
+            Source(demo.index, count=2500, base_dt='2010-01-01', name='demo2'),
+            Source(indexer_crashed, name='crashed'),
+            Source(indexer_with_error, name='with_error'),
+            Source(demo.index, count=5, name='demo3'),
+        ]
+
+    cfg_path = tmp_path / 'config.py'
+    write_config(cfg_path, cfg)
+
+    do_index(cfg_path, parallel=2)
+    stats = get_stats(tmp_path)
+    assert stats == {
+        'demo1': 1000,
+        'demo2': 2500,
+        'with_error': 3,
+        'demo3': 5,
+        'error': 2,
+    }
+
+    # --sources filtering should work the same way
+    do_index(cfg_path, sources_subset=['demo3', 1], overwrite_db=True, parallel=2)
+    stats = get_stats(tmp_path)
+    assert stats == {'demo2': 2500, 'demo3': 5}
+
+
 def test_hook(tmp_path: Path) -> None:
     def cfg() -> None:
         from promnesia.common import Source
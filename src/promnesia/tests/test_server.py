@@ -1,12 +1,26 @@
+import json
+import os
+import random
+import sys
+import time
+from collections.abc import Callable
 from datetime import datetime
 from pathlib import Path
-from subprocess import Popen
+from subprocess import Popen, check_output
+from typing import Any
+from zoneinfo import ZoneInfo
 
 import pytest
+import requests
+from sqlalchemy.pool import QueuePool
 
 from ..__main__ import do_index
-from .common import promnesia_bin, write_config
+from ..database.common import fts_drop
+from ..database.dump import visits_to_sqlite
+from ..sqlite import sqlite_connection
+from .common import promnesia_bin, running_on_ci, write_config
 from .server_helper import run_server
+from .test_db_dump import make_testvisit
 
 
 def test_status_error() -> None:
@@ -115,6 +129,18 @@ def test_visits_hierarchy(tmp_path: Path) -> None:
                 locator=Loc.make('reddit'),
                 context='I am comment 1',
             )
+            # prefix match is case insensitive
+            yield Visit(
+                url='https://reddit.com/Post1/Comment3',
+                dt=datetime.fromisoformat('2023-12-07'),
+                locator=Loc.make('reddit'),
+                context='I am comment 3',
+            )
+            yield Visit(
+                url='https://reddit.com/post10',
+                dt=datetime.fromisoformat('2023-12-07'),
+                locator=Loc.make('reddit'),
+            )
 
         SOURCES = [Source(indexer)]  # noqa: F841
 
@@ -130,6 +156,7 @@ def test_visits_hierarchy(tmp_path: Path) -> None:
             'https://reddit.com/post1',
             'https://reddit.com/post1/comment1',
             'https://reddit.com/post1/comment2',
+            'https://reddit.com/Post1/Comment3',
         }
 
 
@@ -156,6 +183,16 @@ def test_visited(tmp_path: Path) -> None:
         assert r1['original_url'] == test_url
         assert r2 is None
 
+    # check that it works against databases created before url_summary table was introduced
+    with sqlite_connection(tmp_path / 'promnesia.sqlite') as conn:
+        conn.execute('DROP TABLE url_summary')
+
+    with run_server(db=tmp_path / 'promnesia.sqlite', timezone='America/New_York') as server:
+        r = server.post('/visited', json={'urls': [test_url, 'http://badurl.org']}).json()
+        [r1, r2] = r
+        assert r1['original_url'] == test_url
+        assert r2 is None
+
 
 def test_search(tmp_path: Path) -> None:
     # TODO not sure if should index at all here or just insert DbVisits directly?
@@ -206,6 +243,178 @@ def test_search(tmp_path: Path) -> None:
         [v] = rj['visits']
         assert v['context'] == 'perhaps it will help someone else https://wiki.termux.com/wiki/Termux-setup-storage'
 
+        # too short for the full text index, should still work
+        rj = server.post('/search', json={'url': 'wi'}).json()
+        [v] = rj['visits']
+        assert v['normalised_url'] == 'wiki.termux.com/wiki/Termux-setup-storage'
+
+    # check that it works against databases created before full text index was introduced
+    with sqlite_connection(tmp_path / 'promnesia.sqlite') as conn:
+        for stmt in fts_drop():
+            conn.execute(stmt)
+
+    with run_server(db=tmp_path / 'promnesia.sqlite', timezone='America/New_York') as server:
+        rj = server.post('/search', json={'url': 'someone'}).json()
+        assert len(rj['visits']) == 2
+
+
+def test_sharded(tmp_path: Path) -> None:
+    def cfg() -> None:
+        from datetime import datetime
+
+        from promnesia.common import Loc, Source, Visit
+        from promnesia.sources import demo
+
+        def with_context():
+            yield Visit(
+                url='https://demo.com/page1.html',
+                dt=datetime.fromisoformat('2000-01-01T12:00:00+00:00'),
+                locator=Loc.make('notes'),
+                context='some note',
+            )
+
+        SHARDED_DB = True  # noqa: F841
+        SOURCES = [  # noqa: F841
+            Source(demo.index, count=5, base_dt='2000-01-01', delta=30 * 60, name='first'),
+            Source(demo.index, count=3, base_dt='2001-01-01', delta=30 * 60, name='second'),
+            Source(with_context, name='third'),
+        ]
+
+    cfg_path = tmp_path / 'config.py'
+    write_config(cfg_path, cfg)
+    errors = do_index(cfg_path)
+    assert len(errors) == 0, errors
+
+    db_path = tmp_path / 'promnesia.sqlite'
+    assert not db_path.exists()  # only shards are created
+
+    with run_server(db=db_path, timezone='America/New_York') as server:
+        r = server.post('/status').json()
+        assert r['db'] == str(db_path)
+        assert r['stats'] == {'total_visits': 9}
+
+        rj = server.post('/visits', json={'url': 'https://demo.com/page1.html'}).json()
+        assert sorted(v['src'] for v in rj['visits']) == ['first', 'second', 'third']
+
+        rj = server.post('/search', json={'url': 'some note'}).json()
+        [v] = rj['visits']
+        assert v['src'] == 'third'
+
+        # visit with context should be picked among the shards
+        [r1, r2, r3] = server.post(
+            '/visited',
+            json={'urls': ['https://demo.com/page1.html', 'https://demo.com/page4.html', 'http://badurl.org']},
+        ).json()
+        assert r1['context'] == 'some note'
+        assert r2['src'] == 'first'
+        assert r3 is None
+
+
+@pytest.mark.parametrize('sharded', [False, True])
+def test_pagination(tmp_path: Path, sharded: bool) -> None:  # noqa: FBT001
+    def cfg(sharded: str) -> None:
+        from promnesia.common import Source
+        from promnesia.sources import demo
+
+        SHARDED_DB = sharded == 'True'  # noqa: F841
+        # some timestamps are the same in both sources
+        SOURCES = [  # noqa: F841
+            Source(demo.index, count=7, base_dt='2000-01-01T00:00:00+00:00', delta=10 * 60, name='first'),
+            Source(demo.index, count=5, base_dt='2000-01-01T00:00:00+00:00', delta=20 * 60, name='second'),
+        ]
+
+    cfg_path = tmp_path / 'config.py'
+    write_config(cfg_path, cfg, sharded=sharded)
+    errors = do_index(cfg_path)
+    assert len(errors) == 0, errors
+
+    def key(v: dict[str, Any]) -> tuple[str, str, str]:
+        return (v['dt'], v['src'], v['original_url'])
+
+    with run_server(db=tmp_path / 'promnesia.sqlite') as server:
+        rj = server.post('/search', json={'url': 'demo.com'}).json()
+        expected = sorted(map(key, rj['visits']))
+        assert len(expected) == 12
+        assert rj['next_cursor'] is None
+
+        got = []
+        cursor = None
+        pages = 0
+        while True:
+            rj = server.post('/search', json={'url': 'demo.com', 'limit': 5, 'cursor': cursor}).json()
+            assert len(rj['visits']) <= 5
+            got.extend(rj['visits'])
+            pages += 1
+            cursor = rj['next_cursor']
+            if cursor is None:
+                break
+        assert pages == 3
+        assert sorted(map(key, got)) == expected
+        # most recent first
+        dts = [datetime.strptime(v['dt'], '%d %b %Y %H:%M:%S %z') for v in got]
+        assert dts == sorted(dts, reverse=True)
+
+        # streaming
+        r = server.post('/search', json={'url': 'demo.com', 'stream': True})
+        assert r.headers['content-type'] == 'application/x-ndjson'
+        [header, *lines, trailer] = [json.loads(line) for line in r.text.splitlines()]
+        assert header == {'original_url': 'demo.com', 'normalised_url': 'demo.com'}
+        assert sorted(map(key, lines)) == expected
+        assert trailer == {'next_cursor': None}
+
+        r = server.post('/search', json={'url': 'demo.com', 'stream': True, 'limit': 10})
+        [_, *lines, trailer] = [json.loads(line) for line in r.text.splitlines()]
+        assert [key(v) for v in lines] == [key(v) for v in got[:10]]
+        rj = server.post('/search', json={'url': 'demo.com', 'limit': 10, 'cursor': trailer['next_cursor']}).json()
+        assert [key(v) for v in rj['visits']] == [key(v) for v in got[10:]]
+
+        assert server.post('/search', json={'url': 'demo.com', 'cursor': 'garbage'}).status_code == 400
+        assert server.post('/search', json={'url': 'demo.com', 'limit': 0}).status_code == 400
+
+
+def test_response_cache(tmp_path: Path) -> None:
+    def cfg(visits_count: int) -> None:
+        from promnesia.common import Source
+        from promnesia.sources import demo
+
+        SOURCES = [Source(demo.index, count=int(visits_count))]  # noqa: F841
+
+    cfg_path = tmp_path / 'config.py'
+    write_config(cfg_path, cfg, visits_count=3)
+    do_index(cfg_path)
+
+    def cache_stats() -> dict[str, Any]:
+        return server.post('/status').json()['cache']
+
+    with run_server(db=tmp_path / 'promnesia.sqlite') as server:
+        assert cache_stats()['hits'] == 0
+
+        url = 'https://demo.com/page3.html'
+        rj = server.post('/visits', json={'url': url}).json()
+        assert rj['visits'] == []
+        misses = cache_stats()['misses']
+
+        rj = server.post('/visits', json={'url': url}).json()
+        assert rj['visits'] == []
+        [r1] = server.post('/visited', json={'urls': [url]}).json()
+        [r2] = server.post('/visited', json={'urls': [url]}).json()
+        assert r1 is None
+        assert r2 is None
+        stats = cache_stats()
+        assert stats['hits'] == 2
+        assert stats['misses'] == misses + 1
+        assert stats['entries'] == 2
+
+        # reindexing should invalidate the cache
+        write_config(cfg_path, cfg, visits_count=5)
+        do_index(cfg_path)
+
+        rj = server.post('/visits', json={'url': url}).json()
+        assert len(rj['visits']) == 1
+        [r] = server.post('/visited', json={'urls': [url]}).json()
+        assert r is not None
+        assert cache_stats()['hits'] == 2
+
 
 def test_search_around(tmp_path: Path) -> None:
     # this should return visits up to 3 hours in the past
@@ -237,6 +446,22 @@ def test_search_around(tmp_path: Path) -> None:
         assert visits[0 ]['dt'] == '01 Jan 2000 02:00:00 +0300'  # fmt: skip
         assert visits[-1]['dt'] == '01 Jan 2000 04:50:00 +0300'  # fmt: skip
 
+    # check that it works against databases created before dt_epoch column was introduced
+    with sqlite_connection(tmp_path / 'promnesia.sqlite') as conn:
+        conn.execute('DROP TABLE url_summary')
+        conn.execute('DROP INDEX index_dt_epoch')
+        conn.execute('ALTER TABLE visits DROP COLUMN dt_epoch')
+
+    with run_server(db=tmp_path / 'promnesia.sqlite') as server:
+        rj = server.post(
+            '/search_around',
+            json={'timestamp': datetime.fromisoformat('2000-01-01T07:55:00+06:00').timestamp()},
+        ).json()
+        visits = rj['visits']
+        assert len(visits) == 18
+        assert visits[0 ]['dt'] == '01 Jan 2000 02:00:00 +0300'  # fmt: skip
+        assert visits[-1]['dt'] == '01 Jan 2000 04:50:00 +0300'  # fmt: skip
+
 
 @pytest.mark.parametrize('mode', ['update', 'overwrite'])
 def test_query_while_indexing(tmp_path: Path, mode: str) -> None:
@@ -278,6 +503,146 @@ def test_query_while_indexing(tmp_path: Path, mode: str) -> None:
                         assert total_visits >= 1_000 * run_id
 
 
+@pytest.mark.parametrize('count', [99, 100_000, 1_000_000])
+def test_benchmark_latency(tmp_path: Path, count: int) -> None:
+    if count > 99 and running_on_ci:
+        pytest.skip("test would be too slow on CI, only meant to run manually")
+
+    db = tmp_path / 'promnesia.sqlite'
+    errors = visits_to_sqlite((make_testvisit(i) for i in range(count)), overwrite_db=True, _db_path=db)
+    assert len(errors) == 0, errors
+
+    rng = random.Random(0)
+    ts = make_testvisit(0).dt.timestamp()
+    queries: dict[str, Callable[[], dict[str, Any]]] = {
+        '/visits': lambda: {'url': f'https://google.com/{rng.randrange(count)}'},
+        '/visited': lambda: {'urls': [f'https://google.com/{rng.randrange(count * 2)}' for _ in range(50)]},
+        '/search': lambda: {'url': f'title{rng.randrange(count)}'},
+        '/search_around': lambda: {'timestamp': ts + rng.randrange(count)},
+    }
+    requests_per_endpoint = 200
+    with run_server(db=db, timezone='America/New_York') as server, requests.Session() as session:
+        base = f'http://{server.host}:{server.port}'
+        # same request over and over again is only computed once, the rest is served from the response cache
+        for cached in [False, True]:
+            for endpoint, make_request in queries.items():
+                latencies = []
+                same_payload = make_request()
+                for _ in range(requests_per_endpoint):
+                    payload = same_payload if cached else make_request()
+                    start = time.perf_counter()
+                    r = session.post(base + endpoint, json=payload)
+                    latencies.append(time.perf_counter() - start)
+                    assert r.status_code == 200, r
+                latencies.sort()
+                p50 = latencies[len(latencies) // 2]
+                p99 = latencies[len(latencies) * 99 // 100]
+                name = endpoint + (' (cached)' if cached else '')
+                print(f'{name:<23}: {count} visits, p50 {p50 * 1000:.2f}ms, p99 {p99 * 1000:.2f}ms')
+
+
+@pytest.mark.parametrize('count', [99, 20_000, 200_000])
+def test_benchmark_visits_serialization(tmp_path: Path, count: int, monkeypatch: pytest.MonkeyPatch) -> None:
+    """
+    /visits for a domain with lots of child visits, mostly spent on converting rows to json
+    """
+    if count > 99 and running_on_ci:
+        pytest.skip("test would be too slow on CI, only meant to run manually")
+
+    from .. import server as S
+
+    db = tmp_path / 'promnesia.sqlite'
+    # children are only matched if they have context
+    visits = (make_testvisit(i)._replace(context=f'context{i}') for i in range(count))
+    errors = visits_to_sqlite(visits, overwrite_db=True, _db_path=db)
+    assert len(errors) == 0, errors
+
+    monkeypatch.setenv(S.EnvConfig.KEY, S.ServerConfig(db=db, timezone=ZoneInfo('America/New_York')).as_str())
+    S.EnvConfig.get.cache_clear()
+
+    timings = []
+    res = b''
+    for _ in range(10):
+        start = time.perf_counter()
+        res = S.dump_json(vars(S.search_common(url='https://google.com', query=S.visits_query)))
+        timings.append(time.perf_counter() - start)
+    assert len(json.loads(res)['visits']) == count
+    timings.sort()
+    print(f'/visits: {count} child visits, {len(res)} bytes, p50 {timings[len(timings) // 2] * 1000:.2f}ms')
+
+
+def test_engines_disposed(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    from .. import server as S
+
+    db = tmp_path / 'promnesia.sqlite'
+    errors = visits_to_sqlite((make_testvisit(i) for i in range(10)), overwrite_db=True, _db_path=db)
+    assert len(errors) == 0, errors
+    monkeypatch.setenv(S.EnvConfig.KEY, S.ServerConfig(db=db, timezone=ZoneInfo('UTC')).as_str())
+    S.EnvConfig.get.cache_clear()
+
+    def visits() -> int:
+        return len(S.search_common(url='https://google.com/1', query=S.visits_query).visits)
+
+    assert visits() == 1
+    [(_, (engine, _))] = S._engines.values()
+    pool = engine.pool
+    assert isinstance(pool, QueuePool), pool
+    assert pool.checkedin() > 0
+
+    # once database is modified (e.g. checkpointed after reindexing), the engine should be reloaded, and old connections closed
+    st = db.stat()
+    os.utime(db, (st.st_atime, st.st_mtime + 1))
+    for _ in range(3):
+        assert visits() == 1
+    [(_, (new_engine, _))] = S._engines.values()
+    assert new_engine is not engine
+    assert pool.checkedin() == 0
+
+    # engines for databases which are gone are disposed as well
+    db2 = tmp_path / 'other.sqlite'
+    errors = visits_to_sqlite((make_testvisit(i) for i in range(10)), overwrite_db=True, _db_path=db2)
+    assert len(errors) == 0, errors
+    monkeypatch.setenv(S.EnvConfig.KEY, S.ServerConfig(db=db2, timezone=ZoneInfo('UTC')).as_str())
+    S.EnvConfig.get.cache_clear()
+    assert visits() == 1
+    assert list(S._engines) == [db2]
+
+
+def test_workers(tmp_path: Path) -> None:
+    db = tmp_path / 'promnesia.sqlite'
+    errors = visits_to_sqlite((make_testvisit(i) for i in range(10)), overwrite_db=True, _db_path=db)
+    assert len(errors) == 0, errors
+
+    with run_server(db=db, workers=2) as server:
+        assert len(server.process.children()) >= 2
+        for _ in range(10):
+            [r1, r2] = server.post('/visited', json={'urls': ['https://google.com/1', 'https://google.com/10']}).json()
+            assert r1 is not None
+            assert r2 is None
+
+
+@pytest.mark.parametrize('workers', [1, 2, 4])
+def test_benchmark_visited_throughput(tmp_path: Path, workers: int) -> None:
+    """
+    Load test: /visited requests per second from several concurrent clients, see benchmarks/visited_load.py
+    """
+    if running_on_ci:
+        pytest.skip("test would be too slow on CI, only meant to run manually")
+    script = Path(__file__).absolute().parents[3] / 'benchmarks' / 'visited_load.py'
+    if not script.exists():
+        pytest.skip(f"{script} not found, only available in the repository")
+
+    count = 100_000
+    db = tmp_path / 'promnesia.sqlite'
+    errors = visits_to_sqlite((make_testvisit(i) for i in range(count)), overwrite_db=True, _db_path=db)
+    assert len(errors) == 0, errors
+
+    with run_server(db=db, workers=workers) as server:
+        base = f'http://{server.host}:{server.port}'
+        out = check_output([sys.executable, script, '--base', base, '--count', str(count)], text=True)
+    print(f'{workers} workers, {out.strip()}')
+
+
 # TODO also could check server methods directly?
 # via something like this... but not sure if really makes much difference
 # import promnesia.server as S
@@ -0,0 +1,166 @@
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+
+import pytest
+
+from .. import config
+from ..__main__ import do_index
+from ..common import Source
+from ..database.load import get_all_db_visits
+from ..sqlite import sqlite_connection
+from ..watch import index_changes, watch_changes
+from .common import write_config
+
+Key = tuple[str | None, str, str | None]
+
+
+def _urls(tmp_path: Path) -> Counter[Key]:
+    return Counter((v.src, v.orig_url, v.locator.path) for v in get_all_db_visits(tmp_path / 'promnesia.sqlite'))
+
+
+def test_index_changes(tmp_path: Path) -> None:
+    notes = tmp_path / 'notes'
+    notes.mkdir()
+    (notes / 'keep.txt').write_text('https://keep.com\n')
+    (notes / 'change.txt').write_text('https://old.com\n')
+    (notes / 'sub').mkdir()
+    (notes / 'sub' / 'remove.txt').write_text('https://remove.com\n')
+
+    def cfg(notes_path) -> None:
+        from promnesia.common import Source
+        from promnesia.sources import auto, demo
+
+        SOURCES = [  # noqa: F841
+            Source(auto.index, notes_path, name='notes'),
+            Source(demo.index, count=3, name='demo'),
+        ]
+
+    cfg_path = tmp_path / 'config.py'
+    write_config(cfg_path, cfg, notes_path=notes)
+    errors = do_index(cfg_path)
+    assert len(errors) == 0, errors
+
+    keep: Key = ('notes', 'https://keep.com', str(notes / 'keep.txt'))
+    demo: list[Key] = [('demo', f'https://demo.com/page{i}.html', None) for i in range(3)]
+    assert _urls(tmp_path) == Counter(
+        [
+            keep,
+            ('notes', 'https://old.com', str(notes / 'change.txt')),
+            ('notes', 'https://remove.com', str(notes / 'sub' / 'remove.txt')),
+            *demo,
+        ]
+    )
+
+    (notes / 'change.txt').write_text('https://new.com\nhttps://new2.com\n')
+    (notes / 'sub' / 'remove.txt').unlink()
+    (notes / 'sub').rmdir()
+    (notes / 'added.txt').write_text('https://added.com\n')
+    (tmp_path / 'outside.txt').write_text('https://outside.com\n')
+
+    config.load_from(cfg_path)
+    try:
+        changed = {notes / 'change.txt', notes / 'sub', notes / 'added.txt', tmp_path / 'outside.txt'}
+        sources = [s for s in config.get().sources if isinstance(s, Source)]
+        errors = index_changes(sources, changed)
+    finally:
+        config.reset()
+    assert len(errors) == 0, errors
+
+    # other files and sources are untouched
+    assert _urls(tmp_path) == Counter(
+        [
+            keep,
+            ('notes', 'https://new.com', str(notes / 'change.txt')),
+            ('notes', 'https://new2.com', str(notes / 'change.txt')),
+            ('notes', 'https://added.com', str(notes / 'added.txt')),
+            *demo,
+        ]
+    )
+    # url_summary is updated only for the affected urls, but should be consistent with the visits
+    with sqlite_connection(tmp_path / 'promnesia.sqlite') as conn:
+        summary = {u for (u,) in conn.execute('SELECT norm_url FROM url_summary')}
+        visits = {u for (u,) in conn.execute('SELECT DISTINCT norm_url FROM visits')}
+    assert summary == visits
+
+
+@pytest.mark.parametrize('poll', [0.05, None], ids=['poll', 'inotify'])
+def test_watch_changes(tmp_path: Path, poll: float | None) -> None:
+    if poll is None:
+        pytest.importorskip('watchfiles')
+    (tmp_path / 'existing.txt').write_text('whatever')
+    # NOTE: creating the directory in advance, otherwise inotify might miss the file created right after it
+    (tmp_path / 'dir').mkdir()
+    stop = threading.Event()
+
+    def change() -> None:
+        (tmp_path / 'existing.txt').unlink()
+        (tmp_path / 'dir' / 'new.txt').write_text('new')
+
+    timer = threading.Timer(0.5, change)
+    timer.start()
+    watchdog = threading.Timer(10, stop.set)  # just in case, so the test doesn't hang
+    watchdog.start()
+    try:
+        seen: set[Path] = set()
+        for changes in watch_changes([tmp_path], poll=poll, stop=stop):
+            seen |= changes
+            if {tmp_path / 'existing.txt', tmp_path / 'dir' / 'new.txt'}.issubset(seen):
+                break
+    finally:
+        stop.set()
+        timer.cancel()
+        watchdog.cancel()
+    assert {tmp_path / 'existing.txt', tmp_path / 'dir' / 'new.txt'}.issubset(seen)
+
+
+def test_watch_output_dir_inside(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    """
+    Writing the database (which is in the watched directory here) shouldn't trigger reindexing again
+    """
+    pytest.importorskip('watchfiles')
+    from .. import watch as W
+
+    notes = tmp_path / 'notes'
+    notes.mkdir()
+    (notes / 'a.txt').write_text('https://a.com\n')
+
+    def cfg(notes_path) -> None:
+        from promnesia.common import Source
+        from promnesia.sources import auto
+
+        SOURCES = [Source(auto.index, notes_path, name='notes')]  # noqa: F841
+
+    cfg_path = tmp_path / 'config.py'
+    # NOTE: OUTPUT_DIR is tmp_path, so both the database and the auto cache are inside the watched root
+    write_config(cfg_path, cfg, notes_path=tmp_path)
+    errors = do_index(cfg_path)
+    assert len(errors) == 0, errors
+
+    calls: list[set[Path]] = []
+    index_changes_orig = W.index_changes
+
+    def index_changes_counting(sources, changed):
+        calls.append(set(changed))
+        return index_changes_orig(sources, changed)
+
+    monkeypatch.setattr(W, 'index_changes', index_changes_counting)
+
+    stop = threading.Event()
+    config.load_from(cfg_path)
+    try:
+        watcher = threading.Thread(target=W.watch, kwargs={'stop': stop})
+        watcher.start()
+        try:
+            time.sleep(1)  # let it start watching
+            (notes / 'b.txt').write_text('https://b.com\n')
+            time.sleep(4)
+        finally:
+            stop.set()
+            watcher.join(timeout=10)
+    finally:
+        config.reset()
+
+    assert calls == [{notes / 'b.txt'}]
+    assert ('notes', 'https://b.com', str(notes / 'b.txt')) in _urls(tmp_path)
@@ -0,0 +1,183 @@
+"""
+Continuous incremental indexing (see promnesia index --watch).
+
+Watches files and directories indexed by the auto sources, reindexes only the files that changed
+and replaces their visits in the database (visits are matched to files via Loc.path).
+Uses watchfiles (i.e. inotify on Linux) if it's installed, otherwise falls back onto polling.
+"""
+
+from __future__ import annotations
+
+import os
+import threading
+from collections.abc import Collection, Iterable, Iterator, Sequence
+from pathlib import Path
+
+from . import config
+from .common import DbVisit, Res, Source, logger
+from .database.common import get_shard_path, get_shards_dir
+from .database.dump import STAGING_PREFIX, visits_to_sqlite
+from .extract import extract_visits_with_hook
+from .sources import auto
+from .sources.filetypes import IGNORE
+
+_POLL_INTERVAL_SECONDS = 5.0
+
+
+def watched_paths(source: Source) -> list[Path]:
+    """
+    Only auto sources can be reindexed for individual files at the moment, other sources are ignored
+    """
+    if source.ff is not auto.index:
+        return []
+    return [Path(a).expanduser().resolve().absolute() for a in source.args]
+
+
+Snapshot = dict[Path, tuple[int, int]]
+
+
+def _snapshot(roots: Iterable[Path]) -> Snapshot:
+    res: Snapshot = {}
+
+    def add(p: Path) -> None:
+        try:
+            st = p.stat()
+        except OSError:
+            return  # e.g. removed in the meantime
+        res[p] = (st.st_mtime_ns, st.st_size)
+
+    for root in roots:
+        if not root.is_dir():
+            add(root)
+            continue
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames[:] = [d for d in dirnames if d not in IGNORE]
+            for f in filenames:
+                add(Path(dirpath) / f)
+    return res
+
+
+def _poll_changes(roots: Sequence[Path], *, interval: float, stop: threading.Event) -> Iterator[set[Path]]:
+    before = _snapshot(roots)
+    while not stop.wait(interval):
+        after = _snapshot(roots)
+        changed = {p for p in before.keys() | after.keys() if before.get(p) != after.get(p)}
+        before = after
+        if len(changed) > 0:
+            yield changed
+
+
+def watch_changes(
+    roots: Sequence[Path],
+    *,
+    poll: float | None = None,
+    stop: threading.Event | None = None,
+) -> Iterator[set[Path]]:
+    """
+    Yields batches of paths created/modified/deleted under the roots
+
+    :param poll: if passed, polls for changes with this interval (in seconds) instead of using inotify
+    :param stop: when set, stops watching
+    """
+    stop = threading.Event() if stop is None else stop
+    if poll is None:
+        try:
+            import watchfiles
+        except ModuleNotFoundError as e:
+            if e.name != 'watchfiles':
+                raise e
+            logger.warning("watchfiles isn't installed, falling back to polling (pip3 install --user watchfiles)")
+            poll = _POLL_INTERVAL_SECONDS
+        else:
+            for changes in watchfiles.watch(*roots, stop_event=stop):
+                yield {Path(p) for _, p in changes}
+            return
+    yield from _poll_changes(roots, interval=poll, stop=stop)
+
+
+def index_changes(sources: Sequence[Source], changed: Collection[Path]) -> list[Exception]:
+    """
+    Reindexes changed files (or directories) for each source, and replaces their visits in the database
+    """
+    cfg = config.get()
+
+    paths: dict[str, set[str]] = {}
+    subsources: list[Source] = []
+    for source in sources:
+        roots = watched_paths(source)
+        mine = sorted({p for p in changed if any(p.is_relative_to(r) for r in roots)})
+        if len(mine) == 0:
+            continue
+        paths.setdefault(source.name, set()).update(map(str, mine))
+        subsources.append(Source(source.ff, *source.args, name=source.name, **{**source.kwargs, 'only': mine}))
+
+    if len(subsources) == 0:
+        return []
+
+    errors: list[Exception] = []
+
+    def it(sources: Iterable[Source]) -> Iterable[Res[DbVisit]]:
+        for source in sources:
+            for v in extract_visits_with_hook(source, hook=cfg.hook):
+                if isinstance(v, Exception):
+                    errors.append(v)
+                yield v
+
+    if cfg.SHARDED_DB:
+        for name, name_paths in sorted(paths.items()):
+            errors.extend(
+                visits_to_sqlite(
+                    it(s for s in subsources if s.name == name),
+                    overwrite_db=False,
+                    paths={name: name_paths},
+                    _db_path=get_shard_path(cfg.db, name),
+                )
+            )
+    else:
+        errors.extend(visits_to_sqlite(it(subsources), overwrite_db=False, paths=paths))
+    return errors
+
+
+def watch(
+    sources_subset: Collection[str | int] = (),
+    *,
+    poll: float | None = None,
+    stop: threading.Event | None = None,
+) -> None:
+    """
+    Watches auto sources for changes and keeps the database up to date, until stopped (or interrupted)
+    """
+    cfg = config.get()
+    sources = [
+        s
+        for i, s in enumerate(cfg.sources)
+        if isinstance(s, Source) and (len(sources_subset) == 0 or s.name in sources_subset or i in sources_subset)
+    ]
+    roots = sorted({r for s in sources for r in watched_paths(s) if r.exists()})
+    if len(roots) == 0:
+        logger.warning('no auto sources to watch')
+        return
+
+    # otherwise might end up reindexing in a loop if the database is in the watched directory
+    excluded = [str(cfg.db), str(get_shards_dir(cfg.db))]
+    cache_dir = cfg.cache_dir
+    if cache_dir is not None:
+        excluded.append(str(cache_dir / 'auto.sqlite'))
+
+    def interesting(p: Path) -> bool:
+        if any(i in p.parts for i in IGNORE):
+            return False
+        # staging database is next to the main one (so can be in a watched directory), but it's only temporary
+        if any(part.startswith(STAGING_PREFIX) for part in p.parts):
+            return False
+        return not any(str(p).startswith(e) for e in excluded)
+
+    logger.info('watching for changes: %s', [str(r) for r in roots])
+    for changes in watch_changes(roots, poll=poll, stop=stop):
+        changed = {p for p in changes if interesting(p)}
+        if len(changed) == 0:
+            continue
+        logger.info('%d paths changed, reindexing', len(changed))
+        logger.debug('changed: %s', sorted(changed))
+        for e in index_changes(sources, changed):
+            logger.exception(e)